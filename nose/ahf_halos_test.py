@@ -20,3 +20,42 @@ def test_ahf_properties():
     h = pynbody.halo.AHFCatalogue(f)
     assert h[1].properties['children']==[]
     assert h[1].properties['fstart']==23
+
+def test_ahf_particle_index():
+    import os.path
+    f = pynbody.load("testdata/g15784.lr.01024")
+    h = pynbody.halo.AHFCatalogue(f)
+    assert os.path.exists("testdata/g15784.lr.01024.z0.000.AHF_particles.pynbody-index.npy")
+    ids = h[1].get_index_list(f)
+    assert len(ids)==h[1].properties['npart']
+
+    # second load is from the index
+    h2 = pynbody.halo.AHFCatalogue(f)
+    assert (h2[1].get_index_list(f)==ids).all()
+    assert h2[1].properties['fstart']==23
+
+def test_ahf_stale_particle_index():
+    import numpy as np
+    index_filename = "testdata/g15784.lr.01024.z0.000.AHF_particles.pynbody-index.npy"
+    f = pynbody.load("testdata/g15784.lr.01024")
+    ids = pynbody.halo.AHFCatalogue(f)[1].get_index_list(f)
+
+    # an index written for a different catalogue is rebuilt rather than used
+    np.save(index_filename, np.array([5, 0, 1, 2, 3, 4, 5], dtype=np.int64))
+    h = pynbody.halo.AHFCatalogue(f)
+    assert (h[1].get_index_list(f)==ids).all()
+    assert np.load(index_filename)[0]==len(h)
+
+def test_ahf_fpos():
+    fpos_filename = "testdata/g15784.lr.01024.z0.000.AHF_fpos"
+    f = pynbody.load("testdata/g15784.lr.01024")
+    pynbody.halo.AHFCatalogue(f)
+    original = open(fpos_filename).read()
+
+    # halo positions in the particle file are taken from the fpos file
+    open(fpos_filename, 'w').write("\n".join(["999"] + original.split("\n")[1:]))
+    try:
+        h = pynbody.halo.AHFCatalogue(f)
+        assert h[1].properties['fstart']==999
+    finally:
+        open(fpos_filename, 'w').write(original)
@@ -190,3 +190,19 @@ def test_issue321():
     f = pynbody.load("testdata/lpicola/lpicola_z0p000.0")
     assert f['pos'].dtype==np.dtype('float32')
     assert f['mass'].dtype==np.dtype('float32')
+
+
+def test_threaded_multifile_read():
+    """Reading the files concurrently must give the same arrays as reading them in turn"""
+    n_threads = pynbody.config['number_of_threads']
+    try:
+        pynbody.config['number_of_threads'] = 1
+        serial = pynbody.load("testdata/test_g2_snap")
+        serial_pos, serial_gas_u = serial['pos'].copy(), serial.gas['u'].copy()
+        pynbody.config['number_of_threads'] = 4
+        threaded = pynbody.load("testdata/test_g2_snap")
+        assert (threaded['pos'] == serial_pos).all()
+        assert (threaded.gas['u'] == serial_gas_u).all()
+        assert (threaded['mass'] == serial['mass']).all()
+    finally:
+        pynbody.config['number_of_threads'] = n_threads
@@ -173,4 +173,35 @@ def test_hdf_ordering():
     # number
     assert snap._family_slice[pynbody.family.gas] == slice(0, 2076907, None)
     assert snap._family_slice[pynbody.family.dm] == slice(2076907, 4174059, None)
-    assert snap._family_slice[pynbody.family.star] == slice(4174059, 4194304, None)
\ No newline at end of file
+    assert snap._family_slice[pynbody.family.star] == slice(4174059, 4194304, None)
+
+def test_hyperslab_read():
+    """Check that reading a dataset in hyperslabs reproduces the whole array"""
+    from pynbody.snapshot import gadgethdf
+
+    filename = 'testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5'
+    old_hyperslab_size = gadgethdf.hyperslab_size
+    gadgethdf.hyperslab_size = 1000
+    try:
+        with h5py.File(filename, 'r') as f:
+            dataset = f['PartType0/Coordinates']
+            target = np.zeros(dataset.shape, dtype=dataset.dtype)
+            boundaries = gadgethdf._hyperslab_boundaries(dataset, 1)
+            assert len(boundaries) > 1
+            for start_row, stop_row in boundaries:
+                gadgethdf._cpui_read_hyperslab(filename, dataset.name, start_row, stop_row,
+                                               target[start_row:stop_row])
+    finally:
+        gadgethdf.hyperslab_size = old_hyperslab_size
+
+    assert (target == snap.gas['pos'].view(np.ndarray)).all()
+
+def test_take_read():
+    """Check that loading a subset of particles reads just those particles"""
+    take = np.concatenate((np.arange(1000, 1100), len(snap.gas) + np.arange(5000, 5050)))
+    part = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5', take=take)
+    assert len(part.gas) == 100
+    assert len(part.dm) == 50
+    assert (part['pos'] == snap['pos'][take]).all()
+    assert (part.gas['rho'] == snap.gas['rho'][1000:1100]).all()
+    assert (part['iord'] == snap['iord'][take]).all()
@@ -38,3 +38,19 @@ def test_grp_load_copy():
     h1_copy = h[1].load_copy()
     assert (h1_copy['x']==h[1]['x']).all()
     assert h1_copy.ancestor is h1_copy
+
+def test_region_load():
+    import os
+    f1 = pynbody.load("testdata/g15784.lr.01024")
+    region = pynbody.filt.Sphere(0.05, f1['pos'][0])
+
+    try:
+        for i in range(2):
+            # the second load re-uses the index stored alongside the file
+            f2 = pynbody.load("testdata/g15784.lr.01024", region=region)
+            assert os.path.exists("testdata/g15784.lr.01024.region-index.npz")
+            assert len(f2) < len(f1)
+            assert (f2[region]['x'] == f1[region]['x']).all()
+            assert (f2[region]['iord'] == f1[region]['iord']).all()
+    finally:
+        os.remove("testdata/g15784.lr.01024.region-index.npz")
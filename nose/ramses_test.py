@@ -1,5 +1,6 @@
 import pynbody
 import numpy as np
+import nose
 
 
 def setup():
@@ -143,3 +144,36 @@ def test_forcegas_dmo():
             2.25179981e+15,   2.25179981e+15,   2.25179981e+15,
             2.25179981e+15,   2.25179981e+15,   2.25179981e+15,
             1.80143985e+16], rtol=1e-5)
+
+def test_hilbert_cpu_selection():
+    from pynbody.snapshot import ramses
+
+    # eight CPUs, each owning one octant of the box
+    levelmax = 3
+    bound_keys = np.linspace(0, 2.0 ** (3 * (levelmax + 1)), 9)
+    select = lambda lo, hi: ramses._cpus_overlapping_box(np.array(lo), np.array(hi), bound_keys, levelmax)
+
+    assert select([0.1, 0.1, 0.1], [0.2, 0.2, 0.2]) == set([1])
+    assert select([0.6, 0.1, 0.1], [0.7, 0.2, 0.2]) == set([8])
+    assert select([0.0, 0.0, 0.0], [1.0, 1.0, 1.0]) == set(range(1, 9))
+
+def test_threaded_reading():
+    from pynbody.snapshot import ramses
+    from pynbody import util
+
+    if ramses.multiprocess:
+        # the readers are then wrapped to run in a process pool, not threads
+        raise nose.SkipTest("RAMSES reading is configured to use processes")
+
+    serial_remote_map = ramses.remote_map
+    f_serial = pynbody.load("testdata/ramses_partial_output_00250")
+
+    ramses.remote_map = lambda pool, fn, *iterables: util._thread_map_interleaved(fn, zip(*iterables), 4)
+    try:
+        f_threaded = pynbody.load("testdata/ramses_partial_output_00250")
+        assert len(f_threaded.gas) == len(f_serial.gas)
+        np.testing.assert_equal(f_threaded.gas['rho'], f_serial.gas['rho'])
+        np.testing.assert_equal(f_threaded.gas['pos'], f_serial.gas['pos'])
+        np.testing.assert_equal(f_threaded.dm['iord'], f_serial.dm['iord'])
+    finally:
+        ramses.remote_map = serial_remote_map
@@ -84,4 +84,115 @@ def test_render_stars():
 
     compare= np.load("test_stars_2d.npy")
 
-    npt.assert_allclose(compare,im[40:60],atol=0.01)
\ No newline at end of file
+    npt.assert_allclose(compare,im[40:60],atol=0.01)
+
+def test_render_several_quantities():
+    global f
+    f.gas['rho_2'] = f.gas['rho'] * 2
+    try:
+        for threaded in False, 2:
+            im_rho, im_temp, im_rho_2 = pynbody.sph.render_image(
+                f.gas, ['rho', 'temp', 'rho_2'], x2=10.0, nx=100,
+                out_units=["m_p cm^-3", None, "m_p cm^-3"], approximate_fast=False, threaded=threaded)
+
+            npt.assert_allclose(im_rho, pynbody.sph.render_image(f.gas, 'rho', x2=10.0, nx=100, out_units="m_p cm^-3",
+                                                                 approximate_fast=False, threaded=threaded), rtol=1e-5)
+            im_temp_single = pynbody.sph.render_image(f.gas, 'temp', x2=10.0, nx=100,
+                                                      approximate_fast=False, threaded=threaded)
+            npt.assert_allclose(im_temp, im_temp_single, rtol=1e-5)
+            assert im_temp.units == im_temp_single.units
+            npt.assert_allclose(im_rho_2, 2 * im_rho, rtol=1e-5)
+    finally:
+        del f.gas['rho_2']
+
+
+def test_render_with_tree_culling():
+    global f
+    g = pynbody.load("testdata/g15784.lr.01024")
+    g['pos'] -= [0.024456279579533, -0.034112552174141, -0.122436359962132]
+    g.physical_units()
+    g.gas['smooth'] = (g.gas['mass'] / g.gas['rho']) ** (1, 3)
+
+    for kernel in pynbody.sph.Kernel(), pynbody.sph.Kernel2D():
+        args = dict(qty='rho', x1=1.0, x2=3.0, y1=-2.0, y2=-1.0, nx=100, ny=50, kernel=kernel,
+                    approximate_fast=False)
+        im_all = pynbody.sph.render_image(g.gas, **args)
+
+        pynbody.sph.build_tree(g.gas)
+        visible = pynbody.sph._visible_particles(g.gas, 3.0, 100, -1.0, 50, 1.0, -2.0, None, kernel, 'smooth')
+        assert visible is not None and len(visible) < len(g.gas)
+        npt.assert_allclose(pynbody.sph.render_image(g.gas, **args), im_all, rtol=1e-5)
+        del g.gas.kdtree
+
+
+def test_tile_threaded_render():
+    global f
+    args = dict(qty='rho', x2=10.0, nx=300, ny=200, out_units="m_p cm^-3", approximate_fast=False)
+    im_serial = pynbody.sph.render_image(f.gas, threaded=False, **args)
+    im_1 = pynbody.sph.render_image(f.gas, threaded=1, **args)
+    im_4 = pynbody.sph.render_image(f.gas, threaded=4, **args)
+
+    # tiles are rendered independently, so the image does not depend on the
+    # number of threads
+    assert (im_1 == im_4).all()
+    npt.assert_allclose(im_4, im_serial, rtol=1e-5)
+
+
+def test_render_to_file():
+    import tempfile, shutil, os
+    global f
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "image.npy")
+        args = dict(x2=10.0, nx=300, ny=200, out_units="m_p cm^-3", approximate_fast=False)
+        units = pynbody.sph.outofcore.render_image_to_file(f.gas, filename, 'rho', tile_size=128, **args)
+        assert units == pynbody.units.Unit("m_p cm^-3")
+        assert not os.path.exists(filename + '.progress')
+        im = pynbody.sph.render_image(f.gas, 'rho', **args)
+        # (the edge pixels of render_image also include particles just outside the image)
+        npt.assert_allclose(np.load(filename)[1:-1, 1:-1], im[1:-1, 1:-1], rtol=1e-5, atol=1e-5 * im.max())
+
+        # an interrupted render only repeats the tiles that were not finished
+        ar = np.lib.format.open_memmap(filename, mode='r+')
+        ar[:] = 0
+        del ar
+        with open(filename + '.progress', 'wb') as progress:
+            np.save(progress, np.array([False, True, True, True, True, True]))
+        pynbody.sph.outofcore.render_image_to_file(f.gas, filename, 'rho', tile_size=128, **args)
+        result = np.load(filename)
+        npt.assert_allclose(result[1:128, 1:128], im[1:128, 1:128], rtol=1e-5, atol=1e-5 * im.max())
+        assert (result[128:] == 0).all() and (result[:, 128:] == 0).all()
+
+        filename = os.path.join(directory, "grid.npy")
+        pynbody.sph.outofcore.to_3d_grid_to_file(f.gas, filename, nx=40, x2=10.0, slab_size=7, threaded=False)
+        grid = pynbody.sph.to_3d_grid(f.gas, nx=40, x2=10.0, approximate_fast=False, threaded=False)
+        npt.assert_allclose(np.load(filename)[1:-1], grid[1:-1], rtol=1e-5, atol=1e-5 * grid.max())
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_grid_deposition():
+    np.random.seed(7)
+    s = pynbody.new(gas=3000)
+    s['pos'] = np.random.uniform(-5.0, 5.0, (3000, 3))
+    s['pos'].units = 'kpc'
+    s['mass'] = np.random.uniform(0.5, 1.5, 3000)
+    s['mass'].units = 'Msol'
+    s['rho'] = np.random.uniform(0.5, 1.5, 3000)
+    s['rho'].units = 'Msol kpc^-3'
+    # smoothing lengths both much smaller and much larger than the cells
+    s['smooth'] = 10 ** np.random.uniform(-2.0, 0.3, 3000)
+    s['smooth'].units = 'kpc'
+
+    # a non-cubic grid agrees with the original gridding core
+    args = (40, 30, 20, s['x'], s['y'], s['z'], s['smooth'], -10.0, 10.0, -10.0, 10.0, -10.0, 10.0,
+            s['rho'], s['mass'], s['rho'], 0.0, 100000.0, pynbody.sph.Kernel())
+    grid = pynbody.sph._render.to_3d_grid(*args)
+    npt.assert_allclose(pynbody.sph._render.to_3d_grid_slabs(*args, num_threads=4), grid, rtol=1e-6)
+
+    # the conserving deposition keeps all the mass, however many threads fill it
+    volume = 20.0 ** 3 / (40 * 30 * 20)
+    grids = [pynbody.sph.to_3d_grid(s, 'rho', 40, 30, 20, x2=10.0, threaded=threads, conserve=True,
+                                    denoise=False) for threads in (1, 4)]
+    assert (grids[0] == grids[1]).all()
+    npt.assert_allclose(grids[0].sum() * volume, s['mass'].sum(), rtol=1e-4)
@@ -0,0 +1,41 @@
+import pynbody
+import numpy as np
+import numpy.testing as npt
+
+
+def setup():
+    global f
+    np.random.seed(2)
+    f = pynbody.new(gas=20000)
+    f['pos'] = pynbody.array.SimArray(np.random.uniform(-1.0, 1.0, (20000, 3)), 'kpc')
+    f['mass'] = pynbody.array.SimArray(np.random.uniform(0.5, 1.5, 20000), 'Msol')
+    f['rho']
+
+
+def teardown():
+    global f
+    del f
+
+
+def test_render_snapshot_with_tree():
+    assert hasattr(f, 'kdtree')
+    visible = pynbody.sph._visible_particles(f, 0.5, 100, None, 100, None, None, None,
+                                             pynbody.sph.Kernel(), 'smooth')
+    assert visible is not None and len(visible) < len(f)
+
+    images = {}
+    for threaded in False, 2:
+        images[threaded] = pynbody.plot.sph.image(f, width='1 kpc', resolution=100, noplot=True,
+                                                  threaded=threaded)
+
+    # the same images are rendered from every particle once there is no tree
+    tree = f.kdtree
+    del f.kdtree
+    try:
+        for threaded in False, 2:
+            npt.assert_allclose(images[threaded],
+                                pynbody.plot.sph.image(f, width='1 kpc', resolution=100, noplot=True,
+                                                       threaded=threaded),
+                                rtol=1e-5)
+    finally:
+        f.kdtree = tree
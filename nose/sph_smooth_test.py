@@ -106,6 +106,382 @@ def test_periodic_smoothing():
     npt.assert_allclose(f.dm['rho'][::100],
                          np.load('test_rho_periodic.npy'),rtol=1e-5)
 
+def test_derived_array_cache():
+    import tempfile, shutil
+    cache_dir = tempfile.mkdtemp()
+    old_settings = dict(pynbody.config['derived-array-cache'])
+    pynbody.config['derived-array-cache'].update(enabled=True, directory=cache_dir)
+
+    try:
+        f1 = pynbody.load("testdata/g15784.lr.01024")
+        smooth = f1.dm['smooth']
+
+        # a new session on the same file gets the array without building a tree
+        f2 = pynbody.load("testdata/g15784.lr.01024")
+        npt.assert_allclose(f2.dm['smooth'], smooth)
+        assert not hasattr(f2.dm, 'kdtree')
+
+        # but not once the positions it was derived from have been modified
+        f3 = pynbody.load("testdata/g15784.lr.01024")
+        f3['pos'] += 0.01
+        f3.dm['smooth']
+        assert hasattr(f3.dm, 'kdtree')
+
+        # the retrieved array is still known to depend on the positions
+        assert 'smooth' in f2._dependency_tracker.get_dependents('pos')
+
+        # arrays calculated with an existing tree also depend on the
+        # positions, through the tree's neighbour sets
+        f1.dm['v_mean']
+        f4 = pynbody.load("testdata/g15784.lr.01024")
+        f4.dm['smooth']
+        f4['pos'] += 0.01
+        f4.dm['v_mean']
+        assert hasattr(f4.dm, 'kdtree')
+
+        # arrays derived together are each stored, and retrieved together
+        names = ['smooth', 'rho', 'v_mean', 'v_disp']
+        f5 = pynbody.load("testdata/g15784.lr.01024")
+        f5.dm.derive_many(names)
+        f6 = pynbody.load("testdata/g15784.lr.01024")
+        f6.dm.derive_many(names)
+        assert not hasattr(f6.dm, 'kdtree')
+        for name in names:
+            npt.assert_allclose(f6.dm[name], f5.dm[name])
+    finally:
+        pynbody.config['derived-array-cache'] = old_settings
+        shutil.rmtree(cache_dir)
+
+def test_threaded_tree_build():
+    pos = pynbody.util.native_byteorder(f.dm['pos'])
+    mass = pynbody.util.native_byteorder(f.dm['mass'])
+
+    smooth = []
+    for num_threads in 1, 4:
+        tree = pynbody.sph.kdtree.KDTree(pos, mass, num_threads=num_threads)
+        sm = np.empty(len(pos), dtype=pos.dtype)
+        tree.set_array_ref('smooth', sm)
+        tree.populate('hsm', 32)
+        smooth.append(sm)
+
+    # the tree, and hence everything calculated with it, does not depend on
+    # how many threads built it
+    assert (smooth[0] == smooth[1]).all()
+
+def test_tree_build_reference_counts():
+    import sys
+    pos = np.random.uniform(size=(1000, 3))
+    mass = np.ones(1000)
+
+    # building and freeing trees must not leak or steal references
+    before = sys.getrefcount(True), sys.getrefcount(None)
+    for i in range(50):
+        tree = pynbody.sph.kdtree.KDTree(pos, mass)
+        tree.set_array_ref('smooth', np.empty(1000))
+        tree.populate('hsm', 32)
+        del tree
+    assert (sys.getrefcount(True), sys.getrefcount(None)) == before
+
+def test_tree_persistence():
+    import pickle, tempfile, os
+    pos = pynbody.util.native_byteorder(f.dm['pos'])
+    mass = pynbody.util.native_byteorder(f.dm['mass'])
+
+    def hsm(tree):
+        sm = np.empty(len(pos), dtype=pos.dtype)
+        tree.set_array_ref('smooth', sm)
+        tree.populate('hsm', 32)
+        return sm
+
+    tree = pynbody.sph.kdtree.KDTree(pos, mass)
+    reference = hsm(tree)
+
+    # pickled trees are restored without a rebuild
+    assert (hsm(pickle.loads(pickle.dumps(tree, -1))) == reference).all()
+
+    # as are trees saved to disk
+    fd, filename = tempfile.mkstemp(suffix=".npz")
+    os.close(fd)
+    try:
+        tree.save(filename)
+        assert (hsm(pynbody.sph.kdtree.KDTree.load(filename, pos, mass)) == reference).all()
+    finally:
+        os.remove(filename)
+
+    # a corrupt particle order is rejected rather than indexing out of bounds
+    state = tree.get_state()
+    for order in state['order'] + 1, np.zeros_like(state['order']):
+        state['order'] = order
+        npt.assert_raises(ValueError, pynbody.sph.kdtree.KDTree.from_state, pos, mass, state)
+
+def test_batched_query():
+    np.random.seed(1)
+    pos = np.random.uniform(0, 1, (2000, 3))
+    mass = np.ones(2000)
+    points = np.random.uniform(0, 1, (50, 3))
+
+    for boxsize in None, 1.0:
+        tree = pynbody.sph.kdtree.KDTree(pos, mass, boxsize=boxsize)
+        offset = pos[np.newaxis, :, :] - points[:, np.newaxis, :]
+        if boxsize:
+            offset -= boxsize * np.round(offset / boxsize)
+        brute = np.sqrt((offset ** 2).sum(axis=2))
+
+        offsets, indices, distances = tree.query(points, 8, num_threads=2)
+        assert (offsets == np.arange(0, 50 * 8 + 1, 8)).all()
+        npt.assert_allclose(distances.reshape((50, 8)), np.sort(brute, axis=1)[:, :8], rtol=1e-5)
+        npt.assert_allclose(distances, brute[np.repeat(np.arange(50), 8), indices], rtol=1e-5)
+
+        offsets, indices, distances = tree.query_ball(points, 0.1, num_threads=2)
+        for i in xrange(50):
+            found = np.sort(indices[offsets[i]:offsets[i + 1]])
+            assert (found == np.where(brute[i] <= 0.1)[0]).all()
+
+def _linear_field_snapshot():
+    np.random.seed(2)
+    grid = np.mgrid[0:20, 0:20, 0:20].reshape((3, -1)).T + 0.5
+    s = pynbody.new(dm=len(grid))
+    s['pos'] = grid + np.random.uniform(-0.05, 0.05, grid.shape)
+    s['pos'].units = 'kpc'
+    s['mass'] = np.ones(len(s))
+    s['mass'].units = 'Msol'
+    A = np.array([[1.0, 2.0, 0.0], [-1.0, 0.5, 0.0], [0.0, 3.0, -0.5]])
+    s['vel'] = np.dot(s['pos'], A.T)
+    s['vel'].units = 'km s^-1'
+    interior = ((s['pos'] > 5) & (s['pos'] < 15)).all(axis=1)
+    return s, A, interior
+
+def test_sph_derivatives():
+    s, A, interior = _linear_field_snapshot()
+
+    npt.assert_allclose(np.median(s['v_div'][interior]), np.trace(A), rtol=0.05)
+
+    curl = [A[2, 1] - A[1, 2], A[0, 2] - A[2, 0], A[1, 0] - A[0, 1]]
+    npt.assert_allclose(np.median(s['v_curl'][interior], axis=0), curl, rtol=0.05, atol=0.05)
+
+    # the density is uniform, so its gradient is small compared to rho/h
+    assert (abs(s['rho_grad'][interior]).max(axis=1) < 0.1 * (s['rho'] / s['smooth'])[interior]).all()
+
+def test_external_smoothing_operator():
+    import ctypes
+    s, A, interior = _linear_field_snapshot()
+    s['smooth']
+
+    counts = np.zeros(len(s), dtype=np.int32)
+    operator_type = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int, ctypes.c_double, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_float))
+
+    def count_neighbours(data, i, h, n, neighbours, r2):
+        counts[i] = n
+
+    operator = operator_type(count_neighbours)
+    pynbody.sph.kdtree.register_smoothing_operator('count', ctypes.cast(operator, ctypes.c_void_p).value)
+    try:
+        s.kdtree.set_array_ref('smooth', s['smooth'])
+        s.kdtree.populate('count', 32)
+    finally:
+        pynbody.sph.kdtree.unregister_smoothing_operator('count')
+
+    expected = [len(s.kdtree.query_ball(s['pos'][i], 2 * s['smooth'][i])[1]) for i in xrange(0, len(s), 100)]
+    assert (counts[::100] == expected).all()
+
+def test_smooth_several_arrays():
+    f.dm['rho']
+    tree = f.dm.kdtree
+    tree.set_array_ref('rho', f.dm['rho'])
+    tree.set_array_ref('smooth', f.dm['smooth'])
+    tree.set_array_ref('mass', f.dm['mass'])
+
+    vel = f.dm['vel']
+    atol = 1e-4 * abs(vel).max()
+    table = np.random.uniform(size=(len(f.dm), 9))
+
+    vx_mean, vel_mean, table_mean = tree.sph_mean([f.dm['vx'], vel, table], 32)
+    npt.assert_allclose(vx_mean, tree.sph_mean(f.dm['vx'], 32), rtol=1e-4, atol=atol)
+    npt.assert_allclose(vel_mean, tree.sph_mean(vel, 32), rtol=1e-4, atol=atol)
+    assert vel_mean.units == vel.units
+    for i in xrange(9):
+        npt.assert_allclose(table_mean[:, i], tree.sph_mean(table[:, i].copy(), 32), rtol=1e-5)
+
+    tensor_mean = tree.sph_mean(table.reshape((-1, 3, 3)), 32)
+    npt.assert_allclose(tensor_mean.reshape((-1, 9)), table_mean, rtol=1e-5)
+
+    vx_disp, vel_disp = tree.sph_dispersion([f.dm['vx'], vel], 32)
+    npt.assert_allclose(vx_disp, tree.sph_dispersion(f.dm['vx'], 32), rtol=1e-4, atol=atol)
+    npt.assert_allclose(vel_disp, tree.sph_dispersion(vel, 32), rtol=1e-4, atol=atol)
+
+def test_derive_many():
+    g = pynbody.load("testdata/g15784.lr.01024")
+    h = pynbody.load("testdata/g15784.lr.01024")
+    del g.properties['boxsize']
+    del h.properties['boxsize']
+    g.dm.derive_many(['smooth', 'rho', 'v_mean', 'v_disp'])
+
+    for name in 'smooth', 'rho', 'v_mean', 'v_disp':
+        assert name in g.dm.keys()
+        npt.assert_allclose(g.dm[name], h.dm[name], rtol=1e-4)
+
+    # the arrays are linked to the positions as if derived individually
+    g['pos'] += 1
+    assert 'rho' not in g.dm.keys()
+    assert 'v_disp' not in g.dm.keys()
+
+def test_variable_neighbour_number():
+    np.random.seed(3)
+    pos = np.random.uniform(0, 1, (2000, 3))
+    mass = np.ones(2000)
+    nsmooth = np.random.choice([8, 16, 32], 2000)
+
+    tree = pynbody.sph.kdtree.KDTree(pos, mass)
+    smooth = np.empty(2000)
+    tree.set_array_ref('smooth', smooth)
+    tree.populate('hsm', nsmooth)
+
+    brute = np.sort(np.sqrt(((pos[:200, np.newaxis, :] - pos[np.newaxis, :, :]) ** 2).sum(axis=2)), axis=1)
+    npt.assert_allclose(smooth[:200], 0.5 * brute[np.arange(200), nsmooth[:200] - 1], rtol=1e-5)
+
+    # the combined pass agrees with separate smoothing and density passes
+    rho = np.empty(2000)
+    tree.set_array_ref('mass', mass)
+    tree.set_array_ref('rho', rho)
+    tree.populate('rho', 32)
+    smooth_2 = np.empty(2000)
+    rho_2 = np.empty(2000)
+    tree.set_array_ref('smooth', smooth_2)
+    tree.set_array_ref('rho', rho_2)
+    tree.populate('hsm_rho', nsmooth)
+    npt.assert_allclose(smooth_2, smooth, rtol=1e-6)
+    npt.assert_allclose(rho_2, rho, rtol=1e-5)
+
+    # a snapshot's nsmooth array sets the neighbour numbers for its smoothing lengths
+    s = pynbody.new(dm=2000)
+    s['pos'] = pos
+    s['mass'] = mass
+    s['nsmooth'] = nsmooth
+    npt.assert_allclose(s['smooth'], smooth, rtol=1e-6)
+    s['nsmooth'] = np.ones(2000, dtype=int) * 16
+    del s['smooth']
+    npt.assert_allclose(s['smooth'][:200], 0.5 * brute[:200, 15], rtol=1e-5)
+
+def test_out_of_core_smooth():
+    import tempfile, os, shutil
+    np.random.seed(4)
+    pos = np.random.uniform(0, 1, (4000, 3))
+    # include an overdensity so that some tiles need wider halos
+    pos[:1000] = 0.5 + 0.02 * np.random.normal(size=(1000, 3))
+    mass = np.random.uniform(0.5, 1.5, 4000)
+
+    directory = tempfile.mkdtemp()
+    try:
+        np.save(os.path.join(directory, "pos.npy"), pos)
+        pos_map = np.load(os.path.join(directory, "pos.npy"), mmap_mode='r')
+
+        for boxsize in None, 1.0:
+            tree = pynbody.sph.kdtree.KDTree(pos, mass, boxsize=boxsize)
+            smooth = np.empty(4000)
+            rho = np.empty(4000)
+            tree.set_array_ref('smooth', smooth)
+            tree.set_array_ref('mass', mass)
+            tree.set_array_ref('rho', rho)
+            tree.populate('hsm_rho', 32)
+
+            smooth_ooc, rho_ooc = pynbody.sph.outofcore.smooth_out_of_core(
+                pos_map, mass, os.path.join(directory, "smooth.npy"), os.path.join(directory, "rho.npy"),
+                nsmooth=32, boxsize=boxsize, ntiles=3, chunk=500)
+            assert isinstance(smooth_ooc, np.memmap)
+            npt.assert_allclose(smooth_ooc, smooth, rtol=1e-6)
+            npt.assert_allclose(rho_ooc, rho, rtol=1e-5)
+            del smooth_ooc, rho_ooc
+    finally:
+        shutil.rmtree(directory)
+
+class _CountingArray(object):
+    """Wraps an array, counting the particles read from it"""
+    def __init__(self, ar):
+        self.ar = ar
+        self.dtype = ar.dtype
+        self.read = 0
+
+    def __len__(self):
+        return len(self.ar)
+
+    def __getitem__(self, item):
+        result = self.ar[item]
+        self.read += len(result)
+        return result
+
+def test_out_of_core_reads():
+    np.random.seed(4)
+    pos = np.random.uniform(0, 1, (20000, 3))
+    mass = np.random.uniform(0.5, 1.5, 20000)
+
+    for boxsize in None, 1.0:
+        smooth = pynbody.sph.outofcore.smooth_out_of_core(pos, mass, np.empty(20000), nsmooth=32,
+                                                          boxsize=boxsize, ntiles=4, chunk=5000)
+        counting_pos = _CountingArray(pos)
+        npt.assert_allclose(pynbody.sph.outofcore.smooth_out_of_core(counting_pos, mass, np.empty(20000),
+                                                                     nsmooth=32, boxsize=boxsize,
+                                                                     ntiles=4, chunk=5000),
+                            smooth)
+        # rescanning every position for each of the 64 tiles would read
+        # them all 64 times over; the tiles only read their own and their
+        # halos' particles
+        assert counting_pos.read < 16 * len(pos)
+
+def test_smooth_in_processes():
+    if not pynbody.sph.distributed.available:
+        raise nose.SkipTest("posix_ipc is not available")
+
+    np.random.seed(5)
+    pos = np.random.uniform(0, 1, (4000, 3))
+    pos[:1000] = 0.3 + 0.02 * np.random.normal(size=(1000, 3))
+    mass = np.random.uniform(0.5, 1.5, 4000)
+
+    for boxsize in None, 1.0:
+        tree = pynbody.sph.kdtree.KDTree(pos, mass, boxsize=boxsize)
+        smooth = np.empty(4000)
+        rho = np.empty(4000)
+        tree.set_array_ref('smooth', smooth)
+        tree.set_array_ref('mass', mass)
+        tree.set_array_ref('rho', rho)
+        tree.populate('hsm_rho', 32)
+
+        smooth_p, rho_p = pynbody.sph.distributed.smooth_in_processes(pos, mass, 32, boxsize,
+                                                                       processes=2, ntiles=2)
+        npt.assert_allclose(smooth_p, smooth, rtol=1e-6)
+        npt.assert_allclose(rho_p, rho, rtol=1e-5)
+
+def test_float32_tree():
+    np.random.seed(6)
+    # positions far from the origin, where float32 would lose precision
+    pos = 1000.0 + np.random.uniform(0, 1, (3000, 3))
+    mass = np.random.uniform(0.5, 1.5, 3000)
+
+    results = []
+    for float32 in False, True:
+        tree = pynbody.sph.kdtree.KDTree(pos, mass, float32=float32)
+        smooth = np.empty(3000)
+        rho = np.empty(3000)
+        tree.set_array_ref('smooth', smooth)
+        tree.set_array_ref('mass', mass)
+        tree.set_array_ref('rho', rho)
+        tree.populate('hsm_rho', 32)
+        results.append((smooth, rho, tree.query(pos[:100], 8)[2]))
+
+    assert results[1][0].dtype == np.float64
+
+    # the double precision tree measures distances in single precision from
+    # the origin, so the recentred single precision tree is the more accurate
+    brute = np.sort(np.sqrt(((pos[:100, np.newaxis, :] - pos[np.newaxis, :, :]) ** 2).sum(axis=2)), axis=1)
+    npt.assert_allclose(results[1][0][:100], 0.5 * brute[:, 31], rtol=1e-6)
+    npt.assert_allclose(results[1][2].reshape((100, 8))[:, 1:], brute[:, 1:8], rtol=1e-5)
+    npt.assert_allclose(results[1][1], results[0][1], rtol=1e-2)
+
+    # the tree can be recreated from its state
+    state = tree.get_state()
+    assert 'origin' in state
+    tree_2 = pynbody.sph.kdtree.KDTree.from_state(pos, mass, state)
+    npt.assert_allclose(tree_2.query(pos[:100], 8)[2], results[1][2])
 
 if __name__=="__main__":
     test_float_kd()
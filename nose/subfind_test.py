@@ -0,0 +1,99 @@
+import pynbody
+import numpy as np
+import numpy.testing as npt
+import os, shutil, tempfile
+
+group_fields = [('group_len', 'int32', 1), ('group_off', 'int32', 1), ('mass', 'float32', 1),
+                ('pos', 'float32', 3), ('mmean_200', 'float32', 1), ('rmean_200', 'float32', 1),
+                ('mcrit_200', 'float32', 1), ('rcrit_200', 'float32', 1), ('mtop_200', 'float32', 1),
+                ('rtop_200', 'float32', 1), ('cont_count', 'int32', 1), ('contmass', 'float32', 1),
+                ('Nsubs', 'int32', 1), ('first_sub', 'int32', 1)]
+
+subhalo_fields = [('sub_len', 'int32', 1), ('sub_off', 'int32', 1), ('sub_parent', 'int32', 1),
+                  ('sub_mass', 'float32', 1), ('sub_pos', 'float32', 3), ('sub_vel', 'float32', 3),
+                  ('sub_CM', 'float32', 3), ('sub_spin', 'float32', 3), ('sub_veldisp', 'float32', 1),
+                  ('sub_VMax', 'float32', 1), ('sub_VMaxRad', 'float32', 1),
+                  ('sub_HalfMassRad', 'float32', 1), ('sub_mostboundID', 'int32', 1),
+                  ('sub_groupNr', 'int32', 1)]
+
+# groups, subhalos and ids in each of the files written by SubFind
+file_lengths = [(3, 2, 40), (0, 0, 0), (4, 3, 25)]
+
+
+def setup():
+    global f, halodir
+    np.random.seed(1)
+    f = pynbody.new(dm=100)
+    f['iord'] = np.arange(100, dtype=np.int32)
+    f.set_units_system(velocity='km s^-1', distance='kpc', mass='1e10 Msol', temperature='K')
+    f._filename = os.path.join(tempfile.mkdtemp(), "snapshot_005")
+    halodir = os.path.join(os.path.dirname(f._filename), "groups_005")
+    os.mkdir(halodir)
+
+    ngroups, nsubs, nids = [sum(x) for x in zip(*file_lengths)]
+    for n, (ngroup, nsub, nid) in enumerate(file_lengths):
+        with open(os.path.join(halodir, "subhalo_tab_005.%d" % n), "wb") as fd:
+            np.array([ngroup, ngroups, nid, nids, 0, len(file_lengths), nsub, nsubs], dtype=np.int32).tofile(fd)
+            for fields, count in (group_fields, ngroup), (subhalo_fields, nsub):
+                for name, dtype, ncomp in fields:
+                    if name == 'first_sub':
+                        values = np.random.randint(0, nsubs + 1, count)
+                    elif name == 'sub_mostboundID':
+                        values = np.random.randint(0, 100, count)
+                    else:
+                        values = np.random.uniform(0, 50, count * ncomp)
+                    values.astype(dtype).tofile(fd)
+        with open(os.path.join(halodir, "subhalo_ids_005.%d" % n), "wb") as fd:
+            np.array([ngroup, ngroups, nid, nids, 0, len(file_lengths), 0], dtype=np.int32).tofile(fd)
+            np.random.randint(0, 100, nid).astype(np.int32).tofile(fd)
+
+
+def teardown():
+    global f
+    shutil.rmtree(os.path.dirname(f._filename))
+    del f
+
+
+def _read_tables_per_file():
+    """Read the subhalo_tab and subhalo_ids files one at a time, concatenating
+    the results"""
+    halodat = dict([(name, np.array([], dtype=dtype)) for name, dtype, _ in group_fields])
+    subhalodat = dict([(name, np.array([], dtype=dtype)) for name, dtype, _ in subhalo_fields])
+    ids = np.array([], dtype=np.int32)
+
+    for n in range(len(file_lengths)):
+        with open(os.path.join(halodir, "subhalo_tab_005.%d" % n), "rb") as fd:
+            header = np.delete(np.fromfile(fd, dtype='int32', count=8), 4)
+            for table, fields, count in (halodat, group_fields, header[0]), (subhalodat, subhalo_fields, header[5]):
+                for name, dtype, ncomp in fields:
+                    table[name] = np.append(table[name], np.fromfile(fd, dtype=dtype, count=count * ncomp))
+        with open(os.path.join(halodir, "subhalo_ids_005.%d" % n), "rb") as fd:
+            np.fromfile(fd, dtype='int32', count=7)
+            ids = np.append(ids, np.fromfile(fd, dtype=np.int32, count=-1))
+
+    for table, fields in (halodat, group_fields), (subhalodat, subhalo_fields):
+        for name, dtype, ncomp in fields:
+            if ncomp > 1:
+                table[name] = table[name].reshape((-1, ncomp))
+
+    return halodat, subhalodat, ids
+
+
+def test_multi_file_read():
+    h = pynbody.halo.SubfindCatalogue(f)
+    halodat, subhalodat, ids = _read_tables_per_file()
+
+    assert len(h) == sum([x[0] for x in file_lengths])
+    assert (h.ids == ids).all()
+    for name, _, _ in group_fields:
+        npt.assert_array_equal(h._halodat[name], halodat[name])
+    for name, _, _ in subhalo_fields:
+        npt.assert_array_equal(h._subhalodat[name], subhalodat[name])
+
+    real_ones = halodat['first_sub'] < len(subhalodat['sub_len'])
+    npt.assert_array_equal(h._halodat['mostboundID'][real_ones],
+                           subhalodat['sub_mostboundID'][halodat['first_sub'][real_ones]])
+    assert (h._halodat['mostboundID'][~real_ones] == -1).all()
+
+    hs = pynbody.halo.SubfindCatalogue(f, subs=True)
+    assert len(hs) == sum([x[1] for x in file_lengths])
@@ -357,4 +357,62 @@ def test_issue_313():
 
 
 def test_issue_315():
-    assert np.allclose(f.g['cs'][:3], [187.36890472,  210.86151107,  176.04044173])
\ No newline at end of file
+    assert np.allclose(f.g['cs'][:3], [187.36890472,  210.86151107,  176.04044173])
+
+def test_mmap_load():
+    f_mmap = pynbody.load("testdata/g15784.lr.01024", mmap=True)
+    f_ref = pynbody.load("testdata/g15784.lr.01024")
+
+    assert np.all(f_mmap.dm['pos'] == f_ref.dm['pos'])
+    assert np.all(f_mmap.gas['temp'] == f_ref.gas['temp'])
+    assert np.all(f_mmap['mass'] == f_ref['mass'])
+    assert not f_mmap.star['tform'].flags['OWNDATA']
+    _assert_unit(f_mmap['pos'].units, "6.85e+04 kpc a")
+
+    # copy-on-write: the file must not be altered
+    f_mmap.gas['temp'] *= 2
+    assert np.all(pynbody.load("testdata/g15784.lr.01024").gas['temp'] == f_ref.gas['temp'])
+
+
+def test_mmap_binary_aux():
+    f2 = pynbody.new(gas=20, star=11, dm=9, order='gas,dm,star')
+    f2['x'] = np.arange(0, 40)
+    f2['aux_binary'] = np.arange(0, 40) * 0.5
+    f2.write(fmt=pynbody.tipsy.TipsySnap, filename="testdata/test_out.mmap.tipsy",
+             binary_aux_arrays=True)
+
+    f3 = pynbody.load("testdata/test_out.mmap.tipsy", mmap=True)
+    assert np.all(f3['x'] == f2['x'])
+    assert np.all(f3['aux_binary'] == f2['aux_binary'])
+    assert np.all(f3.dm['aux_binary'] == f2.dm['aux_binary'])
+
+
+def test_mmap_sph_derived():
+    np.random.seed(3)
+    f2 = pynbody.new(dm=2000)
+    f2['pos'] = np.random.uniform(0, 1, (2000, 3))
+    f2['vel'] = np.random.normal(size=(2000, 3))
+    f2['mass'] = np.random.uniform(0.5, 1.5, 2000)
+    f2.write(fmt=pynbody.tipsy.TipsySnap, filename="testdata/test_out.mmap_sph.tipsy")
+
+    # the memory-mapped arrays are in the file's byte order, which the
+    # tree must not be given directly
+    f_mmap = pynbody.load("testdata/test_out.mmap_sph.tipsy", mmap=True)
+    f_ref = pynbody.load("testdata/test_out.mmap_sph.tipsy")
+    for name in 'v_mean', 'v_disp', 'v_div', 'rho_grad':
+        ref = f_ref.dm[name]
+        assert np.allclose(f_mmap.dm[name], ref, rtol=1e-4, atol=1e-5 * abs(ref).max())
+
+
+def test_mmap_family_by_family():
+    f2 = pynbody.new(gas=20, star=11, dm=9, order='gas,dm,star')
+    f2['pos'] = np.arange(0, 120, dtype=np.float32).reshape((40, 3))
+    f2.write(fmt=pynbody.tipsy.TipsySnap, filename="testdata/test_out.mmap_fam.tipsy")
+
+    # loading each family in turn promotes the array to the whole snapshot
+    f3 = pynbody.load("testdata/test_out.mmap_fam.tipsy", mmap=True)
+    f3.gas['pos']
+    f3.dm['pos']
+    f3.star['pos']
+    assert np.all(f3['pos'] == f2['pos'])
+    assert np.all(f3.star['y'] == f2.star['y'])
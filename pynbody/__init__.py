@@ -19,7 +19,7 @@ from . import configuration
 from .configuration import config, config_parser, logger
 
 from . import util, filt, array, family, snapshot
-from .snapshot import tipsy, gadget, gadgethdf, ramses, grafic, nchilada, ascii
+from .snapshot import tipsy, gadget, gadgethdf, ramses, grafic, nchilada, ascii, columnar
 from . import analysis, halo, derived, bridge, gravity, sph, transformation
 
 
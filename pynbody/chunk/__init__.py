@@ -44,6 +44,9 @@ step-by-step instructions that take you through the file, specifying what to kee
 to throw away in a simple-to-use fashion. See the help for LoadControl.iterate for details
 on how to implement this final step.
 
+To load only the particles near a region of space, a loader can translate the region
+into a list of ids using the spatial index in :mod:`pynbody.chunk.region`.
+
 """
 
 from __future__ import division
@@ -54,6 +57,7 @@ import numpy as np
 import copy
 
 from .. import util
+from . import region
 
 
 class Chunk:
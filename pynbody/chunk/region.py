@@ -0,0 +1,314 @@
+"""
+
+chunk.region
+============
+
+Spatial indexing to support loading only the part of a file that covers
+a region of space.
+
+A :class:`RegionIndex` divides the particles on disk into *segments*.
+For Tipsy and Nchilada files these are fixed-length runs of particles.
+For multi-file Gadget snapshots they are the individual files. Each
+segment records two things:
+
+* the bounding box of its particles;
+* the range of Peano-Hilbert keys those particles occupy.
+
+Given a :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`,
+the index identifies the segments that may contain particles inside
+it. A loader can then read only those segments.
+
+The index is built the first time it is needed, by reading the
+positions of every particle once. It is then stored next to the
+snapshot as ``<filename>.region-index.npz``, and rebuilt if the
+snapshot changes. This is for internal use by the snapshot loaders;
+users should write e.g.
+
+ f = pynbody.load(filename, region=pynbody.filt.Sphere('1 Mpc', cen))
+
+The returned snapshot contains every particle in the region, plus
+the other particles that share a segment with them. Apply the region
+as a filter, ``f[region]``, for an exact selection.
+
+"""
+
+import os
+import warnings
+import numpy as np
+
+from .. import filt, units
+
+import logging
+logger = logging.getLogger('pynbody.chunk.region')
+
+# number of particles in each segment for formats indexed by particle offset
+_segment_length = 8192
+
+# bits per dimension of the Peano-Hilbert keys stored in the index
+_key_bits = 16
+
+# the largest number of cells a region may cover when it is converted
+# into a list of Peano-Hilbert keys; larger regions use coarser cells
+_max_region_cells = 2 ** 18
+
+
+def hilbert_keys(ix, iy, iz, bits):
+    """Return the Peano-Hilbert keys of the integer cell coordinates
+    *ix*, *iy*, *iz*, each in the range 0 to 2**bits-1.
+
+    Uses the transpose algorithm of Skilling (2004, AIP Conf. Proc.
+    707, 381), vectorised over the input arrays."""
+
+    X = [np.array(a, dtype=np.uint64) for a in (ix, iy, iz)]
+    one = np.uint64(1)
+
+    # inverse undo
+    Q = one << np.uint64(bits - 1)
+    while Q > one:
+        P = Q - one
+        for i in xrange(3):
+            bit_set = (X[i] & Q) != 0
+            X[0][bit_set] ^= P
+            bit_clear = ~bit_set
+            t = (X[0][bit_clear] ^ X[i][bit_clear]) & P
+            X[0][bit_clear] ^= t
+            X[i][bit_clear] ^= t
+        Q >>= one
+
+    # Gray encode
+    X[1] ^= X[0]
+    X[2] ^= X[1]
+    t = np.zeros_like(X[0])
+    Q = one << np.uint64(bits - 1)
+    while Q > one:
+        t[(X[2] & Q) != 0] ^= Q - one
+        Q >>= one
+    for i in xrange(3):
+        X[i] ^= t
+
+    # interleave the transposed bits into a single key
+    keys = np.zeros_like(X[0])
+    for b in xrange(bits - 1, -1, -1):
+        for i in xrange(3):
+            keys = (keys << one) | ((X[i] >> np.uint64(b)) & one)
+
+    return keys
+
+
+def _index_filename(filename):
+    return filename.rstrip(os.sep) + ".region-index.npz"
+
+
+def _source_mtime(filename):
+    for candidate in filename, filename + ".0", filename + ".0.hdf5":
+        if os.path.exists(candidate):
+            return os.path.getmtime(candidate)
+    return 0.0
+
+
+def bounding_boxes(region, f):
+    """Return a list of (lo, hi) boxes in the on-disk position units of *f*
+    which together cover *region*, including periodic images where the
+    region's own selection is periodic."""
+
+    pos_units = f._default_units_for('pos')
+    context = f.conversion_context()
+
+    def in_pos_units(x):
+        if units.is_unit_like(x):
+            return float(x.in_units(pos_units, **context))
+        return x
+
+    if isinstance(region, filt.Sphere):
+        radius = in_pos_units(region.radius)
+        cen = region.cen
+        if units.has_units(cen):
+            cen = cen.in_units(pos_units, **context)
+        cen = np.asarray(cen, dtype=float)
+        lo, hi = cen - radius, cen + radius
+        periodic = True
+    elif isinstance(region, filt.Cuboid):
+        lo = np.array([in_pos_units(x) for x in (region.x1, region.y1, region.z1)], dtype=float)
+        hi = np.array([in_pos_units(x) for x in (region.x2, region.y2, region.z2)], dtype=float)
+        periodic = False
+    else:
+        raise TypeError, "region must be a pynbody.filt.Sphere or pynbody.filt.Cuboid"
+
+    boxsize = f.properties.get('boxsize', None)
+    if not periodic or boxsize is None:
+        return [(lo, hi)]
+
+    boxsize = in_pos_units(boxsize)
+    boxes = []
+    for sx in (-boxsize, 0, boxsize):
+        for sy in (-boxsize, 0, boxsize):
+            for sz in (-boxsize, 0, boxsize):
+                shift = np.array([sx, sy, sz])
+                boxes.append((lo + shift, hi + shift))
+    return boxes
+
+
+class RegionIndex(object):
+
+    """Bounding boxes and Peano-Hilbert key ranges for segments of a file"""
+
+    def __init__(self, bbox_min, bbox_max, key_min, key_max, domain_min, domain_max,
+                 bits=_key_bits, segment_length=0, source_mtime=0.0):
+        self.bbox_min = bbox_min
+        self.bbox_max = bbox_max
+        self.key_min = key_min
+        self.key_max = key_max
+        self.domain_min = domain_min
+        self.domain_max = domain_max
+        self.bits = int(bits)
+        self.segment_length = int(segment_length)
+        self.source_mtime = float(source_mtime)
+
+    def __len__(self):
+        return len(self.key_min)
+
+    @classmethod
+    def build(cls, nsegments, segment_positions, **kwargs):
+        """Build an index for *nsegments* segments, where
+        *segment_positions(i)* returns the (N,3) positions of the particles
+        in segment *i*. Each segment is read twice: once to find the
+        domain, and once to calculate its keys."""
+
+        bits = kwargs.get('bits', _key_bits)
+
+        bbox_min = np.empty((nsegments, 3))
+        bbox_max = np.empty((nsegments, 3))
+        bbox_min[:] = np.inf
+        bbox_max[:] = -np.inf
+
+        for i in xrange(nsegments):
+            pos = np.asarray(segment_positions(i)).reshape((-1, 3))
+            if len(pos) > 0:
+                bbox_min[i] = pos.min(axis=0)
+                bbox_max[i] = pos.max(axis=0)
+
+        populated = np.isfinite(bbox_min[:, 0])
+        if populated.any():
+            domain_min = bbox_min[populated].min(axis=0)
+            domain_max = bbox_max[populated].max(axis=0)
+        else:
+            domain_min = np.zeros(3)
+            domain_max = np.ones(3)
+
+        index = cls(bbox_min, bbox_max, np.ones(nsegments, dtype=np.uint64),
+                    np.zeros(nsegments, dtype=np.uint64), domain_min, domain_max, bits,
+                    kwargs.get('segment_length', 0), kwargs.get('source_mtime', 0.0))
+
+        for i in np.where(populated)[0]:
+            pos = np.asarray(segment_positions(i)).reshape((-1, 3))
+            keys = hilbert_keys(*index._cells(pos, index.bits).T, bits=index.bits)
+            index.key_min[i] = keys.min()
+            index.key_max[i] = keys.max()
+
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        try:
+            return cls(*[data[k] for k in ('bbox_min', 'bbox_max', 'key_min', 'key_max',
+                                           'domain_min', 'domain_max', 'bits', 'segment_length',
+                                           'source_mtime')])
+        finally:
+            data.close()
+
+    def save(self, filename):
+        np.savez(filename, bbox_min=self.bbox_min, bbox_max=self.bbox_max,
+                 key_min=self.key_min, key_max=self.key_max,
+                 domain_min=self.domain_min, domain_max=self.domain_max,
+                 bits=self.bits, segment_length=self.segment_length,
+                 source_mtime=self.source_mtime)
+
+    def _cells(self, pos, level):
+        """Return the integer cell coordinates of *pos* on a grid of
+        2**level cells per dimension spanning the index domain"""
+        extent = self.domain_max - self.domain_min
+        extent = np.where(extent > 0, extent, 1.0)
+        ncells = 2 ** level
+        cells = np.floor((pos - self.domain_min) / extent * ncells)
+        return np.clip(cells, 0, ncells - 1).astype(np.int64)
+
+    def _region_keys(self, lo, hi):
+        """Return the sorted keys of all cells touching the box (lo, hi),
+        together with the level of the cells used"""
+        level = self.bits
+        while True:
+            cell_lo, cell_hi = self._cells(np.array([lo, hi]), level)
+            if np.prod(cell_hi - cell_lo + 1) <= _max_region_cells or level == 0:
+                break
+            level -= 1
+
+        grid = np.mgrid[cell_lo[0]:cell_hi[0] + 1,
+                        cell_lo[1]:cell_hi[1] + 1,
+                        cell_lo[2]:cell_hi[2] + 1].reshape((3, -1))
+        keys = hilbert_keys(*grid, bits=level) if level > 0 else np.zeros(1, dtype=np.uint64)
+        keys.sort()
+        return keys, level
+
+    def _overlapping_box(self, lo, hi):
+        overlap = ((self.bbox_min <= hi) & (self.bbox_max >= lo)).all(axis=1)
+        if not overlap.any():
+            return overlap
+
+        keys, level = self._region_keys(lo, hi)
+        shift = np.uint64(3 * (self.bits - level))
+        key_min = self.key_min >> shift
+        key_max = self.key_max >> shift
+        j = np.minimum(np.searchsorted(keys, key_min), len(keys) - 1)
+        return overlap & (keys[j] >= key_min) & (keys[j] <= key_max)
+
+    def overlapping(self, region, f):
+        """Return a boolean array which is True for segments that may
+        contain particles inside *region*. The snapshot *f* supplies the
+        units and box size used to interpret the region."""
+        result = np.zeros(len(self), dtype=bool)
+        for lo, hi in bounding_boxes(region, f):
+            result |= self._overlapping_box(lo, hi)
+        return result
+
+
+def get_index(f, nsegments, segment_positions, segment_length=0):
+    """Return the index for snapshot *f* stored on disk, or build and store
+    it if it is missing or out of date. See :meth:`RegionIndex.build` for
+    the meaning of *nsegments* and *segment_positions*."""
+
+    index_filename = _index_filename(f.filename)
+    source_mtime = _source_mtime(f.filename)
+
+    if os.path.exists(index_filename):
+        index = RegionIndex.load(index_filename)
+        if (len(index) == nsegments and index.segment_length == segment_length
+                and index.source_mtime == source_mtime):
+            return index
+
+    logger.info("Building region index for %s", f.filename)
+    index = RegionIndex.build(nsegments, segment_positions,
+                              segment_length=segment_length, source_mtime=source_mtime)
+    try:
+        index.save(index_filename)
+    except IOError:
+        warnings.warn("Unable to write region index %r; it will be rebuilt next time" % index_filename,
+                      RuntimeWarning)
+    return index
+
+
+def take_for_region(f, region, segment_length=_segment_length):
+    """Return the indices (in on-disk order) of the particles of the fully
+    loaded snapshot *f* which lie in segments of *segment_length*
+    particles that may overlap *region*. The result is suitable for
+    passing as *take* to a loader that supports partial loading."""
+
+    n = len(f)
+    nsegments = (n + segment_length - 1) // segment_length
+
+    def segment_positions(i):
+        return f['pos'][i * segment_length:(i + 1) * segment_length].view(np.ndarray)
+
+    index = get_index(f, nsegments, segment_positions, segment_length)
+    selected = np.repeat(index.overlapping(region, f), segment_length)[:n]
+    return np.where(selected)[0]
@@ -81,6 +81,11 @@ def _get_basic_config_from_parser(config_parser):
         'general', 'gravity_calculation_mode')
     config['disk-fit-function'] = config_parser.get('general', 'disk-fit-function')
 
+    config['derived-array-cache'] = {
+        'enabled': config_parser.getboolean('derived-array-cache', 'enabled'),
+        'directory': config_parser.get('derived-array-cache', 'directory'),
+        'max-size': int(config_parser.get('derived-array-cache', 'max-size')) * 1024 ** 2}
+
     return config
 
 def _setup_logger(config):
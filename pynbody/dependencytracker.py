@@ -27,6 +27,7 @@ class DependencyTracker(object):
         self._dependencies = {}
         self._current_calculation_stack = []
         self._calculation_lock = threading.RLock()
+        self._modified = set()
 
     def _setup_my_dependencies(self,name):
         if name not in self._dependencies:
@@ -54,3 +55,29 @@ class DependencyTracker(object):
 
     def get_dependents(self, name):
         return self._dependencies.get(name, set())
+
+    def get_dependencies(self, name):
+        return set([other for other, dependents in self._dependencies.iteritems() if name in dependents])
+
+    def get_all_dependencies(self, name):
+        """Return every array the named one depends on, directly or through
+        other derived arrays"""
+        found = set()
+        pending = [name]
+        while pending:
+            for other in self.get_dependencies(pending.pop()):
+                if other not in found and other != name:
+                    found.add(other)
+                    pending.append(other)
+        return found
+
+    def modifying(self, name):
+        """Record a change to the named array. Changes made while loading or
+        deriving an array are part of that calculation; any others are
+        modifications by the user, remembered for has_been_modified."""
+        with self._calculation_lock:
+            if len(self._current_calculation_stack) == 0:
+                self._modified.add(name)
+
+    def has_been_modified(self, name):
+        return name in self._modified
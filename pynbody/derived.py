@@ -14,6 +14,7 @@ from . import analysis
 from . import sph
 from . import config
 from . import units
+from . import util
 import numpy as np
 import sys
 import logging
@@ -125,13 +126,14 @@ def v_mean(self):
     logger.info(
         'Calculating mean velocity with %d nearest neighbours' % nsmooth)
 
-    sm = array.SimArray(np.empty_like(self['vel']),
+    vel = util.native_byteorder(self['vel'])
+    sm = array.SimArray(np.empty_like(vel),
                         self['vel'].units)
 
-    self.kdtree.set_array_ref('rho',self['rho'])
-    self.kdtree.set_array_ref('smooth',self['smooth'])
-    self.kdtree.set_array_ref('mass',self['mass'])
-    self.kdtree.set_array_ref('qty',self['vel'])
+    self.kdtree.set_array_ref('rho',util.native_byteorder(self['rho']))
+    self.kdtree.set_array_ref('smooth',util.native_byteorder(self['smooth']))
+    self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
+    self.kdtree.set_array_ref('qty',vel)
     self.kdtree.set_array_ref('qty_sm',sm)
 
     start = time.time()
@@ -155,13 +157,14 @@ def v_disp(self):
     logger.info(
         'Calculating velocity dispersion with %d nearest neighbours' % nsmooth)
 
-    sm = array.SimArray(np.empty(len(self['vel']),dtype=self['vel'].dtype),
+    vel = util.native_byteorder(self['vel'])
+    sm = array.SimArray(np.empty(len(vel),dtype=vel.dtype),
                         self['vel'].units)
 
-    self.kdtree.set_array_ref('rho',self['rho'])
-    self.kdtree.set_array_ref('smooth',self['smooth'])
-    self.kdtree.set_array_ref('mass',self['mass'])
-    self.kdtree.set_array_ref('qty',self['vel'])
+    self.kdtree.set_array_ref('rho',util.native_byteorder(self['rho']))
+    self.kdtree.set_array_ref('smooth',util.native_byteorder(self['smooth']))
+    self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
+    self.kdtree.set_array_ref('qty',vel)
     self.kdtree.set_array_ref('qty_sm',sm)
 
     start = time.time()
@@ -173,6 +176,94 @@ def v_disp(self):
     return sm
 
 
+@SimSnap.derived_quantity_group('smooth', 'rho', 'v_mean', 'v_disp')
+def _sph_velocity_group(self, names):
+    """Derive smoothing lengths and densities from one neighbour search,
+    then the mean and dispersion of the velocity from one more"""
+    import sph
+
+    results = {}
+    if 'smooth' in names:
+        results['smooth'], results['rho'] = sph._smooth_and_rho(self)
+    elif 'rho' in names:
+        results['rho'] = sph.rho(self)
+
+    if 'v_mean' in names or 'v_disp' in names:
+        sph.build_tree(self)
+        nsmooth = config['sph']['smooth-particles']
+
+        logger.info(
+            'Calculating mean velocity and dispersion with %d nearest neighbours' % nsmooth)
+
+        # the dispersion operator stores the mean and variance of each
+        # component when given an output with two columns per component
+        vel = util.native_byteorder(self['vel'])
+        sm = np.empty((len(vel), 6), dtype=vel.dtype)
+
+        self.kdtree.set_array_ref('rho',util.native_byteorder(results['rho'] if 'rho' in results else self['rho']))
+        self.kdtree.set_array_ref('smooth',util.native_byteorder(results['smooth'] if 'smooth' in results else self['smooth']))
+        self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
+        self.kdtree.set_array_ref('qty',vel)
+        self.kdtree.set_array_ref('qty_sm',sm)
+
+        start = time.time()
+        self.kdtree.populate('qty_disp',nsmooth)
+        end = time.time()
+
+        logger.info('Mean velocity and dispersion done in %5.3g s' % (end - start))
+
+        results['v_mean'] = array.SimArray(sm[:, :3].copy(), vel.units)
+        results['v_disp'] = array.SimArray(np.sqrt(sm[:, 3:].sum(axis=1)), vel.units)
+
+    return results
+
+
+def _sph_derivative(self, qty, mode, shape, units):
+    import sph
+
+    sph.build_tree(self)
+    nsmooth = config['sph']['smooth-particles']
+    self['rho']
+
+    qty_ar = util.native_byteorder(self[qty])
+    sm = array.SimArray(np.empty(shape, dtype=qty_ar.dtype), units)
+
+    self.kdtree.set_array_ref('rho',util.native_byteorder(self['rho']))
+    self.kdtree.set_array_ref('smooth',util.native_byteorder(self['smooth']))
+    self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
+    self.kdtree.set_array_ref('qty',qty_ar)
+    self.kdtree.set_array_ref('qty_sm',sm)
+
+    start = time.time()
+    self.kdtree.populate(mode,nsmooth)
+    end = time.time()
+
+    logger.info('SPH %s of %s done in %5.3g s' % (mode[4:], qty, end - start))
+
+    return sm
+
+
+@SimSnap.derived_quantity
+def v_div(self):
+    """SPH estimate of the divergence of the velocity"""
+    return _sph_derivative(self, 'vel', 'qty_div', len(self),
+                           self['vel'].units / self['pos'].units)
+
+
+@SimSnap.derived_quantity
+def v_curl(self):
+    """SPH estimate of the curl of the velocity"""
+    return _sph_derivative(self, 'vel', 'qty_curl', (len(self), 3),
+                           self['vel'].units / self['pos'].units)
+
+
+@SimSnap.derived_quantity
+def rho_grad(self):
+    """SPH estimate of the gradient of the density"""
+    return _sph_derivative(self, 'rho', 'qty_grad', (len(self), 3),
+                           self['rho'].units / self['pos'].units)
+
+
 @SimSnap.derived_quantity
 def age(self):
     """Stellar age determined from formation time and current snapshot time"""
@@ -1,5 +1,4 @@
 import glob
-import gzip
 import os.path
 import re
 
@@ -8,6 +7,52 @@ import numpy as np
 from . import HaloCatalogue, logger, Halo, DummyHalo
 from .. import util, snapshot, config_parser
 
+# size of the blocks in which the AHF_particles file is read and parsed
+_particle_block_size = 64 * 1024 * 1024
+
+
+def _read_ahf_particle_columns(f, ncols):
+    """Parse the remainder of the AHF_particles file f, which must have
+    ncols integer columns on every line, in large blocks.
+
+    Returns the first column of every line, together with the offset in
+    the file of the start of each line."""
+
+    columns = []
+    line_starts = []
+    offset = f.tell()
+    remainder = ""
+
+    while True:
+        block = f.read(_particle_block_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind("\n") + 1
+        remainder = block[cut:]
+        if cut == 0:
+            continue
+        block = block[:cut]
+
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+        line_starts.append(offset + np.concatenate(([0], newlines[:-1] + 1)))
+        values = np.fromstring(block, dtype=np.int64, sep=" ")
+        if len(values) != ncols * len(newlines):
+            raise IOError("Unexpected layout of AHF particle file")
+        columns.append(values[::ncols])
+        offset += len(block)
+
+    if remainder.strip():
+        values = np.fromstring(remainder, dtype=np.int64, sep=" ")
+        if len(values) != ncols:
+            raise IOError("Unexpected layout of AHF particle file")
+        line_starts.append(np.array([offset]))
+        columns.append(values[:1])
+
+    if len(columns) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(columns), np.concatenate(line_starts)
+
 class AHFCatalogue(HaloCatalogue):
 
     """
@@ -90,7 +135,7 @@ class AHFCatalogue(HaloCatalogue):
         self._load_ahf_halos(self._ahfBasename + 'halos')
 
         if self._only_stat is None:
-            self._get_file_positions(self._ahfBasename + 'particles')
+            self._get_file_positions()
 
         if self._dosort is not None:
             nparr = np.array([self._halos[i+1].properties['npart'] for i in range(self._nhalos)])
@@ -188,19 +233,11 @@ class AHFCatalogue(HaloCatalogue):
             hord = self._sorted_indices[::-1]
             hcnt = hcnt[::-1]
 
-        if self._all_parts is None:
-            f = util.open_(self._ahfBasename+'particles')
-
         cnt = 0
         ar = np.empty(len(target),dtype=np.int32)
         ar[:]=-1
         for i in hord:
-            halo = self._halos[i]
-            if self._all_parts is not None:
-                ids = halo.get_index_list(self.base)
-            else:
-                f.seek(halo.properties['fstart'],0)
-                ids = self._load_ahf_particle_block(f,halo.properties['npart'])
+            ids = self._halo_particle_ids(i)
             if family is None:
                 ar[ids] = hcnt[cnt]
             else:
@@ -240,10 +277,7 @@ class AHFCatalogue(HaloCatalogue):
         if self._all_parts is not None:
             return self._halos[i]
         else:
-            f = util.open_(self._ahfBasename+'particles')
-            fpos = self._halos[i].properties['fstart']
-            f.seek(fpos,0)
-            return Halo(i, self, self.base, self._load_ahf_particle_block(f, self._halos[i].properties['npart']))
+            return Halo(i, self, self.base, self._halo_particle_ids(i))
 
 
 
@@ -259,59 +293,31 @@ class AHFCatalogue(HaloCatalogue):
         if self._dosort is not None:
             i = self._sorted_indices[i-1]
 
-        f = util.open_(self._ahfBasename + 'particles')
-
-        fpos = self._halos[i].properties['fstart']
-        f.seek(fpos,0)
-        ids = self._load_ahf_particle_block(f, nparts=self._halos[i].properties['npart'])
-
-        f.close()
-
-        return load(self.base.filename, take=ids)
+        return load(self.base.filename, take=self._halo_particle_ids(i))
 
-    def _get_file_positions(self,filename):
-        """Get the starting positions of each halo's particle information within the
-        AHF_particles file for faster access later"""
+    def _get_file_positions(self):
+        """Record the starting position of each halo's particle information within
+        the AHF_particles file, from the fpos file if there is one"""
         if os.path.exists(self._ahfBasename + 'fpos'):
             f = util.open_(self._ahfBasename + 'fpos')
             for i in range(self._nhalos):
                 self._halos[i+1].properties['fstart'] = int(f.readline())
             f.close()
         else:
-            f = util.open_(filename)
             for h in xrange(self._nhalos):
-                if len((f.readline().split())) == 1:
-                    f.readline()
-                self._halos[h+1].properties['fstart'] = f.tell()
-                for i in xrange(self._halos[h+1].properties['npart']):
-                    f.readline()
-            f.close()
+                self._halos[h+1].properties['fstart'] = int(self._particle_fstart[h])
 
-    def _load_ahf_particle_block(self, f, nparts=None):
-        """Load the particles for the next halo described in particle file f"""
+    def _file_index_to_snapshot(self, data):
+        """Convert particle indices as written by AHF into offsets within the
+        base snapshot"""
         ng = len(self.base.gas)
         nd = len(self.base.dark)
         ns = len(self.base.star)
         nds = nd+ns
 
-        if nparts is None:
-            startline = f.readline()
-            if len((startline.split()))==1:
-                startline = f.readline()
-            nparts = int(startline.split()[0])
+        data = np.array(data, dtype=int)
 
         if self.isnew:
-            if not isinstance(f, gzip.GzipFile):
-                data = (np.fromfile(
-                    f, dtype=int, sep=" ", count=nparts * 2).reshape(nparts, 2))[:, 0]
-                data = np.ascontiguousarray(data)
-            else:
-                # unfortunately with gzipped files there does not
-                # seem to be an efficient way to load nparts lines
-                data = np.zeros(nparts, dtype=int)
-                for i in xrange(nparts):
-                    data[i] = int(f.readline().split()[0])
-
             if self._use_iord:
                 data = self._iord_to_fpos[data]
             else:
@@ -324,39 +330,121 @@ class AHFCatalogue(HaloCatalogue):
                     g_mask = data >= nds
                     data[np.where(st_mask)] += ng
                     data[np.where(g_mask)] -= ns
-        else:
-            if not isinstance(f, gzip.GzipFile):
-                data = np.fromfile(f, dtype=int, sep=" ", count=nparts)
-            else:
-                # see comment above on gzipped files
-                data = np.zeros(nparts, dtype=int)
-                for i in xrange(nparts):
-                    data[i] = int(f.readline())
         data.sort()
         return data
 
+    def _halo_particle_ids(self, i):
+        """Return the sorted offsets within the base snapshot of the particles in halo i"""
+        start, stop = self._particle_offsets[i-1], self._particle_offsets[i]
+        return self._file_index_to_snapshot(self._particle_ids[start:stop])
+
+    def _parse_ahf_particles(self, filename):
+        """Read the whole AHF_particles file, returning the number of
+        particles in each halo, the file position at which each halo's
+        particle list starts and the concatenated particle indices as
+        written by AHF"""
+
+        f = util.open_(filename)
+        try:
+            first_line = f.readline()
+            if self.isnew:
+                # an optional line giving the number of halos is followed by
+                # an 'npart haloid' line and then npart 'id type' lines per halo
+                header_lines = 1
+                first_column, line_starts = _read_ahf_particle_columns(f, 2)
+                if len(first_line.split()) == 1:
+                    first_line_start = np.zeros(0, dtype=np.int64)
+                else:
+                    first_column = np.concatenate(([int(first_line.split()[0])], first_column))
+                    first_line_start = np.zeros(1, dtype=np.int64)
+            else:
+                # two single-column header lines, the second giving npart, are
+                # followed by npart lines containing one id each
+                header_lines = 2
+                first_column, line_starts = _read_ahf_particle_columns(f, 1)
+                first_column = np.concatenate(([int(first_line)], first_column))
+                first_line_start = np.zeros(1, dtype=np.int64)
+            line_starts = np.concatenate((first_line_start, line_starts))
+        finally:
+            f.close()
+
+        # the position of each halo depends on the sizes of all those before it,
+        # so finding the header lines is a loop over halos rather than particles
+        header_starts = np.empty(self._nhalos, dtype=np.int64)
+        nparts = np.empty(self._nhalos, dtype=np.int64)
+        line = 0
+        for h in xrange(self._nhalos):
+            header_starts[h] = line
+            nparts[h] = first_column[line + header_lines - 1]
+            line += header_lines + nparts[h]
+
+        if line > len(first_column):
+            raise IOError("AHF particle file is truncated")
+
+        is_particle = np.zeros(len(first_column), dtype=bool)
+        is_particle[:line] = True
+        for k in xrange(header_lines):
+            is_particle[header_starts + k] = False
+
+        fstart = line_starts[header_starts + header_lines]
+        return nparts, fstart, first_column[is_particle]
+
+    def _load_particle_index(self, filename):
+        """Read the halo particle lists from the binary index alongside the
+        AHF_particles file, creating the index first if it does not exist
+        or is older than the particle file.
+
+        The index is a single int64 .npy array holding the number of
+        halos, the offset of each halo's particles in the concatenated
+        list, each halo's starting position in the AHF_particles file and
+        finally the concatenated particle list itself. An index for a
+        different number of halos is stale, and is rebuilt."""
+
+        index_filename = filename + ".pynbody-index.npy"
+        source_mtime = max([os.path.getmtime(x) for x in (filename, filename + ".gz") if os.path.exists(x)])
+
+        index = None
+        if os.path.exists(index_filename) and os.path.getmtime(index_filename) >= source_mtime:
+            index = np.load(index_filename, mmap_mode='r')
+            if index[0] != self._nhalos:
+                logger.warn("AHF particle index %s does not match the catalogue; rebuilding it", index_filename)
+                # release the mapping before the file is overwritten
+                index = None
+
+        if index is None:
+            logger.info("AHFCatalogue building particle index %s", index_filename)
+            nparts, fstart, ids = self._parse_ahf_particles(filename)
+            index = np.concatenate(([self._nhalos], [0], np.cumsum(nparts), fstart, ids)).astype(np.int64)
+            try:
+                np.save(index_filename, index)
+            except IOError:
+                logger.warn("Unable to write AHF particle index %s", index_filename)
+
+        self._particle_offsets = index[1:self._nhalos + 2]
+        self._particle_fstart = index[self._nhalos + 2:2 * self._nhalos + 2]
+        self._particle_ids = index[2 * self._nhalos + 2:]
+
     def _load_ahf_particles(self, filename):
         if self._use_iord:
             self._iord_to_fpos = np.zeros(self.base['iord'].max()+1,dtype=int)
             self._iord_to_fpos[self.base['iord']] = np.arange(len(self._base()))
 
-        f = util.open_(filename)
         if filename.split("z")[-2][-1] is ".":
             self.isnew = True
         else:
             self.isnew = False
 
+        self._load_particle_index(filename)
+
         if self._all_parts is not None:
             for h in xrange(self._nhalos):
                 self._halos[h + 1] = Halo(
-                    h + 1, self, self.base, self._load_ahf_particle_block(f))
+                    h + 1, self, self.base, self._halo_particle_ids(h + 1))
                 self._halos[h + 1]._descriptor = "halo_" + str(h + 1)
         else:
             for h in xrange(self._nhalos):
                 self._halos[h + 1] = DummyHalo()
 
-        f.close()
-
     def _load_ahf_halos(self, filename):
         f = util.open_(filename,"rt")
         # get all the property names from the first, commented line
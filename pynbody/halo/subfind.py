@@ -1,10 +1,11 @@
+import io
 import os.path
 import weakref
 
 import numpy as np
 
 from . import HaloCatalogue, Halo
-from .. import units
+from .. import units, util
 from ..array import SimArray
 
 
@@ -115,97 +116,101 @@ class SubfindCatalogue(HaloCatalogue):
         fd.close()
         return header  # [4]
 
+    def _tab_filename(self, n):
+        return self.halodir + "/subhalo_tab_" + self.halodir.split("_")[-1] + "." + str(n)
+
+    def _ids_filename(self, n):
+        return self.halodir + "/subhalo_ids_" + self.halodir.split("_")[-1] + "." + str(n)
+
+    def _group_fields(self):
+        """Return the (name, dtype, components) of each group property in the order
+        they are stored in the subhalo_tab files"""
+        return [('group_len', 'int32', 1), ('group_off', 'int32', 1), ('mass', self.dtype_flt, 1),
+                ('pos', self.dtype_flt, 3), ('mmean_200', self.dtype_flt, 1), ('rmean_200', self.dtype_flt, 1),
+                ('mcrit_200', self.dtype_flt, 1), ('rcrit_200', self.dtype_flt, 1), ('mtop_200', self.dtype_flt, 1),
+                ('rtop_200', self.dtype_flt, 1), ('cont_count', 'int32', 1), ('contmass', self.dtype_flt, 1),
+                ('Nsubs', 'int32', 1), ('first_sub', 'int32', 1)]
+
+    def _subhalo_fields(self):
+        """Return the (name, dtype, components) of each subhalo property in the order
+        they are stored in the subhalo_tab files"""
+        return [('sub_len', 'int32', 1), ('sub_off', 'int32', 1), ('sub_parent', 'int32', 1),
+                ('sub_mass', self.dtype_flt, 1), ('sub_pos', self.dtype_flt, 3), ('sub_vel', self.dtype_flt, 3),
+                ('sub_CM', self.dtype_flt, 3), ('sub_spin', self.dtype_flt, 3), ('sub_veldisp', self.dtype_flt, 1),
+                ('sub_VMax', self.dtype_flt, 1), ('sub_VMaxRad', self.dtype_flt, 1),
+                ('sub_HalfMassRad', self.dtype_flt, 1), ('sub_mostboundID', self.dtype_int, 1),
+                ('sub_groupNr', 'int32', 1)]
+
+    @staticmethod
+    def _allocate_table(fields, length):
+        return dict([(name, np.empty((length, ncomp) if ncomp > 1 else length, dtype=dtype))
+                     for name, dtype, ncomp in fields])
+
+    @staticmethod
+    def _read_into(fd, target, filename):
+        if fd.readinto(target) != target.nbytes:
+            raise IOError("Unexpected end of SubFind file " + filename)
+
     def _read_ids(self):
-        data_ids = np.array([], dtype=self.dtype_int)
-        for n in range(0, self._tasks):
-            filename = self.halodir + "/subhalo_ids_" + \
-                self.halodir.split("_")[-1] + "." + str(n)
-            fd = open(filename, "rb")
-            # for some reason there is an extra value in header which we delete
-            # in the next step
-            header1 = np.fromfile(fd, dtype='int32', sep="", count=7)
-            header = np.delete(header1, 4)
-            # TODO: include a check if both headers agree (they better)
-            ids = np.fromfile(fd, dtype=self.dtype_int, sep="", count=-1)
-            fd.close()
-            data_ids = np.append(data_ids, ids)
+        # find the number of IDs in each file, then read them all into
+        # one preallocated array
+        itemsize = np.dtype(self.dtype_int).itemsize
+        lengths = [(os.path.getsize(self._ids_filename(n)) - 28) // itemsize for n in xrange(self._tasks)]
+        starts = np.concatenate(([0], np.cumsum(lengths)))
+        data_ids = np.empty(starts[-1], dtype=self.dtype_int)
+
+        def read_file(n):
+            filename = self._ids_filename(n)
+            with io.open(filename, 'rb') as fd:
+                # the header is 7 int32s, including a 64-bit total
+                fd.seek(28)
+                self._read_into(fd, data_ids[starts[n]:starts[n + 1]], filename)
+
+        util._thread_map_interleaved(read_file, [(n,) for n in xrange(self._tasks)])
         return data_ids
 
     def _read_groups(self):
-        halodat={}
-        keys_flt=['mass', 'pos', 'mmean_200', 'rmean_200', 'mcrit_200', 'rcrit_200', 'mtop_200', 'rtop_200', 'contmass']
-        keys_int=['group_len', 'group_off',  'first_sub', 'Nsubs', 'cont_count', 'mostboundID']
-        for key in keys_flt:
-            halodat[key]=np.array([], dtype=self.dtype_flt)
-        for key in keys_int:
-            halodat[key]=np.array([], dtype='int32')
-
-        subhalodat={}
-        subkeys_int=['sub_len', 'sub_off', 'sub_parent', 'sub_mostboundID', 'sub_groupNr']
-        subkeys_flt=['sub_pos', 'sub_vel', 'sub_CM', 'sub_mass', 'sub_spin', 'sub_veldisp', 'sub_VMax', 'sub_VMaxRad', 'sub_HalfMassRad', ]
-        for key in subkeys_int:
-            subhalodat[key]=np.array([], dtype='int32')
-        subhalodat['sub_mostboundID']=np.array([], dtype=self.dtype_int)
-        #subhalodat['sub_groupNr']=np.array([], dtype=self.dtype_int) #these are special
-        for key in subkeys_flt:
-            subhalodat[key]=np.array([], dtype=self.dtype_flt)
-
-        self._keys=keys_flt+keys_int
+        group_fields = self._group_fields()
+        subhalo_fields = self._subhalo_fields()
+
+        self._keys = [name for name, _, _ in group_fields] + ['mostboundID']
         if self._subs is True:
-            self._keys=subkeys_flt+subkeys_int
-
-        for n in xrange(0,self._tasks):
-            filename=self.halodir+"/subhalo_tab_"+self.halodir.split("_")[-1]+"." +str(n)
-            fd=open(filename, "rb")
-            header1=np.fromfile(fd, dtype='int32', sep="", count=8)
-            header=np.delete(header1,4)
-            #read groups
-            if header[0]>0:
-                halodat['group_len']=np.append(halodat['group_len'], np.fromfile(fd, dtype='int32', sep="", count=header[0]))
-                halodat['group_off']=np.append(halodat['group_off'], np.fromfile(fd, dtype='int32', sep="", count=header[0]))
-                halodat['mass']=np.append(halodat['mass'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['pos']=np.append(halodat['pos'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=3*header[0]) )
-                halodat['mmean_200']=np.append(halodat['mmean_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['rmean_200']=np.append(halodat['rmean_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['mcrit_200']=np.append(halodat['mcrit_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['rcrit_200']=np.append(halodat['rcrit_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['mtop_200']=np.append(halodat['mtop_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['rtop_200']=np.append(halodat['rtop_200'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['cont_count']=np.append(halodat['cont_count'], np.fromfile(fd, dtype='int32', sep="", count=header[0]))
-                halodat['contmass']=np.append(halodat['contmass'],np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[0]))
-                halodat['Nsubs']=np.append(halodat['Nsubs'],np.fromfile(fd, dtype='int32', sep="", count=header[0]))
-                halodat['first_sub']=np.append(halodat['first_sub'],np.fromfile(fd, dtype='int32', sep="", count=header[0]))
-            #read subhalos only if expected to exist from header
-            if header[5]>0:
-                subhalodat['sub_len']=np.append(subhalodat['sub_len'], np.fromfile(fd, dtype='int32', sep="", count=header[5]))
-                subhalodat['sub_off']=np.append(subhalodat['sub_off'], np.fromfile(fd, dtype='int32', sep="", count=header[5]))
-                subhalodat['sub_parent']=np.append(subhalodat['sub_parent'], np.fromfile(fd, dtype='int32', sep="", count=header[5]))
-                subhalodat['sub_mass']=np.append(subhalodat['sub_mass'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[5]))
-                subhalodat['sub_pos']=np.append(subhalodat['sub_pos'],np.fromfile(fd, dtype=self.dtype_flt, sep="", count=3*header[5]))
-                subhalodat['sub_vel']=np.append(subhalodat['sub_vel'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=3*header[5]))
-                subhalodat['sub_CM']=np.append(subhalodat['sub_CM'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=3*header[5]))
-                subhalodat['sub_spin']=np.append(subhalodat['sub_spin'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=3*header[5]))
-                subhalodat['sub_veldisp']=np.append(subhalodat['sub_veldisp'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[5]))
-                subhalodat['sub_VMax']=np.append(subhalodat['sub_VMax'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[5]))
-                subhalodat['sub_VMaxRad']=np.append(subhalodat['sub_VMaxRad'],np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[5]))
-                subhalodat['sub_HalfMassRad']=np.append(subhalodat['sub_HalfMassRad'], np.fromfile(fd, dtype=self.dtype_flt, sep="", count=header[5]))
-                subhalodat['sub_mostboundID']=np.append(subhalodat['sub_mostboundID'], np.fromfile(fd, dtype=self.dtype_int, sep="", count=header[5]))
-                subhalodat['sub_groupNr']=np.append(subhalodat['sub_groupNr'], np.fromfile(fd, dtype='int32', sep="", count=header[5]))
-            fd.close()
-
-        halodat['pos']=np.reshape(halodat['pos'], (header[1],3))
-        if header[6]>0:
+            self._keys = [name for name, _, _ in subhalo_fields]
+
+        # first pass: read every header to find where each file's groups and
+        # subhalos belong in the full tables
+        ngroups = np.zeros(self._tasks, dtype=int)
+        nsubs = np.zeros(self._tasks, dtype=int)
+        for n in xrange(self._tasks):
+            with open(self._tab_filename(n), "rb") as fd:
+                header = np.delete(np.fromfile(fd, dtype='int32', sep="", count=8), 4)
+            ngroups[n] = header[0]
+            nsubs[n] = header[5]
+
+        group_starts = np.concatenate(([0], np.cumsum(ngroups)))
+        sub_starts = np.concatenate(([0], np.cumsum(nsubs)))
+        halodat = self._allocate_table(group_fields, group_starts[-1])
+        subhalodat = self._allocate_table(subhalo_fields, sub_starts[-1])
+
+        # second pass: each property is stored contiguously within a file, so
+        # is read directly into its place in the preallocated table
+        def read_file(n):
+            filename = self._tab_filename(n)
+            with io.open(filename, 'rb') as fd:
+                fd.seek(32)
+                for name, _, _ in group_fields:
+                    self._read_into(fd, halodat[name][group_starts[n]:group_starts[n + 1]], filename)
+                for name, _, _ in subhalo_fields:
+                    self._read_into(fd, subhalodat[name][sub_starts[n]:sub_starts[n + 1]], filename)
+
+        util._thread_map_interleaved(read_file, [(n,) for n in xrange(self._tasks)])
+
+        halodat['mostboundID']=np.zeros(len(halodat['Nsubs']),dtype=self.dtype_int)-1
+        if sub_starts[-1]>0:
             #some voodoo because some SubFind files may have (at least?) one extra entry which is not really a subhalo
-            real_ones=np.where(halodat['first_sub']<header[6])[0]
-            fake_ones=np.where(halodat['first_sub']>=header[6])[0]
-            halodat['mostboundID']=np.zeros(len(halodat['Nsubs']),dtype=self.dtype_int)-1
+            real_ones=np.where(halodat['first_sub']<sub_starts[-1])[0]
             halodat['mostboundID'][real_ones]=subhalodat['sub_mostboundID'][halodat['first_sub'][real_ones]]  #useful for the case of unordered snapshot IDs
 
-            subhalodat['sub_pos']=np.reshape(subhalodat['sub_pos'], (header[6],3))
-            subhalodat['sub_vel']=np.reshape(subhalodat['sub_vel'], (header[6],3))
-            subhalodat['sub_CM']=np.reshape(subhalodat['sub_CM'], (header[6],3))
-            subhalodat['sub_spin']=np.reshape(subhalodat['sub_spin'], (header[6],3))
-
         ar_names = 'mass', 'pos', 'mmean_200', 'rmean_200', 'mcrit_200', 'rcrit_200', 'mtop_200', 'rtop_200', \
                    'sub_mass', 'sub_pos', 'sub_vel', 'sub_CM', 'sub_veldisp', 'sub_VMax', 'sub_VMaxRad', 'sub_HalfMassRad'
         ar_dimensions = 'kg', 'm', 'kg', 'm', 'kg', 'm', 'kg', 'm', \
@@ -100,12 +100,6 @@ def velocity_image(sim, width="10 kpc", vector_color='black', edgecolor='black',
 
     vx_name, vy_name, _ = sim._array_name_ND_to_1D(vector_qty)
 
-    vx = image(sim, qty=vx_name, width=width, log=False,
-               resolution=vector_resolution, noplot=True,av_z=av_z)
-    vy = image(sim, qty=vy_name, width=width, log=False,
-               resolution=vector_resolution, noplot=True,av_z=av_z)
-    key_unit = _units.Unit(key_length)
-
     if isinstance(width, str) or issubclass(width.__class__, _units.UnitBase):
         if isinstance(width, str):
             width = _units.Unit(width)
@@ -113,6 +107,19 @@ def velocity_image(sim, width="10 kpc", vector_color='black', edgecolor='black',
 
     width = float(width)
 
+    if av_z:
+        vx = image(sim, qty=vx_name, width=width, log=False,
+                   resolution=vector_resolution, noplot=True,av_z=av_z)
+        vy = image(sim, qty=vy_name, width=width, log=False,
+                   resolution=vector_resolution, noplot=True,av_z=av_z)
+    else:
+        # render both components in a single pass
+        vx, vy = sph.render_image(sim, [vx_name, vy_name], width / 2, vector_resolution)
+        for im in vx, vy:
+            im[np.isnan(im)] = 0.0
+
+    key_unit = _units.Unit(key_length)
+
     pixel_size = width / vector_resolution
     X, Y = np.meshgrid(np.arange(-width / 2 + pixel_size/2, width / 2 + pixel_size/2, pixel_size ),
                        np.arange(-width / 2 + pixel_size/2, width / 2 + pixel_size/2, pixel_size))
@@ -399,10 +406,9 @@ def image(sim, qty='rho', width="10 kpc", resolution=500, units=None, log=True,
                 sim["__one"] = np.ones_like(sim[qty])
                 sim["__one"].units = "1"
 
-            im = sph.render_image(sim, qty, width / 2, resolution, out_units=aunits, kernel=kernel,
-                                  z_camera=z_camera, **kwargs)
-            im2 = sph.render_image(sim, av_z, width / 2, resolution, kernel=kernel,
-                                   z_camera=z_camera, **kwargs)
+            # render the weighted quantity and the weights in one pass
+            im, im2 = sph.render_image(sim, [qty, av_z], width / 2, resolution, out_units=[aunits, None],
+                                       kernel=kernel, z_camera=z_camera, **kwargs)
 
             top = sim.ancestor
 
@@ -15,7 +15,7 @@ from .. import filt, units, config, array
 from .sph import image
 from .. import units as _units
 
-from ..sph import render_spherical_image
+from ..sph import render_spherical_image, render_image
 from ..sph import Kernel2D
 
 import logging
@@ -163,12 +163,14 @@ def render(sim, filename=None,
 		smf = filt.HighPass('smooth', str(starsize) + ' kpc')
 		sim.s[smf]['smooth'] = array.SimArray(starsize, 'kpc', sim=sim)
 
-	r = image(sim.s, qty=r_band + '_lum_den', width=width, log=False,
-			  units="pc^-2", clear=False, noplot=True, resolution=resolution) * r_scale
-	g = image(sim.s, qty=g_band + '_lum_den', width=width, log=False,
-			  units="pc^-2", clear=False, noplot=True, resolution=resolution) * g_scale
-	b = image(sim.s, qty=b_band + '_lum_den', width=width, log=False,
-			  units="pc^-2", clear=False, noplot=True, resolution=resolution) * b_scale
+	# render the three bands together, in a single pass over the stars
+	r, g, b = render_image(sim.s, [band + '_lum_den' for band in (r_band, g_band, b_band)],
+						   float(width) / 2, resolution, out_units=_units.Unit("pc^-2"), kernel=Kernel2D())
+	for im in r, g, b:
+		im[np.isnan(im)] = 0.0
+	r = r * r_scale
+	g = g * g_scale
+	b = b * b_scale
 
 	# convert all channels to mag arcsec^-2
 
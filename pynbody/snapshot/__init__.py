@@ -17,10 +17,12 @@ from .. import units
 from .. import config
 from .. import simdict
 from .. import dependencytracker
+from . import derivedcache
 from ..units import has_units
 
 import numpy as np
 import copy
+import contextlib
 import weakref
 import sys
 import hashlib
@@ -88,6 +90,8 @@ class SimSnap(object):
 
     _derived_quantity_registry = {}
 
+    _derived_quantity_groups = []
+
     _decorator_registry = {}
 
     _loadable_keys_registry = {}
@@ -1227,6 +1231,39 @@ class SimSnap(object):
                 sfa(a, new_ar[:, i])
                 self._family_arrays[a][family]._name = a
 
+    def _install_mapped_array(self, array_name, fam, ar):
+        """Store an existing array (typically memory-mapped from disk) directly in
+        the snapshot for family *fam*, or for the whole snapshot if *fam* is None,
+        bypassing the allocation and copy that _create_array would perform"""
+
+        ar._sim = weakref.ref(self)
+        ar._name = array_name
+
+        if fam is None or len(self.families()) == 1:
+            ar.family = None
+
+            def store(n, v):
+                self._arrays[n] = v
+        else:
+            ar.family = fam
+
+            def store(n, v):
+                self._family_arrays.setdefault(n, {})[fam] = v
+
+        store(array_name, ar)
+        if len(ar.shape) == 2 and ar.shape[1] == 3:
+            for i, a in enumerate(self._array_name_ND_to_1D(array_name)):
+                ar_1D = ar[:, i]
+                ar_1D._name = a
+                store(a, ar_1D)
+
+        if ar.family is not None and all([f in self._family_arrays[array_name] for f in self.families()]):
+            # as in _create_family_array, an array present for every family
+            # becomes a simulation-level array. The families are stored
+            # separately on disk, so that array cannot be a view onto the file.
+            self._promote_family_array(array_name, ndim=ar.shape[1] if ar.ndim > 1 else 1,
+                                       dtype=ar.dtype.newbyteorder('='))
+
     def _del_family_array(self, array_name, family):
         """Delete the array with the specified name for the specified family"""
         del self._family_arrays[array_name][family]
@@ -1475,6 +1512,70 @@ class SimSnap(object):
         else:
             return None
 
+    @classmethod
+    def derived_quantity_group(cl, *names):
+        """Return a decorator registering a function *fn(sim, names)* which
+        calculates together two or more of the named derived arrays more
+        cheaply than deriving them one at a time. It is used by
+        :meth:`derive_many`, and must return a dictionary mapping each of
+        the requested names to its array. The names must be listed so that
+        each depends only on those before it."""
+        def register(fn):
+            SimSnap._derived_quantity_groups.append((cl, names, fn))
+            return fn
+        return register
+
+    def derive_many(self, names):
+        """Derive each of the named arrays that is not already present.
+
+        Where several of them can be calculated together, they are
+        calculated in one step. For example, SPH smoothing lengths,
+        densities and smoothed velocities share their neighbour
+        searches. The remaining arrays are derived one at a time."""
+        self._derive_many([n for n in names if n not in self.keys()])
+        for name in names:
+            self[name]
+
+    def _derive_many(self, names, fam=None):
+        target = self if fam is None else self[fam]
+        for cl, group, fn in self._derived_quantity_groups:
+            if not isinstance(self, cl):
+                continue
+
+            entries = {}
+            for n in group:
+                if n in names and n not in target.keys():
+                    deriving_fn = self._find_deriving_function(n)
+                    if deriving_fn is not None:
+                        entries[n] = (deriving_fn,) + self._derived_cache_entry(deriving_fn, n, fam)
+
+            # arrays available from the derived array cache are retrieved
+            # from it rather than calculated
+            with self.auto_propagate_off:
+                for name, (deriving_fn, key, cached) in entries.iteritems():
+                    if cached is not None:
+                        with self._dependency_tracker.calculating(name):
+                            result = self._retrieve_from_derived_cache(name, cached)
+                        self._install_derived_array(name, result, deriving_fn, fam)
+
+            wanted = [n for n in group if n in entries and entries[n][2] is None]
+            if len(wanted) < 2:
+                continue
+
+            logger.info("Deriving arrays %s together" % ", ".join(wanted))
+            with self.auto_propagate_off:
+                # nested calculations, so that arrays used by fn are recorded as
+                # dependencies of all the arrays it calculates
+                with contextlib.nested(*[self._dependency_tracker.calculating(n) for n in reversed(wanted)]):
+                    results = fn(target, wanted)
+
+                # installing an array marks it modified, so store every
+                # result before installing any of them
+                for name in wanted:
+                    self._store_in_derived_cache(entries[name][1], name, results[name])
+                for name in wanted:
+                    self._install_derived_array(name, results[name], entries[name][0], fam)
+
     def _derive_array(self, name, fam=None):
         """Calculate and store, for this SnapShot, the derivable array 'name'.
         If *fam* is not None, derive only for the specified family.
@@ -1489,50 +1590,117 @@ class SimSnap(object):
         if fn:
             logger.info("Deriving array %s" % name)
             with self.auto_propagate_off:
-                if fam is None:
-                    result = fn(self)
-                    ndim = result.shape[-1] if len(
-                        result.shape) > 1 else 1
-                    self._create_array(
-                        name, ndim, dtype=result.dtype, derived=not fn.__stable__)
-                    write_array = self._get_array(
-                        name, always_writable=True)
-                else:
-                    result = fn(self[fam])
-                    ndim = result.shape[-1] if len(
-                        result.shape) > 1 else 1
+                result = self._calculate_derived_array(fn, name, fam)
+                self._install_derived_array(name, result, fn, fam)
 
-                    # check if a family array already exists with a different dtype
-                    # if so, cast the result to the existing dtype
-                    # numpy version < 1.7 does not support doing this in-place
-
-                    if self._get_preferred_dtype(name) != result.dtype \
-                       and self._get_preferred_dtype(name) is not None:
-                        if int(np.version.version.split('.')[1]) > 6 :
-                            result = result.astype(self._get_preferred_dtype(name),copy=False)
-                        else :
-                            result = result.astype(self._get_preferred_dtype(name))
-
-                    self[fam]._create_array(
-                        name, ndim, dtype=result.dtype, derived=not fn.__stable__)
-                    write_array = self[fam]._get_array(
-                        name, always_writable=True)
-
-                self.ancestor._autoconvert_array_unit(result)
-
-                write_array[:] = result
-                if units.has_units(result):
-                    write_array.units = result.units
+    def _install_derived_array(self, name, result, fn, fam=None):
+        """Store the result of deriving the named array with *fn*"""
+        if fam is None:
+            ndim = result.shape[-1] if len(
+                result.shape) > 1 else 1
+            self._create_array(
+                name, ndim, dtype=result.dtype, derived=not fn.__stable__)
+            write_array = self._get_array(
+                name, always_writable=True)
+        else:
+            ndim = result.shape[-1] if len(
+                result.shape) > 1 else 1
+
+            # check if a family array already exists with a different dtype
+            # if so, cast the result to the existing dtype
+            # numpy version < 1.7 does not support doing this in-place
+
+            if self._get_preferred_dtype(name) != result.dtype \
+               and self._get_preferred_dtype(name) is not None:
+                if int(np.version.version.split('.')[1]) > 6 :
+                    result = result.astype(self._get_preferred_dtype(name),copy=False)
+                else :
+                    result = result.astype(self._get_preferred_dtype(name))
+
+            self[fam]._create_array(
+                name, ndim, dtype=result.dtype, derived=not fn.__stable__)
+            write_array = self[fam]._get_array(
+                name, always_writable=True)
+
+        self.ancestor._autoconvert_array_unit(result)
+
+        write_array[:] = result
+        if units.has_units(result):
+            write_array.units = result.units
+
+    def _derived_cache_entry(self, fn, name, fam=None):
+        """Return the derived array cache key for the named array, and the
+        (result, inputs) stored under it if these can be re-used"""
+        cache = derivedcache.get_cache()
+        if cache is None:
+            return None, None
+
+        key = derivedcache.cache_key(self, name, fam, fn)
+        if key is None:
+            return None, None
+
+        cached = cache.lookup(key)
+        if cached is not None:
+            result, inputs = cached
+            if not self._any_modified(inputs):
+                return key, cached
+        return key, None
+
+    def _any_modified(self, inputs):
+        """Return True if any of the named arrays, or anything they were
+        derived from in this session, has been modified"""
+        tracker = self._dependency_tracker
+        for x in inputs:
+            if tracker.has_been_modified(x):
+                return True
+            if any([tracker.has_been_modified(y) for y in tracker.get_all_dependencies(x)]):
+                return True
+        return False
 
+    def _store_in_derived_cache(self, key, name, result):
+        if key is None:
+            return
+        inputs = self._dependency_tracker.get_all_dependencies(name)
+        if not self._any_modified(inputs):
+            try:
+                derivedcache.get_cache().store(key, result, inputs)
+            except (IOError, OSError):
+                warnings.warn("Unable to store array %s in the derived array cache" % name, RuntimeWarning)
+
+    def _retrieve_from_derived_cache(self, name, cached):
+        """Return the result from a derived array cache entry found by
+        :meth:`_derived_cache_entry`"""
+        result, inputs = cached
+        logger.info("Retrieved array %s from derived array cache" % name)
+        # register the dependencies that calling the deriving function would have
+        for x in inputs:
+            self._dependency_tracker.touching(x)
+        return result
+
+    def _calculate_derived_array(self, fn, name, fam=None):
+        """Call the deriving function *fn* for the named array, or retrieve its
+        result from the derived array cache if that is switched on and none
+        of the arrays it depends on have been modified"""
+
+        key, cached = self._derived_cache_entry(fn, name, fam)
+        if cached is not None:
+            return self._retrieve_from_derived_cache(name, cached)
 
+        if fam is None:
+            result = fn(self)
+        else:
+            result = fn(self[fam])
 
+        self._store_in_derived_cache(key, name, result)
 
+        return result
 
     def _dirty(self, name):
         """Declare a given array as changed, so deleting any derived
         quantities which depend on it"""
 
         name = self._array_name_1D_to_ND(name) or name
+        self._dependency_tracker.modifying(name)
         if name=='pos':
             for v in self.ancestor._persistent_objects.itervalues():
                 if 'kdtree' in v:
@@ -1803,6 +1971,9 @@ class SubSnap(SimSnap):
     def _derive_array(self, array_name, fam=None):
         self.base._derive_array(array_name, fam)
 
+    def _derive_many(self, names, fam=None):
+        self.base._derive_many(names, fam)
+
     def family_keys(self, fam=None):
         return self.base.family_keys(fam)
 
@@ -1971,6 +2142,10 @@ class FamilySubSnap(SubSnap):
         if fam is self._unifamily or fam is None:
             self.base._derive_array(array_name, self._unifamily)
 
+    def _derive_many(self, names, fam=None):
+        if fam is self._unifamily or fam is None:
+            self.base._derive_many(names, self._unifamily)
+
 
 
 def load(filename, *args, **kwargs):
@@ -2048,10 +2223,11 @@ def _get_snap_classes():
     from . import ramses
     from . import grafic
     from . import ascii
+    from . import columnar
 
     _snap_classes = [gadgethdf.GadgetHDFSnap, gadgethdf.SubFindHDFSnap, gadgethdf.EagleLikeHDFSnap,
                      nchilada.NchiladaSnap, gadget.GadgetSnap,
                      tipsy.TipsySnap, ramses.RamsesSnap, grafic.GrafICSnap,
-                     ascii.AsciiSnap]
+                     ascii.AsciiSnap, columnar.ColumnarSnap]
 
     return _snap_classes
@@ -0,0 +1,301 @@
+"""
+
+columnar
+========
+
+A pynbody-native snapshot format designed for re-opening quickly.
+
+A columnar snapshot is a directory. Each array is stored in its own
+numpy ``.npy`` file: snapshot-level arrays as ``<array>.npy``, and
+family-level arrays as ``<array>.<family>.npy``. A small header,
+``columnar-header.json``, records:
+
+* the family slices;
+* the snapshot properties;
+* the file unit system;
+* the units and file name of every array.
+
+Opening the snapshot reads only the header, and arrays are loaded
+lazily one at a time. Uncompressed columns are memory-mapped
+copy-on-write, so loading them costs almost nothing until the data is
+used. Columns may instead be gzip-compressed (``.npy.gz``). Compressed
+columns take less space but must be read in full.
+
+To convert any snapshot, write it in this format:
+
+ f = pynbody.load("output_00080")
+ f.write(fmt=pynbody.snapshot.columnar.ColumnarSnap, filename="output_00080.columnar")
+
+Every array that can be loaded from the original file is written, along
+with any other arrays in memory that are not derived. Arrays that were
+not already in memory are loaded one at a time and released again after
+writing.
+
+"""
+
+from __future__ import with_statement  # for py2.5
+
+from .. import array
+from .. import family
+from .. import units
+from . import SimSnap
+
+import os
+import gzip
+import json
+import tempfile
+import numpy as np
+
+import logging
+logger = logging.getLogger('pynbody.snapshot.columnar')
+
+_header_filename = "columnar-header.json"
+_format_version = 1
+
+
+def _unit_to_string(u):
+    """Return a string which units.Unit parses back to *u* without the loss
+    of precision in the scale factor that str(u) would incur"""
+    if isinstance(u, units.CompositeUnit):
+        parts = []
+        if u._scale != 1 or len(u._bases) == 0:
+            parts.append(repr(float(u._scale)))
+        for b, p in zip(u._bases, u._powers):
+            if p != 1:
+                parts.append("%s**%s" % (b, p))
+            else:
+                parts.append(str(b))
+        return " ".join(parts)
+    return str(u)
+
+
+def _property_to_json(value):
+    if units.is_unit_like(value):
+        if isinstance(value, array.SimArray):
+            value = float(value) * value.units
+        return {"unit": _unit_to_string(value)}
+    elif isinstance(value, basestring):
+        return value
+    elif isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    elif isinstance(value, (int, long, np.integer)):
+        return int(value)
+    elif isinstance(value, (float, np.floating)):
+        return float(value)
+    else:
+        raise TypeError, "Unable to store property of type %s" % type(value)
+
+
+def _property_from_json(value):
+    if isinstance(value, dict):
+        return units.Unit(str(value["unit"]))
+    elif isinstance(value, unicode):
+        return str(value)
+    else:
+        return value
+
+
+class ColumnarSnap(SimSnap):
+
+    """Snapshot stored as a directory of one file per array. See the
+    module documentation for details."""
+
+    def __init__(self, filename, mmap=True):
+        """Open the columnar snapshot in the directory *filename*.
+
+        If *mmap* is True (the default), uncompressed arrays are
+        memory-mapped copy-on-write rather than read into memory."""
+
+        super(ColumnarSnap, self).__init__()
+
+        self._filename = filename
+        self._mmap = mmap
+
+        with open(os.path.join(filename, _header_filename)) as f:
+            header = json.load(f)
+
+        if header["format-version"] > _format_version:
+            raise IOError, "Columnar snapshot was written by a newer version of pynbody"
+
+        self._family_slice = {}
+        for name, start, stop in header["families"]:
+            self._family_slice[family.get_family(str(name))] = slice(start, stop)
+        self._num_particles = header["num-particles"]
+
+        self._file_units_system = [units.Unit(str(u)) for u in header["file-units-system"]]
+
+        for k, v in header["properties"].iteritems():
+            self.properties[str(k)] = _property_from_json(v)
+
+        self._columns = {}
+        for name, info in header["arrays"].iteritems():
+            self._columns[str(name)] = info
+
+        self._family_columns = {}
+        for fam_name, arrays in header["family-arrays"].iteritems():
+            fam = family.get_family(str(fam_name))
+            self._family_columns[fam] = dict([(str(name), info) for name, info in arrays.iteritems()])
+
+        self._decorate()
+
+    def loadable_keys(self, fam=None):
+        keys = set(self._columns.keys())
+        if fam is not None:
+            keys.update(self._family_columns.get(fam, {}).keys())
+        elif len(self.families()) > 0:
+            keys.update(reduce(set.intersection,
+                               [set(self._family_columns.get(f, {}).keys()) for f in self.families()]))
+        return list(keys)
+
+    def _read_column(self, info):
+        path = os.path.join(self._filename, info["file"])
+        if info["compressed"]:
+            with gzip.open(path, 'rb') as f:
+                data = np.lib.format.read_array(f)
+        elif self._mmap:
+            data = np.load(path, mmap_mode='c')
+        else:
+            data = np.load(path)
+
+        data = data.view(array.SimArray)
+        if info["units"] is not None:
+            data.units = units.Unit(str(info["units"]))
+        return data
+
+    def _load_array(self, array_name, fam=None):
+        if array_name in self._columns:
+            logger.info("Loading %s from %s", array_name, self._filename)
+            data = self._read_column(self._columns[array_name])
+            if fam is not None and array_name in self._family_arrays:
+                data = data[self._get_family_slice(fam)]
+            else:
+                # even when one family asks for it, install the whole column
+                # so that it remains a single view onto the file
+                fam = None
+        elif fam is not None and array_name in self._family_columns.get(fam, {}):
+            logger.info("Loading %s for %s from %s", array_name, fam, self._filename)
+            data = self._read_column(self._family_columns[fam][array_name])
+        else:
+            raise IOError, "No such array on disk"
+
+        self._install_mapped_array(array_name, fam, data)
+
+    @staticmethod
+    def _can_load(f):
+        return os.path.isdir(f) and os.path.exists(os.path.join(f, _header_filename))
+
+    @staticmethod
+    def _write(self, filename=None, compress=False):
+        """Write the snapshot in columnar format.
+
+        **Optional Keywords**
+
+        *filename* (None): name of the directory to be written. If None,
+                           the original file name is used; this is only
+                           permitted when the snapshot is already columnar.
+
+        *compress* (False): if True, gzip-compress each column. Compressed
+                            columns cannot be memory-mapped when they are
+                            re-opened.
+        """
+
+        if self.ancestor is not self:
+            raise RuntimeError, "Can only write a columnar file from the root snapshot"
+
+        if filename is None:
+            if not isinstance(self, ColumnarSnap):
+                raise IOError, "A filename must be given when converting a snapshot to columnar format"
+            filename = self._filename
+
+        if not os.path.exists(filename):
+            os.makedirs(filename)
+
+        logger.info("Writing columnar snapshot %s", filename)
+
+        def write_column(ar, column_filename):
+            # write to a temporary file first, so that a column being
+            # replaced can still be memory-mapped by the snapshot being written
+            fd, temp_path = tempfile.mkstemp(dir=filename, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                if compress:
+                    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                        np.lib.format.write_array(gz, np.asarray(ar))
+                else:
+                    np.lib.format.write_array(f, np.asarray(ar))
+            os.rename(temp_path, os.path.join(filename, column_filename))
+
+            if units.has_units(ar):
+                unit_string = _unit_to_string(ar.units)
+            else:
+                unit_string = None
+
+            return {"file": column_filename, "units": unit_string, "compressed": compress}
+
+        def names_to_write(target, in_memory, loadable):
+            names = set([n for n in in_memory if not target.is_derived_array(n)])
+            names.update(loadable)
+            # 1D views such as 'x' are written as part of their ND array
+            return sorted([n for n in names if self._array_name_1D_to_ND(n) not in names])
+
+        def release(target, name, family_level):
+            # remove an array, and any 1D views of it, that was only loaded for writing
+            keys = target.family_keys(fam) if family_level else target.keys()
+            for n in [name] + list(self._array_name_ND_to_1D(name)):
+                if n in keys:
+                    del target[n]
+
+        suffix = ".npy.gz" if compress else ".npy"
+
+        header_arrays = {}
+        snapshot_names = names_to_write(self, self.keys(), self.loadable_keys())
+        for name in snapshot_names:
+            with self.lazy_derive_off:
+                was_loaded = name in self.keys()
+                ar = self[name]
+                header_arrays[name] = write_column(ar, name + suffix)
+                if not was_loaded:
+                    release(self, name, False)
+
+        header_family_arrays = {}
+        for fam in self.families():
+            fam_arrays = {}
+            fam_names = names_to_write(self[fam], self.family_keys(fam), self[fam].loadable_keys())
+            for name in fam_names:
+                if name in snapshot_names:
+                    continue
+                with self.lazy_derive_off:
+                    was_loaded = name in self.family_keys(fam)
+                    ar = self[fam][name]
+                    fam_arrays[name] = write_column(ar, name + "." + fam.name + suffix)
+                    if not was_loaded:
+                        release(self[fam], name, True)
+            header_family_arrays[fam.name] = fam_arrays
+
+        properties = {}
+        for k, v in self.properties.iteritems():
+            try:
+                properties[k] = _property_to_json(v)
+            except TypeError:
+                logger.warn("Property %r cannot be stored in a columnar file and has been skipped", k)
+
+        header = {"format-version": _format_version,
+                  "num-particles": len(self),
+                  "families": sorted([[fam.name, s.start, s.stop] for fam, s in self._family_slice.iteritems()],
+                                     key=lambda x: x[1]),
+                  "file-units-system": [_unit_to_string(u) for u in getattr(self, '_file_units_system', [])],
+                  "properties": properties,
+                  "arrays": header_arrays,
+                  "family-arrays": header_family_arrays}
+
+        # remove columns left over from a previous write to the same directory
+        written = set([info["file"] for info in header_arrays.values()])
+        for fam_arrays in header_family_arrays.values():
+            written.update([info["file"] for info in fam_arrays.values()])
+        for existing in os.listdir(filename):
+            if (existing.endswith(".npy") or existing.endswith(".npy.gz")) and existing not in written:
+                os.remove(os.path.join(filename, existing))
+
+        fd, temp_path = tempfile.mkstemp(dir=filename, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(header, f, indent=1, sort_keys=True)
+        os.rename(temp_path, os.path.join(filename, _header_filename))
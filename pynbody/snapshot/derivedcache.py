@@ -0,0 +1,184 @@
+"""
+
+derivedcache
+============
+
+An optional on-disk cache for derived arrays, so that expensive
+quantities such as ``smooth`` and ``rho`` need only be calculated once
+for a given snapshot file.
+
+The cache is switched on in the ``[derived-array-cache]`` section of
+the configuration. An entry records the arrays the quantity was derived
+from, including those reached through other derived arrays and, for
+anything calculated with a KD-tree, the positions. It is only re-used
+while none of those arrays has been modified in the current session,
+for example by centering the snapshot or by converting its units.
+Derive the quantities you need before modifying the snapshot to get the
+full benefit.
+
+Entries are keyed by:
+
+* the file's name, size and modification time;
+* the loaded particle layout;
+* the array name and family;
+* the deriving function;
+* the snapshot's properties and unit system;
+* the ``[sph]`` configuration, and whether the snapshot has per-particle
+  neighbour numbers in an ``nsmooth`` array.
+
+The KD-trees built for smoothing are cached in the same way, so long as
+the positions have not been modified.
+
+The least recently used entries are removed once the cache grows
+beyond its maximum size.
+
+"""
+
+import os
+import glob
+import hashlib
+import tempfile
+import numpy as np
+
+from .. import array, config, units
+
+import logging
+logger = logging.getLogger('pynbody.snapshot.derivedcache')
+
+
+def _file_fingerprint(filename):
+    for candidate in filename, filename + ".0", filename + ".0.hdf5":
+        if os.path.exists(candidate):
+            stat = os.stat(candidate)
+            return os.path.abspath(filename), stat.st_size, stat.st_mtime
+    return None
+
+
+def cache_key(sim, name, fam, fn):
+    """Return the key under which the array *name* derived by *fn* for
+    family *fam* of *sim* is stored, or None if the snapshot is not
+    suitable for caching (e.g. it was created in memory or only
+    partially loaded)."""
+
+    from .. import __version__
+
+    if getattr(sim, 'partial_load', False) or not isinstance(sim.filename, basestring):
+        return None
+
+    fingerprint = _file_fingerprint(sim.filename)
+    if fingerprint is None:
+        return None
+
+    description = (__version__, type(sim).__name__, fingerprint,
+                   len(sim), sorted([(str(f), s.start, s.stop) for f, s in sim._family_slice.iteritems()]),
+                   name, str(fam), fn.__module__, fn.__name__,
+                   sorted([(k, str(v)) for k, v in sim.properties.iteritems()]),
+                   [str(u) for u in getattr(sim, '_file_units_system', [])],
+                   sorted(config['sph'].items()), 'nsmooth' in sim.keys())
+
+    return hashlib.sha1(repr(description)).hexdigest()
+
+
+class DerivedArrayCache(object):
+
+    """A directory of derived arrays with a maximum total size in bytes"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            data = np.load(path)
+        except IOError:
+            return None
+
+        try:
+            contents = dict([(k, data[k]) for k in data.files])
+        finally:
+            data.close()
+
+        # record the use, for the least-recently-used eviction
+        os.utime(path, None)
+        return contents
+
+    def _write(self, key, **arrays):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # write to a temporary file first, so that other sessions never see
+        # a partially written entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(temp_path, self._path(key))
+
+        self.evict()
+
+    def lookup(self, key):
+        """Return (array, input_names) for the given key, or None if there
+        is no such entry"""
+        contents = self._read(key)
+        if contents is None:
+            return None
+
+        result = contents['data'].view(array.SimArray)
+        if str(contents['units']) != "":
+            result.units = units.Unit(str(contents['units']))
+        inputs = [str(x) for x in contents['inputs']]
+        return result, inputs
+
+    def store(self, key, result, inputs):
+        """Store the array *result*, derived from the arrays named in
+        *inputs*, under the given key"""
+        if units.has_units(result):
+            unit_string = str(result.units)
+        else:
+            unit_string = ""
+
+        self._write(key, data=np.asarray(result), units=unit_string,
+                    inputs=np.array(sorted(inputs), dtype=str))
+
+    def lookup_arrays(self, key):
+        """Return the dictionary of arrays stored by :meth:`store_arrays` under
+        the given key, or None if there is no such entry"""
+        return self._read(key)
+
+    def store_arrays(self, key, arrays):
+        """Store a dictionary of plain numpy arrays, such as the state of a
+        KD-tree, under the given key"""
+        self._write(key, **arrays)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no
+        larger than its maximum size"""
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_cache():
+    """Return the configured cache, or None if caching is switched off"""
+    settings = config['derived-array-cache']
+    if not settings['enabled']:
+        return None
+    return DerivedArrayCache(settings['directory'], settings['max-size'])
@@ -16,6 +16,7 @@ from .. import config
 from .. import config_parser
 from .. import util
 from .. import backcompat
+from .. import chunk
 from . import SimSnap
 from . import namemapper
 
@@ -28,6 +29,7 @@ import os.path as path
 import warnings
 import errno
 import itertools
+import io
 
 # This is set here and not in a config file because too many things break
 # if it is not 6
@@ -490,6 +492,28 @@ class GadgetFile(object):
             data = data.byteswap(True)
         return (p_toread, data)
 
+    def read_block_into(self, name, p_type, out):
+        """Read all particles of type p_type from the named block directly
+        into out, which must be a contiguous 1D array of the block's data
+        type with room for exactly those particles. Returns the number of
+        particles read."""
+        name = _to_raw(name)
+
+        cur_block = self.blocks[name]
+        parts = self.get_block_parts(name, p_type)
+        p_start = self.get_start_part(name, p_type)
+        nbytes = int(cur_block.partlen * parts)
+        if out.nbytes != nbytes or out.dtype != np.dtype(cur_block.data_type):
+            raise ValueError("Output buffer does not match block " + name + " in " + self._filename)
+        with io.open(self._filename, 'rb') as fd:
+            fd.seek(cur_block.start + int(cur_block.partlen * p_start), 0)
+            if fd.readinto(out) != nbytes:
+                raise IOError("Read of " + self._filename + " asked for " + str(
+                    parts) + " particles but the file was too short")
+        if self.endian != '=':
+            out.byteswap(True)
+        return parts
+
     def get_block_parts(self, name, p_type):
         """Get the number of particles present in a block in this file"""
         if name not in self.blocks:
@@ -700,9 +724,13 @@ class WriteBlock:
 class GadgetSnap(SimSnap):
 
     """Main class for reading Gadget-2 snapshots. The constructor makes a map of the locations
-    of the blocks, which are then read by _load_array"""
+    of the blocks, which are then read by _load_array.
 
-    def __init__(self, filename, only_header=False, must_have_paramfile=False):
+    If *region* (a :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`) is
+    specified, only the files of a multi-file snapshot which may contain particles in
+    that region are read; see :mod:`pynbody.chunk.region`."""
+
+    def __init__(self, filename, only_header=False, must_have_paramfile=False, region=None):
 
         global config
         super(GadgetSnap, self).__init__()
@@ -742,6 +770,15 @@ class GadgetSnap(SimSnap):
                 continue
             self._files.append(tmp_file)
             npart = npart + tmp_file.header.npart
+
+        if region is not None:
+            overlapping = GadgetSnap(self._filename)._files_overlapping_region(region)
+            # always keep one file, so that the block layout is still known
+            # even when the region is empty
+            overlapping[0] |= not overlapping.any()
+            self._files = [f for f, keep in zip(self._files, overlapping) if keep]
+            npart = sum([f.header.npart for f in self._files[1:]], np.array(self._files[0].header.npart))
+
         # Set up things from the parent class
         self._num_particles = npart.sum()
         # Set up global header
@@ -797,6 +834,19 @@ class GadgetSnap(SimSnap):
 
         self._decorate()
 
+    def _files_overlapping_region(self, region):
+        """Return a boolean array which is True for each file that may contain
+        particles inside the specified region"""
+
+        g_name = _translate_array_name('pos')
+
+        def file_positions(i):
+            f = self._files[i]
+            return f.get_block(g_name, -1, f.get_block_parts(_to_raw(g_name), -1))[1]
+
+        index = chunk.region.get_index(self, len(self._files), file_positions)
+        return index.overlapping(region, self)
+
     def loadable_family_keys(self, fam=None):
         """Return list of arrays which are loadable for specific families,
         but not for all families."""
@@ -907,53 +957,43 @@ class GadgetSnap(SimSnap):
 
         ndim = self._get_array_dims(name)
 
-        if ndim == 1:
-            dims = [self.get_block_parts(g_name, fam), ]
-        else:
-            dims = [self.get_block_parts(g_name, fam), ndim]
-
         if fam is not None:
             p_types = gadget_type(fam)
         else:
             p_types = gadget_type(self.families())
 
-        # Get the data. Get one type at a time and then concatenate.
-        # A possible optimisation is to special-case loading all particles.
-        data = np.array([], dtype=self._get_array_type(name))
+        dtype = self._get_array_type(name)
+
+        if fam is None:
+            self._create_array(name, ndim, dtype=dtype, zeros=False)
+            target = self._get_array(name, always_writable=True)
+        else:
+            self[fam]._create_array(name, ndim, dtype=dtype, zeros=False)
+            target = self[fam]._get_array(name, always_writable=True)
+
+        # Work out where each file's contribution to each type lands in the
+        # target, then read them all concurrently. Every read goes straight
+        # into its own disjoint slice, so no concatenation is required.
+        data = target.view(np.ndarray).reshape(-1)
+        reads = []
+        ipos = 0
         for p in p_types:
             # Special-case mass
             if g_name == b"MASS" and self.header.mass[p] != 0.:
-                data = np.append(data, self.header.mass[
-                                 p] * np.ones(self.header.npart[p], dtype=data.dtype))
-            else:
-                data = np.append(data, self.__load_array(g_name, p))
+                data[ipos:ipos + self.header.npart[p]] = self.header.mass[p]
+                ipos += self.header.npart[p]
+                continue
+            for f in self._files:
+                iread = ndim * f.get_block_parts(g_name, p)
+                if iread > 0:
+                    reads.append((f, g_name, p, data[ipos:ipos + iread]))
+                ipos += iread
 
-        if fam is None:
-            self[name] = data.reshape(dims, order='C').view(array.SimArray)
-            self[name].set_default_units(quiet=True)
-        else:
-            self[fam][name] = data.reshape(
-                dims, order='C').view(array.SimArray)
-            self[fam][name].set_default_units(quiet=True)
-
-    def __load_array(self, g_name, p_type):
-       """Internal helper function for _load_array that takes a g_name and a gadget type,
-       gets the data from each file and returns it as one long array."""
-       data = np.array(np.zeros(self._get_array_dims(g_name) * self.header.npart[p_type]), dtype=self._get_array_type_g(g_name))
-       # Get a type from each file
-       ipos = 0
-       for f in self._files:
-           f_parts = f.get_block_parts(g_name, p_type)
-           if f_parts == 0:
-               continue
-           (f_read, f_data) = f.get_block(g_name, p_type, f_parts)
-           if f_read != f_parts:
-               raise IOError("Read of " + f._filename + " asked for " + str(
-                   f_parts) + " particles but got " + str(f_read))
-           iread = self._get_array_dims(g_name)*f.header.npart[p_type]
-           data[ipos:ipos + iread] = f_data
-           ipos += iread
-       return data
+        assert ipos == len(data)
+
+        util._thread_map_interleaved(GadgetFile.read_block_into, reads)
+
+        target.set_default_units(quiet=True)
 
     @staticmethod
     def _can_load(f):
@@ -26,7 +26,9 @@ from __future__ import with_statement  # for py2.5
 from .. import util, halo
 from .. import family
 from .. import units
+from .. import array
 from .. import config_parser
+from .. import chunk
 from . import SimSnap
 
 import ConfigParser
@@ -45,6 +47,29 @@ try:
 except ImportError:
     h5py = None
 
+multiprocess_num = int(config_parser.get('gadgethdf', "parallel-read"))
+multiprocess = (multiprocess_num > 1)
+hyperslab_size = int(config_parser.get('gadgethdf', "hyperslab-size"))
+
+issue_multiprocess_warning = False
+
+if multiprocess:
+    try:
+        import multiprocessing
+        import posix_ipc
+        remote_exec = array.shared_array_remote
+        remote_map = array.remote_map
+    except ImportError:
+        issue_multiprocess_warning = True
+        multiprocess = False
+
+if not multiprocess:
+    def remote_exec(fn):
+        return fn
+
+    def remote_map(*args, **kwargs):
+        return map(*args[1:], **kwargs)
+
 _default_type_map = {}
 for x in family.family_names():
     try:
@@ -66,6 +91,45 @@ def _append_if_array(to_list, name, obj):
         to_list.append(name)
 
 
+def _hyperslab_boundaries(dataset, rows_per_particle, particles=None):
+    """Split the rows of an HDF dataset into hyperslabs of roughly
+    hyperslab_size particles. Each hyperslab consists of whole HDF chunks
+    (so that no compressed chunk is decompressed by two readers) and of
+    whole particles. Returns a list of (start_row, stop_row) tuples.
+
+    If *particles* (a sorted array of particle offsets into the dataset) is
+    given, only the hyperslabs containing at least one of them are returned,
+    so that chunks holding none of the particles are never read."""
+
+    unit = rows_per_particle
+    if dataset.chunks is not None:
+        unit = util.lcm(dataset.chunks[0], rows_per_particle)
+    step = max(unit, ((hyperslab_size * rows_per_particle) // unit) * unit)
+    nrows = dataset.shape[0]
+    starts = np.arange(0, nrows, step)
+    if particles is not None:
+        starts = np.unique((particles * rows_per_particle) // step) * step
+    return [(start, min(start + step, nrows)) for start in starts]
+
+
+@remote_exec
+def _cpui_read_hyperslab(filename, dataset_name, start_row, stop_row, target, particles=None):
+    """Read rows start_row to stop_row of the named dataset directly into
+    target, which in a parallel read lives in shared memory. HDF5 only
+    touches the chunks that overlap the selected rows.
+
+    If *particles* (offsets from the start of the hyperslab) is given, only
+    those particles are copied into target."""
+    with h5py.File(filename, "r") as f:
+        dataset = f[dataset_name]
+        if particles is None:
+            target = target.view(np.ndarray).reshape((stop_row - start_row,) + dataset.shape[1:])
+            dataset.read_direct(target, source_sel=np.s_[start_row:stop_row])
+        else:
+            rows = dataset[start_row:stop_row]
+            target.view(np.ndarray)[:] = rows.reshape((-1,) + target.shape[1:])[particles]
+
+
 class DummyHDFData(object):
 
     """A stupid class to allow emulation of mass arrays for particles
@@ -99,23 +163,27 @@ class GadgetHdfMultiFileManager(object) :
             self._numfiles = h1[self._nfiles_groupname].attrs[self._nfiles_attrname]
             self._filenames = [filename+"."+str(i)+".hdf5" for i in range(self._numfiles)]
 
+        self._selected_files = range(self._numfiles)
         self._open_files = {}
 
-    def __iter__(self) :
-        for i in range(self._numfiles) :
-            if i not in self._open_files:
-                self._open_files[i] = h5py.File(self._filenames[i], "r")
-                if self._subgroup_name is not None:
-                    self._open_files[i] = self._open_files[i][self._subgroup_name]
+    def select_files(self, file_numbers):
+        """Restrict iteration to the specified files. Header and unit
+        information continue to be read from the first file."""
+        self._selected_files = list(file_numbers)
 
-            yield self._open_files[i]
+    def __len__(self):
+        return self._numfiles
+
+    def __iter__(self) :
+        for i in self._selected_files :
+            yield self[i]
 
     def __getitem__(self, i) : 
-        try : 
-            return self._open_files[i]
-        except KeyError : 
-            self._open_files[i] = next(itertools.islice(self,i,i+1))
-            return self._open_files[i]
+        if i not in self._open_files:
+            self._open_files[i] = h5py.File(self._filenames[i], "r")
+            if self._subgroup_name is not None:
+                self._open_files[i] = self._open_files[i][self._subgroup_name]
+        return self._open_files[i]
 
     def get_header_attrs(self):
         return self[0].parent['Header'].attrs
@@ -141,28 +209,76 @@ class SubfindHdfMultiFileManager(GadgetHdfMultiFileManager):
     
 class GadgetHDFSnap(SimSnap):
     """
-    Class that reads HDF Gadget data
+    Class that reads HDF Gadget data.
+
+    If *region* (a :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`) is
+    specified, only the files of a multi-file snapshot which may contain particles in
+    that region are read; see :mod:`pynbody.chunk.region`.
+
+    If *take* (an array of particle indices into the full snapshot) is
+    specified, only those particles are loaded. Only the chunk-aligned
+    hyperslabs of each dataset which contain some of them are read.
     """
 
     _multifile_manager_class = GadgetHdfMultiFileManager
     _readable_hdf5_test_key = "PartType?"
     _size_from_hdf5_key = "ParticleIDs"
 
-    def __init__(self, filename, ):
+    reader_pool = None
+
+    def __init__(self, filename, region=None, take=None):
         super(GadgetHDFSnap, self).__init__()
 
+        if region is not None and take is not None:
+            raise ValueError, "Cannot specify both take and region"
+
         self._filename = filename
+        self.partial_load = take is not None
+
+        self.__setup_parallel_reading()
 
         self._init_hdf_filemanager(filename)
 
+        if region is not None:
+            overlapping = type(self)(filename)._files_overlapping_region(region)
+            self._hdf_files.select_files(np.where(overlapping)[0])
+
         self._translate_array_name = namemapper.AdaptiveNameMapper('gadgethdf-name-mapping')
         self.__init_unit_information()
         self.__init_family_map()
         self.__init_file_map()
+        self.__init_take(take)
         self.__init_loadable_keys()
 
         self._decorate()
 
+    def __setup_parallel_reading(self):
+        if multiprocess:
+            self._shared_arrays = True
+            if (GadgetHDFSnap.reader_pool is None):
+                GadgetHDFSnap.reader_pool = multiprocessing.Pool(multiprocess_num)
+        elif issue_multiprocess_warning:
+            warnings.warn(
+                "GadgetHDFSnap is configured to use multiple processes, but the posix_ipc module is missing. Reverting to single process.",
+                RuntimeWarning)
+
+    def _files_overlapping_region(self, region):
+        """Return a boolean array which is True for each file that may contain
+        particles inside the specified region"""
+
+        coordinates = self._translate_array_name('pos')
+
+        def file_positions(i):
+            hdf = self._hdf_files[i]
+            pos = [hdf[g][coordinates][:] for g in _all_hdf_particle_groups
+                   if g in hdf and coordinates in hdf[g]]
+            if len(pos) == 0:
+                return np.empty((0, 3))
+            return np.concatenate(pos)
+
+        index = chunk.region.get_index(self, len(self._hdf_files), file_positions)
+        return index.overlapping(region, self)
+
     def _get_hdf_header_attrs(self):
         return self._hdf_files.get_header_attrs()
 
@@ -211,6 +327,25 @@ class GadgetHDFSnap(SimSnap):
 
         self._num_particles = family_slice_start
 
+    def __init_take(self, take):
+        """Restrict the family slices to the particles in *take*, recording
+        for each family the offsets of its particles to be loaded"""
+        self._family_take = None
+        if take is None:
+            return
+
+        take = np.unique(np.asarray(take, dtype=np.int64))
+        self._family_take = {}
+        family_slice_start = 0
+        for fam in self._families_ordered():
+            s = self._family_slice[fam]
+            fam_take = take[(take >= s.start) & (take < s.stop)] - s.start
+            self._family_take[fam] = fam_take
+            self._family_slice[fam] = slice(family_slice_start, family_slice_start + len(fam_take))
+            family_slice_start += len(fam_take)
+
+        self._num_particles = family_slice_start
+
     def _families_ordered(self):
         # order by the PartTypeN
         all_families = self._family_to_group_map.keys()
@@ -400,21 +535,71 @@ class GadgetHDFSnap(SimSnap):
             else:
                 target[array_name].set_default_units()
 
+            hyperslab_reads = []
+
             for loading_fam in all_fams_to_load:
                 i0 = 0
+                j0 = 0
                 for hdf in self._all_hdf_groups_in_family(loading_fam):
                     npart = hdf['ParticleIDs'].size
                     i1 = i0+npart
 
                     dataset = self._get_hdf_dataset(hdf, translated_name)
 
+                    if self._family_take is not None:
+                        fam_take = self._family_take[loading_fam]
+                        particles = fam_take[(fam_take >= i0) & (fam_take < i1)] - i0
+                        j1 = j0 + len(particles)
+                        if len(particles) > 0:
+                            self.__read_particles(dataset, npart, particles,
+                                                  self[loading_fam][array_name][j0:j1], hyperslab_reads)
+                        i0 = i1
+                        j0 = j1
+                        continue
+
                     target_array = self[loading_fam][array_name][i0:i1]
                     assert target_array.size == dataset.size
 
-                    dataset.read_direct(target_array.reshape(dataset.shape))
+                    if multiprocess and isinstance(dataset, h5py.Dataset) and npart > 0:
+                        # defer to the reader pool, which writes each hyperslab
+                        # straight into its own part of the shared target
+                        rows_per_particle = dataset.shape[0] // npart
+                        for start_row, stop_row in _hyperslab_boundaries(dataset, rows_per_particle):
+                            hyperslab_reads.append((dataset.file.filename, dataset.name, start_row, stop_row,
+                                                    target_array[start_row // rows_per_particle:
+                                                                 stop_row // rows_per_particle], None))
+                    else:
+                        dataset.read_direct(target_array.reshape(dataset.shape))
 
                     i0 = i1
 
+            if len(hyperslab_reads) > 0:
+                remote_map(self.reader_pool, _cpui_read_hyperslab, *zip(*hyperslab_reads))
+
+    def __read_particles(self, dataset, npart, particles, target_array, hyperslab_reads):
+        """Read the specified *particles* (sorted offsets into a dataset of
+        *npart* particles) into *target_array*, reading only the hyperslabs
+        which contain them. In a parallel read, the hyperslab reads are
+        appended to *hyperslab_reads* instead."""
+
+        if not isinstance(dataset, h5py.Dataset):
+            dataset.read_direct(target_array)
+            return
+
+        rows_per_particle = dataset.shape[0] // npart
+        j0 = 0
+        for start_row, stop_row in _hyperslab_boundaries(dataset, rows_per_particle, particles):
+            start, stop = start_row // rows_per_particle, stop_row // rows_per_particle
+            n_in_slab = np.searchsorted(particles, stop) - np.searchsorted(particles, start)
+            j1 = j0 + n_in_slab
+            args = (dataset.file.filename, dataset.name, start_row, stop_row,
+                    target_array[j0:j1], particles[j0:j1] - start)
+            if multiprocess:
+                hyperslab_reads.append(args)
+            else:
+                _cpui_read_hyperslab(*args)
+            j0 = j1
+
     def __get_dtype_dims_and_units(self, fam, translated_name):
         if fam is None:
             fam = self.families()[0]
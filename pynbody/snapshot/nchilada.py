@@ -85,8 +85,12 @@ class NchiladaSnap(SimSnap):
         self._family_slice = self._load_control.mem_family_slice
         self._num_particles = self._load_control.mem_num_particles
 
-    def __init__(self, filename, take=None, paramfile=None):
+    def __init__(self, filename, take=None, paramfile=None, region=None):
         super(NchiladaSnap, self).__init__()
+        if region is not None:
+            if take is not None:
+                raise ValueError, "Cannot specify both take and region"
+            take = chunk.region.take_for_region(NchiladaSnap(filename, paramfile=paramfile), region)
         self._dom_sim = xml.dom.minidom.parse(
             os.path.join(filename, "description.xml")).getElementsByTagName('simulation')[0]
         self._filename = filename
@@ -163,7 +167,11 @@ class NchiladaSnap(SimSnap):
         # skip over min and max values (see issue #211)
         np.fromfile(f, dtype=disk_dtype, count=2 * ndim)
 
-        for readlen, buf_index, mem_index in self._load_control.iterate(fam, fam):
+        for readlen, buf_index, mem_index in self._load_control.iterate(fam, fam, multiskip=True):
+            if mem_index is None:
+                f.seek(readlen * ndim * disk_dtype.itemsize, 1)
+                continue
+
             b = np.fromfile(f, dtype=disk_dtype, count=readlen * ndim)
             if ndim > 1:
                 b = b.reshape((readlen, ndim))
@@ -22,8 +22,9 @@ from .. import family
 from .. import units
 from .. import config, config_parser
 from .. import analysis
+from .. import chunk
 from . import SimSnap
-from ..util import read_fortran, read_fortran_series, skip_fortran
+from ..util import read_fortran, read_fortran_records, read_fortran_series, skip_fortran
 from . import namemapper
 
 import os
@@ -41,6 +42,7 @@ multiprocess_num = int(config_parser.get('ramses', "parallel-read"))
 multiprocess = (multiprocess_num > 1)
 
 issue_multiprocess_warning = False
+multithread = False
 
 if multiprocess:
     try:
@@ -51,6 +53,9 @@ if multiprocess:
     except ImportError:
         issue_multiprocess_warning = True
         multiprocess = False
+        # without shared memory, fall back to threads, which share the
+        # target arrays anyway
+        multithread = True
 
 if not multiprocess:
     def remote_exec(fn):
@@ -60,6 +65,11 @@ if not multiprocess:
             return r
         return q
 
+if multithread:
+    def remote_map(pool, fn, *iterables):
+        return util._thread_map_interleaved(fn, zip(*iterables), multiprocess_num)
+
+elif not multiprocess:
     def remote_map(*args, **kwargs):
         return map(*args[1:], **kwargs)
 
@@ -79,6 +89,66 @@ def _cpu_id(i):
     return str(i).rjust(5, "0")
 
 
+# The state diagram of the Hilbert ordering used for the RAMSES domain
+# decomposition (hilbert3d in amr/hilbert.f90). For each state, the first row
+# gives the next state and the second the Hilbert digit, both indexed by the
+# octant 4*x+2*y+z.
+_hilbert_state_diagram = np.array([
+    [[1, 2, 3, 2, 4, 5, 3, 5], [0, 1, 3, 2, 7, 6, 4, 5]],
+    [[2, 6, 0, 7, 8, 8, 0, 7], [0, 7, 1, 6, 3, 4, 2, 5]],
+    [[0, 9, 10, 9, 1, 1, 11, 11], [0, 3, 7, 4, 1, 2, 6, 5]],
+    [[6, 0, 6, 11, 9, 0, 9, 8], [2, 3, 1, 0, 5, 4, 6, 7]],
+    [[11, 11, 0, 7, 5, 9, 0, 7], [4, 3, 5, 2, 7, 0, 6, 1]],
+    [[4, 4, 8, 8, 0, 6, 10, 6], [6, 5, 1, 2, 7, 4, 0, 3]],
+    [[5, 7, 5, 3, 1, 1, 11, 11], [4, 7, 3, 0, 5, 6, 2, 1]],
+    [[6, 1, 6, 10, 9, 4, 9, 10], [6, 7, 5, 4, 1, 0, 2, 3]],
+    [[10, 3, 1, 1, 10, 3, 5, 9], [2, 5, 3, 4, 1, 6, 0, 7]],
+    [[4, 4, 8, 8, 2, 7, 2, 3], [2, 1, 5, 6, 3, 0, 4, 7]],
+    [[7, 2, 11, 2, 7, 5, 8, 5], [4, 5, 7, 6, 3, 2, 0, 1]],
+    [[10, 3, 2, 6, 10, 3, 4, 4], [6, 1, 7, 0, 5, 2, 4, 3]]])
+
+
+def _hilbert_key(i, j, k, bit_length):
+    """Return the RAMSES Hilbert key of integer cell (i, j, k) on a grid of
+    2**bit_length cells per dimension"""
+    state = 0
+    key = 0
+    for level in xrange(bit_length - 1, -1, -1):
+        octant = ((i >> level) & 1) * 4 + ((j >> level) & 1) * 2 + ((k >> level) & 1)
+        key = key * 8 + _hilbert_state_diagram[state, 1, octant]
+        state = _hilbert_state_diagram[state, 0, octant]
+    return key
+
+
+def _cpus_overlapping_box(lo, hi, bound_keys, levelmax):
+    """Return the CPUs whose Hilbert domains may contain cells inside the box
+    (lo, hi), given in units of the box length. *bound_keys* holds the
+    ncpu+1 domain boundaries listed in the RAMSES info file.
+
+    This follows the approach of get_cpu_list in the RAMSES utilities: the
+    box is covered by (at most) eight cells of the coarsest level whose cell
+    size exceeds the box, and CPUs are selected by the key ranges of those
+    cells."""
+    extent = max((hi - lo).max(), 0.5 ** levelmax)
+    bit_length = 0
+    while 0.5 ** (bit_length + 1) >= extent:
+        bit_length += 1
+
+    ncells = 2 ** bit_length
+    dkey = (2.0 ** (levelmax + 1) / ncells) ** 3
+    corner = np.minimum(np.floor(lo * ncells).astype(int), ncells - 1)
+
+    cpus = set()
+    for di in (0, 1):
+        for dj in (0, 1):
+            for dk in (0, 1):
+                key = _hilbert_key(corner[0] + di, corner[1] + dj, corner[2] + dk, bit_length)
+                key_min, key_max = key * dkey, (key + 1) * dkey
+                overlapping = (bound_keys[:-1] < key_max) & (bound_keys[1:] > key_min)
+                cpus.update(np.where(overlapping)[0] + 1)
+    return cpus
+
+
 @remote_exec
 def _cpui_count_particles_with_implicit_families(filename, distinguisher_field, distinguisher_type):
 
@@ -299,14 +369,14 @@ def _cpui_load_gas_vars(dims, maxlevel, ndim, filename, cpu, lia, i1,
                     assert gi_cpu == cpu
 
                 if cpuf == cpu and len(mark[0]) > 0:
+                    # all variables for all cells of this level, in one read
+                    data = read_fortran_records(f, _float_type, ncache, (2 ** ndim) * nvar_file)
+                    data = data.reshape((2 ** ndim, nvar_file, ncache))
                     for icel in xrange(2 ** ndim):
                         i0 = i1
                         i1 = i0 + (refine[icel] == 0).sum()
-                        for ar in dims:
-                            ar[i0:i1] = read_fortran(
-                                f, _float_type, ncache)[(refine[icel] == 0)]
-
-                        skip_fortran(f, (nvar_file - nvar))
+                        for ar, data_var in zip(dims, data[icel]):
+                            ar[i0:i1] = data_var[(refine[icel] == 0)]
 
                 else:
                     skip_fortran(f, (2 ** ndim) * nvar_file)
@@ -371,6 +441,8 @@ class RamsesSnap(SimSnap):
          *maxlevel* : the maximum refinement level to load. If not set, the deepest level is loaded.
          *with_gas* : if False, never load any gas cells (particles only) - default is True
          *force_gas* : if True, load the AMR cells as "gas particles" even if they don't actually contain gas in the run
+         *region* : a :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`. Only the CPUs whose
+                    Hilbert domains may overlap the region are loaded. Cannot be combined with *cpus*.
          """
 
         global config
@@ -392,7 +464,11 @@ class RamsesSnap(SimSnap):
         self._ndim = self._info['ndim']
         self.ncpu = self._info['ncpu']
         if 'cpus' in kwargs:
+            if kwargs.get('region', None) is not None:
+                raise ValueError, "Cannot specify both cpus and region"
             self._cpus = kwargs['cpus']
+        elif kwargs.get('region', None) is not None:
+            self._cpus = self._cpus_in_region(kwargs['region'])
         else:
             self._cpus = range(1, self.ncpu + 1)
         self._maxlevel = kwargs.get('maxlevel', None)
@@ -427,7 +503,7 @@ class RamsesSnap(SimSnap):
                 RamsesSnap.reader_pool = multiprocessing.Pool(multiprocess_num)
         elif issue_multiprocess_warning:
             warnings.warn(
-                "RamsesSnap is configured to use multiple processes, but the posix_ipc module is missing. Reverting to single thread.",
+                "RamsesSnap is configured to use multiple processes, but the posix_ipc module is missing. Using %d threads instead." % multiprocess_num,
                 RuntimeWarning)
 
     def _load_rt_infofile(self):
@@ -449,6 +525,30 @@ class RamsesSnap(SimSnap):
         for block in self._rt_blocks:
             self._rt_blocks_3d.add(self._array_name_1D_to_ND(block) or block)
 
+    def _cpus_in_region(self, region):
+        """Return the list of CPUs whose domains may contain particles or
+        cells inside the specified region"""
+
+        if self._info.get('ordering type', None) != 'hilbert' or self._ndim != 3 \
+                or len(self._hilbert_bound_keys) != self.ncpu + 1:
+            warnings.warn(
+                "Region loading requires a three-dimensional RAMSES output with Hilbert domain decomposition; loading all CPUs",
+                RuntimeWarning)
+            return range(1, self.ncpu + 1)
+
+        # the units and box size are needed to interpret the region
+        self._decorate()
+
+        boxlen = self._info['boxlen']
+        cpus = set()
+        for lo, hi in chunk.region.bounding_boxes(region, self):
+            lo = np.clip(lo / boxlen, 0.0, 1.0)
+            hi = np.clip(hi / boxlen, 0.0, 1.0)
+            if (hi > lo).all():
+                cpus.update(_cpus_overlapping_box(lo, hi, self._hilbert_bound_keys, self._info['levelmax']))
+
+        return sorted(cpus)
+
     def _load_info_from_specified_file(self, f):
         for l in f:
             if '=' in l:
@@ -467,6 +567,18 @@ class RamsesSnap(SimSnap):
             self._filename + "/info_" + _timestep_id(self._filename) + ".txt", "r")
 
         self._load_info_from_specified_file(f)
+
+        # the domain decomposition table follows the key=value lines
+        f.seek(0)
+        self._hilbert_bound_keys = []
+        for l in f:
+            columns = l.split()
+            if len(columns) == 3 and columns[0].isdigit():
+                if len(self._hilbert_bound_keys) == 0:
+                    self._hilbert_bound_keys.append(float(columns[1]))
+                self._hilbert_bound_keys.append(float(columns[2]))
+        self._hilbert_bound_keys = np.array(self._hilbert_bound_keys)
+
         try:
             f = open(
                 self._filename + "/header_" + _timestep_id(self._filename) + ".txt", "r")
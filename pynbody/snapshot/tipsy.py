@@ -15,6 +15,16 @@ automatically via pynbody.load.
 specified, the loader will look for a file `*.param` in the current and
 parent directories.
 
+*mmap*: if True, the main file and any binary auxiliary arrays are
+memory-mapped rather than read into memory, so that only the parts of
+the file actually used are ever read from disk. The mapping is
+copy-on-write, so modifying an array never alters the file. Requires
+an uncompressed file and is incompatible with *take* and *region*.
+
+*region*: a :class:`~pynbody.filt.Sphere` or :class:`~pynbody.filt.Cuboid`.
+Only the parts of the file which may contain particles in the region are
+loaded; see :mod:`pynbody.chunk.region`.
+
 """
 
 from __future__ import with_statement  # for py2.5
@@ -37,6 +47,7 @@ import warnings
 import copy
 import types
 import math
+import weakref
 
 import logging
 logger = logging.getLogger('pynbody.snapshot.tipsy')
@@ -50,6 +61,10 @@ class TipsySnap(SimSnap):
                                               'eps', 'mass', 'vel']),
                             None: set(['phi', 'pos', 'eps', 'mass', 'vel'])}
 
+    _starlog_arrays = ['massform', 'rhoform', 'tempform', 'phiform', 'nsmooth',
+                       'xform', 'yform', 'zform', 'vxform', 'vyform', 'vzform',
+                       'posform', 'velform', 'h2form']
+
     def __init__(self, filename, **kwargs):
 
         global config
@@ -65,10 +80,24 @@ class TipsySnap(SimSnap):
         take = kwargs.get('take', None)
         verbose = kwargs.get('verbose', config['verbose'])
 
+        region = kwargs.get('region', None)
+        if region is not None:
+            if take is not None:
+                raise ValueError, "Cannot specify both take and region"
+            take = chunk.region.take_for_region(
+                TipsySnap(filename, paramfile=kwargs.get('paramfile', None)), region)
+
         self.partial_load = take is not None
 
         self._filename = util.cutgz(filename)
 
+        self._mmap = kwargs.get('mmap', False)
+        if self._mmap and (self.partial_load or not os.path.exists(filename)
+                           or filename[-3:] == '.gz'):
+            warnings.warn(
+                "Memory-mapped loading requires a full load of an uncompressed file; reverting to normal loading", RuntimeWarning)
+            self._mmap = False
+
         f = util.open_(filename, 'rb')
 
         if not only_header:
@@ -220,6 +249,119 @@ class TipsySnap(SimSnap):
                         if name in write:
                             self_fam[name][mem_index] = buf[name][buf_index]
 
+    def _main_file_mmap(self, fam):
+        """Return a copy-on-write memory map of the main file records for
+        the specified family. The on-disk byte order is expressed in the
+        dtype rather than by swapping the data."""
+
+        offset = 32
+        for fam_x, dtype in ((family.gas, self._g_dtype), (family.dm, self._d_dtype), (family.star, self._s_dtype)):
+            if self._byteswap:
+                dtype = dtype.newbyteorder('S')
+            sl = self._get_family_slice(fam_x)
+            if fam_x is fam:
+                return np.memmap(self._filename, dtype=dtype, mode='c', offset=offset,
+                                 shape=(sl.stop - sl.start,))
+            offset += dtype.itemsize * (sl.stop - sl.start)
+
+    def _main_file_view(self, array_name, fam):
+        """Return a view of the named main file array for the specified family,
+        pointing directly into the memory map. Vector arrays (pos, vel) become
+        strided Nx3 views over their x,y,z record fields."""
+
+        mm = self._main_file_mmap(fam)
+        if array_name in self._split_arrays:
+            dtype, offset = mm.dtype.fields[self._split_arrays[array_name][0]][:2]
+            ar = np.ndarray((len(mm), 3), dtype=dtype, buffer=mm, offset=offset,
+                            strides=(mm.dtype.itemsize, dtype.itemsize))
+        else:
+            ar = mm[array_name]
+        return ar.view(array.SimArray)
+
+    def _map_main_file_array(self, array_name, fam=None):
+        """Memory-map the named main file array for one family, or for the whole
+        snapshot if fam is None, instead of reading the entire file."""
+
+        logger.info("Memory-mapping %s from main file %s", array_name, self._filename)
+
+        def set_units(ar):
+            ar._sim = weakref.ref(self)
+            ar._name = array_name
+            if array_name == "temp":
+                ar.units = "K"
+            else:
+                ar.set_default_units(quiet=True)
+
+            # only do this for cosmo runs
+            if array_name == "phi" and self.properties.has_key('h'):
+                ar.units = ar.units * units.a ** -3
+
+        if fam is None and len(self.families()) > 1:
+            # A snapshot-level array spans several record layouts so has to be
+            # gathered; this is a single cast-and-copy with no separate byteswap
+            views = [(f, self._main_file_view(array_name, f)) for f in self.families()]
+            v0 = views[0][1]
+            self._create_array(array_name, ndim=v0.shape[1] if len(v0.shape) > 1 else 1,
+                               dtype=v0.dtype.newbyteorder('='), zeros=False)
+            for f, v in views:
+                self._arrays[array_name][self._get_family_slice(f)] = v
+            set_units(self._arrays[array_name])
+        else:
+            for f in [fam] if fam is not None else self.families():
+                ar = self._main_file_view(array_name, f)
+                set_units(ar)
+                self._install_mapped_array(array_name, f, ar)
+
+    def _map_binary_aux_array(self, array_name, fam=None, filename=None):
+        """Return a copy-on-write memory-mapped view of a binary auxiliary array,
+        or None if the file cannot be mapped (missing, compressed or ASCII)."""
+
+        if filename is None:
+            filename = self._filename + "." + array_name
+
+        if not os.path.exists(filename):
+            return None
+
+        disk_num_particles = self._load_control.disk_num_particles
+
+        with open(filename, 'rb') as f:
+            header = f.read(4)
+        if len(header) != 4 or os.path.getsize(filename) != 4 + 4 * disk_num_particles:
+            return None
+        if self._byteswap:
+            l = struct.unpack(">I", header)[0]
+        else:
+            l = struct.unpack("I", header)[0]
+        if l != disk_num_particles & 0xffffffffL:
+            return None
+
+        aux_units, _, dtype = self._get_loadable_array_metadata(array_name)
+        if dtype is None:
+            dtype = self._get_preferred_dtype(array_name)
+        if dtype is None:
+            int_arrays = map(
+                str.strip, config_parser.get('tipsy', 'binary-int-arrays').split(","))
+            dtype = 'i' if array_name in int_arrays else 'f'
+        dtype = np.dtype(dtype)
+        if dtype.itemsize != 4:
+            return None
+        if self._byteswap:
+            dtype = dtype.newbyteorder('S')
+
+        logger.info("Memory-mapping auxiliary array %s", filename)
+
+        self.ancestor._tipsy_arrays_binary = True
+
+        r = np.memmap(filename, dtype=dtype, mode='c', offset=4,
+                      shape=(disk_num_particles,)).view(array.SimArray)
+        if fam is not None:
+            r = r[self._get_family_slice(fam)]
+
+        if aux_units is not None:
+            r.units = aux_units
+
+        return r
+
     def _update_loadable_keys(self):
         def is_readable_array(x):
             try:
@@ -529,7 +671,8 @@ class TipsySnap(SimSnap):
                 if not self.is_derived_array(x) and x not in ["mass", "pos", "x", "y", "z", "vel", "vx", "vy", "vz", "rho", "temp",
                                                               "eps", "metals", "phi", "tform"]:
                     TipsySnap._write_array(
-                        self, x, filename=filename + "." + x, binary=binary_aux_arrays)
+                        self, x, filename=filename + "." + x, binary=binary_aux_arrays,
+                        byteswap=byteswap)
 
 
     @staticmethod
@@ -751,7 +894,10 @@ class TipsySnap(SimSnap):
                     packed_vector=None):
 
         if array_name in self._basic_loadable_keys[fam]:
-            self._load_main_file()
+            if self._mmap:
+                self._map_main_file_array(array_name, fam)
+            else:
+                self._load_main_file()
             return
 
         fams = self._get_loadable_array_metadata(
@@ -765,6 +911,12 @@ class TipsySnap(SimSnap):
 
             raise IOError, "This array is marked as available only for families %s" % fams
 
+        if self._mmap and array_name not in self._starlog_arrays:
+            data = self._map_binary_aux_array(array_name, fam=fam, filename=filename)
+            if data is not None:
+                self._install_mapped_array(array_name, fam, data)
+                return
+
         data = self.__read_array_from_disk(array_name, fam=fam,
                                            filename=filename,
                                            packed_vector=packed_vector)
@@ -780,9 +932,7 @@ class TipsySnap(SimSnap):
         specified name. If fam is not None, read only the particles of
         the specified family."""
 
-        if filename is None and array_name in ['massform', 'rhoform', 'tempform', 'phiform', 'nsmooth',
-                                               'xform', 'yform', 'zform', 'vxform', 'vyform', 'vzform',
-                                               'posform', 'velform','h2form']:
+        if filename is None and array_name in self._starlog_arrays:
 
             try:
                 self.read_starlog()
@@ -33,6 +33,8 @@ except ImportError:
     raise ImportError, "Pynbody cannot import the kdtree subpackage. This can be caused when you try to import pynbody directly from the installation folder. Try changing to another folder before launching python"
 import os
 
+from . import outofcore
+from . import distributed
 
 
 
@@ -84,19 +86,63 @@ def _auto_denoise(sim, kernel):
     else:
         return False
 
+def _tree_cache_key(sim):
+    """Return the key under which the tree for sim is kept in the derived
+    array cache, or None if the tree should not be cached"""
+    from ..snapshot import derivedcache
+    if derivedcache.get_cache() is None or sim.ancestor._dependency_tracker.has_been_modified('pos'):
+        return None
+    name = 'kdtree-' + sim._inclusion_hash.encode('hex')
+    if _float32_tree():
+        name += '-float32'
+    return derivedcache.cache_key(sim.ancestor, name, None, build_tree)
+
+
+def _float32_tree():
+    return config_parser.getboolean('sph', 'float32-tree')
+
+
+def _boxsize(sim):
+    """Return the periodic box size of sim in its position units, or None"""
+    boxsize = sim.properties.get('boxsize',None)
+    if boxsize:
+        return float(boxsize.in_units(sim['pos'].units))
+    return None
+
+
 def build_tree(sim):
+    # anything derived through the tree depends on pos via its neighbour
+    # sets, even when an existing tree is re-used
+    sim._dependency_tracker.touching('pos')
     if hasattr(sim, 'kdtree') is False:
+        from ..snapshot import derivedcache
+
         # n.b. getting the following arrays through the full framework is
         # not possible because it can cause a deadlock if the build_tree
         # has been triggered by getting an array in the calling thread.
-        boxsize = sim.properties.get('boxsize',None)
-        if boxsize:
-            boxsize = float(boxsize.in_units(sim['pos'].units))
-        else:
-            boxsize = -1.0 # represents infinite box
-        sim.kdtree = kdtree.KDTree(sim['pos'], sim['mass'],
+        boxsize = _boxsize(sim) or -1.0 # -1 represents infinite box
+
+        pos = util.native_byteorder(sim['pos'])
+        mass = util.native_byteorder(sim['mass'])
+
+        key = _tree_cache_key(sim)
+        if key is not None:
+            state = derivedcache.get_cache().lookup_arrays(key)
+            if state is not None:
+                try:
+                    sim.kdtree = kdtree.KDTree.from_state(pos, mass, state, boxsize=boxsize)
+                except ValueError:
+                    logger.warn("Ignoring invalid KDTree in derived array cache")
+                else:
+                    logger.info("Retrieved KDTree from derived array cache")
+                    return
+
+        sim.kdtree = kdtree.KDTree(pos, mass,
                         leafsize=config['sph']['tree-leafsize'],
-                        boxsize=boxsize)
+                        boxsize=boxsize, float32=_float32_tree())
+
+        if key is not None:
+            derivedcache.get_cache().store_arrays(key, sim.kdtree.get_state())
 
 
 def _tree_decomposition(obj):
@@ -109,32 +155,69 @@ def _get_tree_objects(sim):
 
 def build_tree_or_trees(sim):
 
+    sim._dependency_tracker.touching('pos')
     if hasattr(sim, 'kdtree'):
         return
 
     logger.info('Building tree with leafsize=%d' % config['sph']['tree-leafsize'])
 
-    start = time.clock()
+    # wall-clock time, since the build may be shared between threads
+    start = time.time()
     build_tree(sim)
-    end = time.clock()
+    end = time.time()
 
     logger.info('Tree build done in %5.3g s' % (end - start))
 
 
+def _smoothing_neighbours(sim):
+    """Return the number of neighbours over which to smooth each particle:
+    the snapshot's ``nsmooth`` array if it has one, otherwise the number
+    given in the configuration"""
+    if 'nsmooth' in sim.keys():
+        return sim['nsmooth']
+    return config['sph']['smooth-particles']
+
+
+def _describe_neighbours(nsmooth):
+    if np.isscalar(nsmooth):
+        return '%d nearest neighbours' % nsmooth
+    return '%d to %d nearest neighbours' % (nsmooth.min(), nsmooth.max())
+
+
+def _smoothing_processes(nsmooth):
+    """Return the number of processes over which to share out the smoothing,
+    or 1 to smooth with threads in this process"""
+    processes = config['sph'].get('smooth-processes', 1)
+    if processes <= 1 or not np.isscalar(nsmooth):
+        return 1
+    if not distributed.available:
+        logger.warning("Smoothing in one process, since the posix_ipc module is not available")
+        return 1
+    return processes
+
+
 @snapshot.SimSnap.stable_derived_quantity
 def smooth(self):
+    nsmooth = _smoothing_neighbours(self)
+    processes = _smoothing_processes(nsmooth)
+
+    if processes > 1:
+        sm = distributed.smooth_in_processes(self['pos'], self['mass'], nsmooth, _boxsize(self),
+                                             rho=False, processes=processes)
+        sm.units = self['pos'].units
+        return sm
+
     build_tree_or_trees(self)
 
-    logger.info('Smoothing with %d nearest neighbours' %
-                config['sph']['smooth-particles'])
+    logger.info('Smoothing with %s' % _describe_neighbours(nsmooth))
 
     sm = array.SimArray(np.empty(len(self['pos'])), self['pos'].units,
-                       dtype=self['pos'].dtype)
+                       dtype=self['pos'].dtype.newbyteorder('='))
 
 
     start = time.time()
     self.kdtree.set_array_ref('smooth',sm)
-    self.kdtree.populate('hsm', config['sph']['smooth-particles'])
+    self.kdtree.populate('hsm', nsmooth)
     end = time.time()
 
     logger.info('Smoothing done in %5.3gs' % (end - start))
@@ -150,15 +233,15 @@ def rho(self):
     logger.info('Calculating SPH density')
     rho = array.SimArray(
         np.empty(len(self['pos'])), self['mass'].units / self['pos'].units ** 3,
-        dtype=self['pos'].dtype)
+        dtype=self['pos'].dtype.newbyteorder('='))
 
     start = time.time()
 
-    self.kdtree.set_array_ref('smooth',self['smooth'])
-    self.kdtree.set_array_ref('mass',self['mass'])
+    self.kdtree.set_array_ref('smooth',util.native_byteorder(self['smooth']))
+    self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
     self.kdtree.set_array_ref('rho',rho)
 
-    self.kdtree.populate('rho', config['sph']['smooth-particles'])
+    self.kdtree.populate('rho', _smoothing_neighbours(self))
 
     end = time.time()
     logger.info('Density calculation done in %5.3g s' % (end - start))
@@ -166,6 +249,40 @@ def rho(self):
     return rho
 
 
+def _smooth_and_rho(self):
+    """Return the smoothing lengths and densities of the particles,
+    calculated together from a single neighbour search"""
+    nsmooth = _smoothing_neighbours(self)
+    processes = _smoothing_processes(nsmooth)
+
+    if processes > 1:
+        sm, rho = distributed.smooth_in_processes(self['pos'], self['mass'], nsmooth, _boxsize(self),
+                                                  processes=processes)
+        sm.units = self['pos'].units
+        rho.units = self['mass'].units / self['pos'].units ** 3
+        return sm, rho
+
+    build_tree_or_trees(self)
+
+    logger.info('Smoothing and calculating SPH density with %s' % _describe_neighbours(nsmooth))
+
+    dtype = self['pos'].dtype.newbyteorder('=')
+    sm = array.SimArray(np.empty(len(self['pos'])), self['pos'].units, dtype=dtype)
+    rho = array.SimArray(np.empty(len(self['pos'])), self['mass'].units / self['pos'].units ** 3,
+                         dtype=dtype)
+
+    start = time.time()
+    self.kdtree.set_array_ref('smooth',sm)
+    self.kdtree.set_array_ref('mass',util.native_byteorder(self['mass']))
+    self.kdtree.set_array_ref('rho',rho)
+    self.kdtree.populate('hsm_rho', nsmooth)
+    end = time.time()
+
+    logger.info('Smoothing and density calculation done in %5.3g s' % (end - start))
+
+    return sm, rho
+
+
 class Kernel(object):
 
     def __init__(self):
@@ -445,7 +562,10 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
 
     **Keyword arguments:**
 
-    *qty* ('rho'): The name of the array within the simulation to render
+    *qty* ('rho'): The name of the array within the simulation to render,
+     or a list of names. A list of images is then returned, rendered in a
+     single pass over the particles which is faster than rendering each
+     separately; *out_units* may then also be a list.
 
     *x2* (100.0): The x-coordinate of the right edge of the image
 
@@ -494,7 +614,8 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
 
      *threaded*: if False (or None), render on a single core. Otherwise,
       the number of threads to use (defaults to a value specified in your
-      configuration files).
+      configuration files). Each thread renders separate tiles of the
+      image, so the result does not depend on the number of threads.
     """
 
     if denoise is None:
@@ -513,37 +634,145 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
     if threaded is None:
         threaded = _get_threaded_image()
 
-    if threaded:
-        im = _threaded_render_image(base_renderer, snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
-                                    out_units, xy_units, kernel, z_camera, smooth,
-                                    smooth_in_pixels, True,
-                                    num_threads=threaded)
+    if z_camera is None and not smooth_in_pixels:
+        # only visit the particles whose kernels may overlap the image
+        visible = _visible_particles(snap, x2, nx, y2, ny, x1, y1, xy_units, kernel, smooth)
     else:
-        im = base_renderer(snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
-                           out_units, xy_units, kernel, z_camera, smooth,
-                           smooth_in_pixels, False)
+        visible = None
+
+    multiple = isinstance(qty, (list, tuple))
+    if multiple:
+        qty_list = list(qty)
+        if isinstance(out_units, (list, tuple)):
+            out_units_list = list(out_units)
+        else:
+            out_units_list = [out_units] * len(qty_list)
+    else:
+        qty_list = [qty]
+        out_units_list = [out_units]
 
     if denoise:
-        # call self to render a 'flat field'
+        # render a 'flat field' alongside the requested images
         snap['__denoise_one'] = 1
-        im2 = render_image(snap, '__denoise_one', x2, nx, y2, ny, x1, y1, z_plane, None,
-                           xy_units, kernel, z_camera, smooth, smooth_in_pixels,
-                           force_quiet, approximate_fast, threaded, False)
-        del snap.ancestor['__denoise_one']
-        im2 = im / im2
-        im2.units = im.units
-        return im2
+        qty_list.append('__denoise_one')
+        out_units_list.append(None)
 
+    if len(qty_list) == 1:
+        render_qty, render_units = qty, out_units
     else:
-        return im
+        render_qty, render_units = qty_list, out_units_list
+
+    try:
+        if threaded and not z_camera:
+            # the renderer divides the image between the threads
+            im = base_renderer(snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                               render_units, xy_units, kernel, z_camera, smooth,
+                               smooth_in_pixels, False, snap_slice=visible,
+                               num_threads=threaded)
+        elif threaded:
+            # perspective images divide the particles between the threads
+            im = _threaded_render_image(base_renderer, snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                                        render_units, xy_units, kernel, z_camera, smooth,
+                                        smooth_in_pixels, True,
+                                        num_threads=threaded)
+        else:
+            im = base_renderer(snap, render_qty, x2, nx, y2, ny, x1, y1, z_plane,
+                               render_units, xy_units, kernel, z_camera, smooth,
+                               smooth_in_pixels, False, snap_slice=visible)
+
+        if len(qty_list) == 1:
+            im.sim = snap
+            images = [im]
+        else:
+            images = []
+            for i, (qty_s, out_units_s) in enumerate(zip(qty_list, out_units_list)):
+                im_s = im[i].copy()
+                im_s.units = _image_units(snap, qty_s, out_units_s, kernel)
+                im_s.sim = snap
+                images.append(im_s)
+    finally:
+        if denoise:
+            del snap.ancestor['__denoise_one']
+
+    if denoise:
+        flat_field = images.pop()
+        for i, im in enumerate(images):
+            images[i] = im / flat_field
+            images[i].units = im.units
+
+    if multiple:
+        return images
+    else:
+        return images[0]
+
+
+def _visible_particles(snap, x2, nx, y2, ny, x1, y1, xy_units, kernel, smooth):
+    """Return the indices of the particles of snap whose kernels may overlap
+    the image with the given extent, found using the snapshot's tree; or None
+    if it has no tree or too many particles are visible for it to be worth
+    rendering only those"""
+
+    tree = getattr(snap, 'kdtree', None)
+    if tree is None or tree.s_len != len(snap):
+        return None
+
+    if y2 is None:
+        if ny is not None:
+            y2 = x2 * float(ny) / nx
+        else:
+            y2 = x2
+    if x1 is None:
+        x1 = -x2
+    if y1 is None:
+        y1 = -y2
+
+    # the tree is in the units of the positions
+    pos_units = snap['pos'].units
+    if xy_units is None:
+        to_pos = snap['x'].units.ratio(pos_units, **snap.conversion_context())
+    else:
+        to_pos = units.Unit(xy_units).ratio(pos_units, **snap.conversion_context())
+
+    # leave a margin for particles rendered into the edge pixels, including
+    # the coarse pixels of approximate_fast rendering
+    margin_x = float(x2 - x1) / 20
+    margin_y = float(y2 - y1) / 20
+    lower = np.array([x1 - margin_x, y1 - margin_y, -np.inf]) * to_pos
+    upper = np.array([x2 + margin_x, y2 + margin_y, np.inf]) * to_pos
+    if kernel.h_power == 3:
+        # a slice through z=0
+        lower[2] = upper[2] = 0.0
+
+    sm = snap[smooth]
+    reach = kernel.max_d * sm.view(np.ndarray) * sm.units.ratio(pos_units, **snap.conversion_context())
+
+    if 'boxsize' in snap.properties:
+        boxsize = float(snap.properties['boxsize'].in_units(pos_units, **snap.conversion_context()))
+        num_repeats = int(round(x2 * to_pos / boxsize)) + 1
+        repeat_array = np.linspace(-num_repeats * boxsize, num_repeats * boxsize, num_repeats * 2 + 1)
+    else:
+        repeat_array = [0.0]
+
+    # the periodic images of the particles that are also rendered
+    offsets = np.array([[offset_x, offset_y, 0.0] for offset_x in repeat_array for offset_y in repeat_array])
+    visible = tree.particles_in_box(lower - offsets, upper - offsets, reach)
+
+    # gathering the arrays of most of the particles would cost more than
+    # the renderer saves by skipping the others
+    if len(visible) > len(snap) // 2:
+        return None
+
+    logger.info("Rendering the %d of %d particles which overlap the image" % (len(visible), len(snap)))
+    return visible
 
 
 def _render_image(snap, qty, x2, nx, y2, ny, x1,
                   y1, z_plane, out_units, xy_units, kernel, z_camera,
                   smooth, smooth_in_pixels,  force_quiet,
                   smooth_range=None, res_downgrade=None, snap_slice=None,
-                  __threaded=False):
-    """The single-threaded image rendering core function. External calls
+                  __threaded=False, num_threads=None):
+    """The image rendering core function. If *num_threads* is given, an
+    orthographic image is rendered on that many threads. External calls
     should be made to the render_image function."""
 
     import os
@@ -554,11 +783,20 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
 
     snap_proxy = {}
 
+    # several quantities, given as a list, are rendered together as a
+    # stack of images with out_units a list of the same length
+    multiple = isinstance(qty, (list, tuple))
+    if multiple:
+        qty_list, out_units_list = qty, out_units
+    else:
+        qty_list, out_units_list = [qty], [out_units]
+
     # cache the arrays and take a slice of them if we've been asked to
-    for arname in 'x', 'y', 'z', 'pos', smooth, qty, 'rho', 'mass':
+    for arname in ['x', 'y', 'z', 'pos', smooth, 'rho', 'mass'] + list(qty_list):
         snap_proxy[arname] = snap[arname]
         if snap_slice is not None:
             snap_proxy[arname] = snap_proxy[arname][snap_slice]
+        snap_proxy[arname] = util.native_byteorder(snap_proxy[arname])
 
     if 'boxsize' in snap.properties:
         boxsize = snap.properties['boxsize'].in_units(snap_proxy['x'].units,**snap.conversion_context())
@@ -626,16 +864,24 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     if sm.units != x.units and not smooth_in_pixels:
         sm = sm.in_units(x.units)
 
-    qty_s = qty
-    qty = snap_proxy[qty]
     mass = snap_proxy['mass']
     rho = snap_proxy['rho']
 
-    if out_units is not None:
-        # Calculate the ratio now so we don't waste time calculating
-        # the image only to throw a UnitsException later
-        conv_ratio = (qty.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(out_units,
-                                                                                               **snap.conversion_context())
+    # Calculate the conversions now so we don't waste time calculating
+    # the image only to throw a UnitsException later.
+    #
+    # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
+    # where M-u, rho_u and h_u are mass, density and smoothing units
+    # respectively. This is dimensionless, but may not be 1 if the units
+    # have been changed since load-time.
+    conv_ratios = []
+    for qty_s, out_units_s in zip(qty_list, out_units_list):
+        if out_units_s is None:
+            conv_ratios.append((mass.units / rho.units).ratio(
+                snap_proxy['x'].units ** 3, **snap_proxy['x'].conversion_context()))
+        else:
+            conv_ratios.append((snap_proxy[qty_s].units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(
+                out_units_s, **snap.conversion_context()))
 
     if z_camera is None:
         z_camera = 0.0
@@ -647,34 +893,49 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     else:
         repeat_array = [0.0]
 
-    result = _render.render_image(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
-                                  smooth_lo, smooth_hi, kernel, repeat_array, repeat_array)
-
-    result = result.view(array.SimArray)
-
-    # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
-    # where M-u, rho_u and h_u are mass, density and smoothing units
-    # respectively. This is dimensionless, but may not be 1 if the units
-    # have been changed since load-time.
-    if out_units is None:
-        result *= (snap_proxy['mass'].units / (snap_proxy['rho'].units)).ratio(
-            snap_proxy['x'].units ** 3, **snap_proxy['x'].conversion_context())
+    # the quantities are rendered from the columns of a 2D array
+    if multiple:
+        qty = np.empty((len(x), len(qty_list)),
+                       dtype=np.result_type(np.float32, *[snap_proxy[q].dtype for q in qty_list]))
+        for i, qty_s in enumerate(qty_list):
+            qty[:, i] = snap_proxy[qty_s]
+    else:
+        qty = snap_proxy[qty_list[0]][:, np.newaxis]
 
-        # The following will be the units of outputs after the above conversion
-        # is applied
-        result.units = snap_proxy[qty_s].units * \
-            snap_proxy['x'].units ** (3 - kernel.h_power)
+    if num_threads and z_camera == 0.0:
+        # the image is divided into tiles, rendered by separate threads
+        result = _render.render_image_tiles(nx, ny, x, y, z, sm, x1, x2, y1, y2, 0.0, qty, mass, rho,
+                                            smooth_lo, smooth_hi, kernel, repeat_array, repeat_array,
+                                            num_threads=int(num_threads))
     else:
-        result *= conv_ratio
-        result.units = out_units
+        result = _render.render_image_multi(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
+                                            smooth_lo, smooth_hi, kernel, repeat_array, repeat_array)
+
+    if multiple:
+        result = result.view(array.SimArray)
+        for i, conv_ratio in enumerate(conv_ratios):
+            result[i] *= conv_ratio
+        # the units of each image are assigned by render_image
+    else:
+        result = result[0].view(array.SimArray)
+        result *= conv_ratios[0]
+        result.units = _image_units(snap_proxy, qty_list[0], out_units, kernel)
 
     result.sim = snap
     return result
 
 
+def _image_units(snap, qty, out_units, kernel):
+    """Return the units of an image of qty rendered by _render_image"""
+    if out_units is None:
+        return snap[qty].units * snap['x'].units ** (3 - kernel.h_power)
+    else:
+        return out_units
+
+
 def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=None,
                xy_units=None, kernel=Kernel(), smooth='smooth', approximate_fast=_approximate_image,
-               threaded=None, snap_slice=None, denoise=None):
+               threaded=None, snap_slice=None, denoise=None, conserve=False):
     """
 
     Project SPH onto a grid using a typical (mass/rho)-weighted 'scatter'
@@ -704,6 +965,15 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
       can be useful to reduce noise especially when rendering AMR grids which
       often introduce problematic edge effects.
 
+    *threaded*: if False (or None), grid on a single core. Otherwise, the
+      number of threads to use, each filling separate slabs of the grid.
+
+    *conserve*: if True, normalise each particle's kernel over the cells it
+      overlaps, so that the sum over the grid of qty*mass/rho is exact
+      (apart from particles lying partly outside the grid) even when cells
+      are comparable to, or larger than, the smoothing lengths. The grid
+      is then not rendered with *approximate_fast*.
+
     """
 
     import os
@@ -716,6 +986,9 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
     if denoise and not _kernel_suitable_for_denoise(kernel):
         raise ValueError, "Denoising not supported with this kernel type. Re-run with denoise=False"
 
+    if conserve:
+        approximate_fast = False
+
     in_time = time.time()
 
     if x2 is None:
@@ -742,6 +1015,18 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
     x1, x2, y1, y2, z1, z2 = [float(q) for q in x1, x2, y1, y2, z1, z2]
     nx, ny, nz = [int(q) for q in nx, ny, nz]
 
+    im = _grid_region(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                      xy_units, kernel, smooth, approximate_fast, threaded, denoise, conserve)
+
+    logger.info("Render done at %.2f s" % (time.time() - in_time))
+
+    return im
+
+
+def _grid_region(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                 xy_units, kernel, smooth, approximate_fast, threaded, denoise, conserve=False):
+    """Render qty onto a grid with the given edges, as to_3d_grid"""
+
     if approximate_fast:
         renderer = _interpolated_renderer(
             _to_3d_grid, int(np.floor(np.log2(nx / 20))))
@@ -751,21 +1036,19 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
     if threaded is None:
         threaded = _get_threaded_image()
 
-    if threaded:
-        im = _threaded_render_image(renderer, snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                                    xy_units, kernel, smooth, num_threads=threaded)
-    else:
-        im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                      xy_units, kernel, smooth, False)
-
-    logger.info("Render done at %.2f s" % (time.time() - in_time))
+    # the gridding core divides the grid between the threads
+    im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                  xy_units, kernel, smooth, False, num_threads=int(threaded) if threaded else 1,
+                  conserve=conserve)
 
     if denoise:
-        # call self to render a 'flat field'
+        # render a 'flat field' over the same region
         snap['__one'] = 1
-        im2 = to_3d_grid(snap, '__one', nx, ny, nz, x2, None, xy_units, kernel, smooth,
-                         approximate_fast, threaded, snap_slice, False)
-        del snap.ancestor['__one']
+        try:
+            im2 = _grid_region(snap, '__one', nx, ny, nz, x1, x2, y1, y2, z1, z2, None,
+                               xy_units, kernel, smooth, approximate_fast, threaded, False, conserve)
+        finally:
+            del snap.ancestor['__one']
         im2 = im / im2
         im2.units = im.units
         return im2
@@ -777,7 +1060,7 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
 def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
                 xy_units, kernel, smooth, __threaded=False, res_downgrade=None,
                 snap_slice=None,
-                smooth_range=None):
+                smooth_range=None, num_threads=1, conserve=False):
 
     snap_proxy = {}
 
@@ -787,6 +1070,7 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
 
         if snap_slice is not None:
             snap_proxy[arname] = snap_proxy[arname][snap_slice]
+        snap_proxy[arname] = util.native_byteorder(snap_proxy[arname])
 
     if res_downgrade is not None:
         dx = float(x2 - x1) / nx
@@ -842,8 +1126,9 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
 
     logger.info("Gridding particles")
 
-    result = _render.to_3d_grid(nx,ny,nz,x,y,z,sm,x1,x2,y1,y2,z1,z2,
-                                qty,mass,rho,smooth_lo,smooth_hi,kernel)
+    result = _render.to_3d_grid_slabs(nx,ny,nz,x,y,z,sm,x1,x2,y1,y2,z1,z2,
+                                      qty,mass,rho,smooth_lo,smooth_hi,kernel,
+                                      conserve=conserve, num_threads=num_threads)
     result = result.view(array.SimArray)
 
     # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
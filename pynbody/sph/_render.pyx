@@ -5,6 +5,7 @@ cimport cython
 cimport libc.math as cmath
 from libc.math cimport atan, pow
 from libc.stdlib cimport malloc, free
+from cython.parallel cimport prange
 
 # The following slightly odd repetitiveness is to force Cython to generate
 # code for different permutations of the possible integer inputs.
@@ -119,30 +120,48 @@ cdef image_output_type get_kernel_xyz(fixed_input_type x, fixed_input_type y, fi
 
 
 
+def render_image(int nx, int ny, x, y, z, sm,
+                 fixed_input_type x1,fixed_input_type x2,fixed_input_type y1,
+                 fixed_input_type y2,fixed_input_type z_camera, fixed_input_type z0,
+                 qty, mass, rho,
+                 fixed_input_type smooth_lo, fixed_input_type smooth_hi,
+                 kernel,
+                 wrap_offsets_x=[0], wrap_offsets_y=[0]) :
+    """Render the single quantity *qty*; see render_image_multi"""
+    return render_image_multi(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, z0,
+                              qty[:,np.newaxis], mass, rho, smooth_lo, smooth_hi, kernel,
+                              wrap_offsets_x, wrap_offsets_y)[0]
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def render_image(int nx, int ny,
+def render_image_multi(int nx, int ny,
                  np.ndarray[fused_input_type_1,ndim=1] x,
                  np.ndarray[fused_input_type_1,ndim=1] y,
                  np.ndarray[fused_input_type_1,ndim=1] z,
                  np.ndarray[fused_input_type_2,ndim=1] sm,
                  fixed_input_type x1,fixed_input_type x2,fixed_input_type y1,
                  fixed_input_type y2,fixed_input_type z_camera, fixed_input_type z0,
-                 np.ndarray[fused_input_type_3,ndim=1] qty,
+                 np.ndarray[fused_input_type_3,ndim=2] qty,
                  np.ndarray[fused_input_type_4,ndim=1] mass,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
                  kernel,
                  wrap_offsets_x=[0], wrap_offsets_y=[0]) :
+    """Render the quantities in the columns of *qty* into a stack of
+    images, of shape (qty.shape[1], ny, nx), in a single pass over the
+    particles. The kernel is evaluated once for each particle and pixel,
+    and applied to all the quantities."""
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
     cdef fixed_input_type x_start = x1+pixel_dx/2
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef int n_part = len(x)
-    cdef int nn=0, i=0
-    cdef fixed_input_type x_i, y_i, z_i, sm_i, qty_i
+    cdef int n_qty = qty.shape[1]
+    cdef int nn=0, i=0, q
+    cdef fixed_input_type x_i, y_i, z_i, sm_i, weight_i, kernel_i
     cdef fixed_input_type x_pixel, y_pixel, z_pixel
     cdef int x_pos, y_pos
     cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
@@ -168,7 +187,7 @@ def render_image(int nx, int ny,
 
     cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
-    cdef np.ndarray[image_output_type,ndim=2] result = np.zeros((ny,nx),dtype=np_image_output_type)
+    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((n_qty,ny,nx),dtype=np_image_output_type)
 
     z_pixel = z0
     cdef int total_ptcls = 0
@@ -184,7 +203,7 @@ def render_image(int nx, int ny,
                 for i in range(n_part) :
                     # load particle details
                     x_i = x[i]+wrap_offset_x; y_i=y[i]+wrap_offset_y;
-                    z_i=z[i]; sm_i = sm[i]; qty_i = qty[i]*mass[i]/rho[i]
+                    z_i=z[i]; sm_i = sm[i]; weight_i = mass[i]/rho[i]
 
                     if z_camera!=0.0 :
                         # perspective image -
@@ -234,7 +253,9 @@ def render_image(int nx, int ny,
 
                         # final bounds check
                         if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny :
-                            result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            kernel_i = weight_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            for q in range(n_qty) :
+                                result[q,y_pos,x_pos]+=qty[i,q]*kernel_i
                     else :
                         # multi-pixel
                         x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
@@ -264,7 +285,196 @@ def render_image(int nx, int ny,
 
                                 #c_result[x_pos+nx*y_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
 
-                                result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                kernel_i = weight_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                                for q in range(n_qty) :
+                                    result[q,y_pos,x_pos]+=qty[i,q]*kernel_i
+
+    return result
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int pixel_range(fixed_input_type x_i, fixed_input_type y_i, fixed_input_type z_i, fixed_input_type sm_i,
+                     fixed_input_type x1, fixed_input_type x2, fixed_input_type y1, fixed_input_type y2,
+                     fixed_input_type z0, fixed_input_type pixel_dx, fixed_input_type pixel_dy,
+                     int nx, int ny, fixed_input_type max_d_over_h, int use_z,
+                     fixed_input_type smooth_lo, fixed_input_type smooth_hi, int *pix) nogil :
+    """Find the pixels pix[0]<=x<pix[1], pix[2]<=y<pix[3] to which an orthographic
+    image of a particle contributes, as in render_image_multi; return 0 if there
+    are none"""
+    if sm_i<pixel_dx*smooth_lo or sm_i>pixel_dx*smooth_hi :
+        return 0
+
+    if not ((use_z*cmath.fabs(z_i-z0)<max_d_over_h*sm_i)
+            and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
+        return 0
+
+    if (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
+        # single pixel
+        pix[0] = int((x_i-x1)/pixel_dx)
+        pix[2] = int((y_i-y1)/pixel_dy)
+        if not (pix[0]>=0 and pix[0]<nx and pix[2]>=0 and pix[2]<ny) :
+            return 0
+        pix[1] = pix[0]+1
+        pix[3] = pix[2]+1
+    else :
+        # multi-pixel
+        pix[0] = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
+        pix[1] = int((x_i+max_d_over_h*sm_i-x1)/pixel_dx)
+        pix[2] = int((y_i-max_d_over_h*sm_i-y1)/pixel_dy)
+        pix[3] = int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
+        if pix[0]<0 : pix[0] = 0
+        if pix[1]>nx : pix[1] = nx
+        if pix[2]<0 : pix[2] = 0
+        if pix[3]>ny : pix[3] = ny
+        if pix[0]>=pix[1] or pix[2]>=pix[3] :
+            return 0
+
+    return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def render_image_tiles(int nx, int ny,
+                 np.ndarray[fused_input_type_1,ndim=1] x,
+                 np.ndarray[fused_input_type_1,ndim=1] y,
+                 np.ndarray[fused_input_type_1,ndim=1] z,
+                 np.ndarray[fused_input_type_2,ndim=1] sm,
+                 fixed_input_type x1,fixed_input_type x2,fixed_input_type y1,
+                 fixed_input_type y2, fixed_input_type z0,
+                 np.ndarray[fused_input_type_3,ndim=2] qty,
+                 np.ndarray[fused_input_type_4,ndim=1] mass,
+                 np.ndarray[fused_input_type_5,ndim=1] rho,
+                 fixed_input_type smooth_lo, fixed_input_type smooth_hi,
+                 kernel,
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],
+                 int num_threads=1, int tile_size=64) :
+    """Render an orthographic image exactly as render_image_multi, but on
+    *num_threads* threads.
+
+    The image is divided into tiles of *tile_size* pixels square and the
+    particles are binned, once, to the tiles their kernels overlap. Each
+    tile is then rendered by one thread from its own particles, in their
+    original order, so that the threads write to separate parts of a
+    single image and the result does not depend on the number of
+    threads."""
+
+    cdef fixed_input_type pixel_dx = (x2-x1)/nx
+    cdef fixed_input_type pixel_dy = (y2-y1)/ny
+    cdef fixed_input_type x_start = x1+pixel_dx/2
+    cdef fixed_input_type y_start = y1+pixel_dy/2
+    cdef int n_part = len(x)
+    cdef int n_qty = qty.shape[1]
+    cdef int i, q, w, t
+    cdef long c, e, n_contrib
+    cdef fixed_input_type x_i, y_i, z_i, sm_i, weight_i, kernel_i
+    cdef fixed_input_type x_pixel, y_pixel
+    cdef int x_pos, y_pos, x_lo, x_hi, y_lo, y_hi, tx, ty
+    cdef int pix[4]
+
+    cdef int kernel_dim = kernel.h_power
+    cdef fixed_input_type max_d_over_h = kernel.max_d
+
+    cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
+    cdef int num_samples = len(samples)
+    cdef image_output_type* samples_c = <image_output_type*>samples.data
+    cdef image_output_type sm_to_kdim
+    cdef fixed_input_type kernel_max_2
+
+    cdef int use_z = 1 if kernel_dim>=3 else 0
+
+    assert kernel_dim==2 or kernel_dim==3, "Only kernels of dimension 2 or 3 currently supported"
+    assert len(x) == len(y) == len(z) == len(sm) == len(qty) == len(mass) == len(rho), "Inconsistent array lengths passed to render_image_tiles"
+
+    # every combination of periodic offsets, x varying slowest as in render_image_multi
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_x = np.repeat(np.asarray(wrap_offsets_x, dtype=np.float32), len(wrap_offsets_y))
+    cdef np.ndarray[np.float32_t,ndim=1] wrap_y = np.tile(np.asarray(wrap_offsets_y, dtype=np.float32), len(wrap_offsets_x))
+    cdef int n_wrap = len(wrap_x)
+
+    cdef int n_tiles_x = (nx+tile_size-1)/tile_size
+    cdef int n_tiles_y = (ny+tile_size-1)/tile_size
+    cdef int n_tiles = n_tiles_x*n_tiles_y
+
+    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((n_qty,ny,nx),dtype=np_image_output_type)
+
+    # count the particle images that contribute to the image
+    n_contrib = 0
+    with nogil:
+        for w in range(n_wrap) :
+            for i in range(n_part) :
+                n_contrib+=pixel_range(x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i], x1, x2, y1, y2, z0,
+                                       pixel_dx, pixel_dy, nx, ny, max_d_over_h, use_z, smooth_lo, smooth_hi, pix)
+
+    # record them with the pixels they cover, and count their entries in each tile
+    cdef np.ndarray[np.int32_t,ndim=1] contrib_particle = np.empty(n_contrib, dtype=np.int32)
+    cdef np.ndarray[np.int32_t,ndim=1] contrib_wrap = np.empty(n_contrib, dtype=np.int32)
+    cdef np.ndarray[np.int32_t,ndim=2] contrib_pixels = np.empty((n_contrib,4), dtype=np.int32)
+    cdef np.ndarray[np.int64_t,ndim=1] tile_start = np.zeros(n_tiles+1, dtype=np.int64)
+
+    c = 0
+    with nogil:
+        for w in range(n_wrap) :
+            for i in range(n_part) :
+                if pixel_range(x[i]+wrap_x[w], y[i]+wrap_y[w], z[i], sm[i], x1, x2, y1, y2, z0,
+                               pixel_dx, pixel_dy, nx, ny, max_d_over_h, use_z, smooth_lo, smooth_hi, pix) :
+                    contrib_particle[c] = i
+                    contrib_wrap[c] = w
+                    for q in range(4) :
+                        contrib_pixels[c,q] = pix[q]
+                    for ty in range(pix[2]/tile_size, (pix[3]-1)/tile_size+1) :
+                        for tx in range(pix[0]/tile_size, (pix[1]-1)/tile_size+1) :
+                            tile_start[ty*n_tiles_x+tx+1]+=1
+                    c+=1
+
+        for t in range(n_tiles) :
+            tile_start[t+1]+=tile_start[t]
+
+    # list the contributions to each tile, in order
+    cdef np.ndarray[np.int64_t,ndim=1] tile_fill = tile_start[:-1].copy()
+    cdef np.ndarray[np.int64_t,ndim=1] tile_entries = np.empty(tile_start[n_tiles], dtype=np.int64)
+
+    with nogil:
+        for c in range(n_contrib) :
+            for ty in range(contrib_pixels[c,2]/tile_size, (contrib_pixels[c,3]-1)/tile_size+1) :
+                for tx in range(contrib_pixels[c,0]/tile_size, (contrib_pixels[c,1]-1)/tile_size+1) :
+                    t = ty*n_tiles_x+tx
+                    tile_entries[tile_fill[t]] = c
+                    tile_fill[t]+=1
+
+        # render the tiles
+        for t in prange(n_tiles, schedule='dynamic', num_threads=num_threads) :
+            for e in range(tile_start[t], tile_start[t+1]) :
+                c = tile_entries[e]
+                i = contrib_particle[c]
+                w = contrib_wrap[c]
+
+                x_i = x[i]+wrap_x[w]; y_i = y[i]+wrap_y[w]
+                z_i = z[i]; sm_i = sm[i]; weight_i = mass[i]/rho[i]
+
+                if kernel_dim==2 :
+                    sm_to_kdim = sm_i*sm_i
+                else :
+                    sm_to_kdim = sm_i*sm_i*sm_i
+
+                kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
+
+                # the pixels of this particle that lie within the tile
+                x_lo = max(contrib_pixels[c,0], (t%n_tiles_x)*tile_size)
+                x_hi = min(contrib_pixels[c,1], (t%n_tiles_x+1)*tile_size)
+                y_lo = max(contrib_pixels[c,2], (t/n_tiles_x)*tile_size)
+                y_hi = min(contrib_pixels[c,3], (t/n_tiles_x+1)*tile_size)
+
+                for x_pos in range(x_lo, x_hi) :
+                    x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
+                    for y_pos in range(y_lo, y_hi) :
+                        y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
+                        kernel_i = weight_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z0)*use_z, kernel_max_2, sm_to_kdim, num_samples, samples_c)
+                        for q in range(n_qty) :
+                            result[q,y_pos,x_pos]+=qty[i,q]*kernel_i
 
     return result
 
@@ -291,7 +501,7 @@ def to_3d_grid(int nx, int ny, int nz,
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
-    cdef fixed_input_type pixel_dz = (z2-z1)/ny
+    cdef fixed_input_type pixel_dz = (z2-z1)/nz
     cdef fixed_input_type x_start = x1+pixel_dx/2
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef fixed_input_type z_start = z1+pixel_dz/2
@@ -392,3 +602,213 @@ def to_3d_grid(int nx, int ny, int nz,
                             result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
 
     return result
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def to_3d_grid_slabs(int nx, int ny, int nz,
+                 np.ndarray[fused_input_type_1,ndim=1] x,
+                 np.ndarray[fused_input_type_1,ndim=1] y,
+                 np.ndarray[fused_input_type_1,ndim=1] z,
+                 np.ndarray[fused_input_type_2,ndim=1] sm,
+                 fixed_input_type x1,fixed_input_type x2,fixed_input_type y1,
+                 fixed_input_type y2,fixed_input_type z1, fixed_input_type z2,
+                 np.ndarray[fused_input_type_3,ndim=1] qty,
+                 np.ndarray[fused_input_type_4,ndim=1] mass,
+                 np.ndarray[fused_input_type_5,ndim=1] rho,
+                 fixed_input_type smooth_lo, fixed_input_type smooth_hi,
+                 kernel, int conserve=0, int num_threads=1, int max_norm_cells=64) :
+    """Grid the particles as to_3d_grid, on *num_threads* threads.
+
+    The cells each particle contributes to, and the factor by which it
+    contributes, are found for all the particles first. The grid is then
+    divided into slabs along z, each filled by one thread from its own
+    particles in their original order, so that the result does not depend
+    on the number of threads.
+
+    If *conserve* is zero the values are those of to_3d_grid. Otherwise
+    each particle's kernel values are normalised to sum to one over the
+    cells it overlaps, so that the grid conserves the integral of
+    qty*mass/rho exactly, and particles whose kernels lie inside a single
+    cell, or miss every cell centre, are deposited straight into the cell
+    containing them. Kernels covering more than *max_norm_cells* cells
+    along an axis are well sampled by the grid and are not normalised."""
+
+    cdef fixed_input_type pixel_dx = (x2-x1)/nx
+    cdef fixed_input_type pixel_dy = (y2-y1)/ny
+    cdef fixed_input_type pixel_dz = (z2-z1)/nz
+    cdef fixed_input_type x_start = x1+pixel_dx/2
+    cdef fixed_input_type y_start = y1+pixel_dy/2
+    cdef fixed_input_type z_start = z1+pixel_dz/2
+    cdef fixed_input_type cell_volume = pixel_dx*pixel_dy*pixel_dz
+    cdef int n_part = len(x)
+    cdef int i, s, a, b, c
+    cdef long e
+    cdef fixed_input_type x_i, y_i, z_i, sm_i, reach, total
+    cdef fixed_input_type dx2, dy2, dz2
+    cdef int a0, a1, b0, b1, c0, c1, c_lo, c_hi
+    cdef image_output_type sm_to_kdim
+    cdef fixed_input_type kernel_max_2
+
+    cdef int kernel_dim = kernel.h_power
+    cdef fixed_input_type max_d_over_h = kernel.max_d
+
+    cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
+    cdef int num_samples = len(samples)
+    cdef image_output_type* samples_c = <image_output_type*>samples.data
+
+    if kernel_dim<3:
+        raise ValueError, \
+          "Cannot render to 3D grid without 3-dimensional kernel or greater"
+
+    assert len(x) == len(y) == len(z) == len(sm) == \
+            len(qty) == len(mass) == len(rho), \
+            "Inconsistent array lengths passed to to_3d_grid_slabs"
+
+    # the cells [lower, upper) each particle contributes to, whether it
+    # contributes to them all equally, and the factor by which it does so
+    cdef np.ndarray[np.int32_t,ndim=2] lower = np.zeros((n_part,3), dtype=np.int32)
+    cdef np.ndarray[np.int32_t,ndim=2] upper = np.zeros((n_part,3), dtype=np.int32)
+    cdef np.ndarray[np.int8_t,ndim=1] uniform = np.zeros(n_part, dtype=np.int8)
+    cdef np.ndarray[np.float64_t,ndim=1] factor = np.zeros(n_part, dtype=np.float64)
+
+    cdef int slab_size = max(1, nz/(4*num_threads))
+    cdef int n_slabs = (nz+slab_size-1)/slab_size
+    cdef np.ndarray[np.int64_t,ndim=1] slab_start = np.zeros(n_slabs+1, dtype=np.int64)
+
+    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
+
+    with nogil:
+        for i in prange(n_part, schedule='guided', num_threads=num_threads) :
+            x_i = x[i]; y_i=y[i]; z_i=z[i]; sm_i = sm[i]
+
+            # check particle smoothing is within specified range, and the
+            # particle is within bounds
+            if sm_i<pixel_dx*smooth_lo or sm_i>pixel_dx*smooth_hi : continue
+            if not (z_i>z1-2*sm_i and z_i<z2+2*sm_i \
+                    and x_i>x1-2*sm_i and x_i<x2+2*sm_i \
+                    and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
+                continue
+
+            factor[i] = qty[i]*mass[i]/rho[i]
+            reach = max_d_over_h*sm_i
+
+            if not conserve :
+                if (reach/pixel_dx<1 and reach/pixel_dy<1) :
+                    # single cell, sampled at its centre
+                    a0 = int((x_i-x1)/pixel_dx)
+                    b0 = int((y_i-y1)/pixel_dy)
+                    c0 = int((z_i-z1)/pixel_dz)
+                    if a0>=0 and a0<nx and b0>=0 and b0<ny and c0>=0 and c0<nz :
+                        lower[i,0] = a0; upper[i,0] = a0+1
+                        lower[i,1] = b0; upper[i,1] = b0+1
+                        lower[i,2] = c0; upper[i,2] = c0+1
+                else :
+                    a0 = <int>cmath.floor((x_i-reach-x1)/pixel_dx)
+                    a1 = <int>cmath.floor((x_i+reach-x1)/pixel_dx)
+                    b0 = <int>cmath.floor((y_i-reach-y1)/pixel_dy)
+                    b1 = <int>cmath.floor((y_i+reach-y1)/pixel_dy)
+                    c0 = <int>cmath.floor((z_i-reach-z1)/pixel_dz)
+                    c1 = <int>cmath.floor((z_i+reach-z1)/pixel_dz)
+                    if a0<0 : a0 = 0
+                    if a1>nx : a1 = nx
+                    if b0<0 : b0 = 0
+                    if b1>ny : b1 = ny
+                    if c0<0 : c0 = 0
+                    if c1>nz : c1 = nz
+                    lower[i,0] = a0; upper[i,0] = a1
+                    lower[i,1] = b0; upper[i,1] = b1
+                    lower[i,2] = c0; upper[i,2] = c1
+                continue
+
+            # every cell the kernel overlaps, including those off the grid
+            a0 = <int>cmath.floor((x_i-reach-x1)/pixel_dx)
+            a1 = <int>cmath.floor((x_i+reach-x1)/pixel_dx)+1
+            b0 = <int>cmath.floor((y_i-reach-y1)/pixel_dy)
+            b1 = <int>cmath.floor((y_i+reach-y1)/pixel_dy)+1
+            c0 = <int>cmath.floor((z_i-reach-z1)/pixel_dz)
+            c1 = <int>cmath.floor((z_i+reach-z1)/pixel_dz)+1
+
+            total = 0
+            if a1-a0>1 or b1-b0>1 or c1-c0>1 :
+                if a1-a0>max_norm_cells or b1-b0>max_norm_cells or c1-c0>max_norm_cells :
+                    total = 1
+                else :
+                    sm_to_kdim = sm_i*sm_i*sm_i
+                    kernel_max_2 = reach*reach
+                    for a in range(a0, a1) :
+                        dx2 = (pixel_dx*<fixed_input_type>(a)+x_start)-x_i
+                        dx2 = dx2*dx2
+                        for b in range(b0, b1) :
+                            dy2 = (pixel_dy*<fixed_input_type>(b)+y_start)-y_i
+                            dy2 = dx2+dy2*dy2
+                            for c in range(c0, c1) :
+                                dz2 = (pixel_dz*<fixed_input_type>(c)+z_start)-z_i
+                                total = total + get_kernel(dy2+dz2*dz2, kernel_max_2, sm_to_kdim, num_samples, samples_c)
+                    total = total*cell_volume
+
+            if total>0 :
+                factor[i] = factor[i]/total
+            else :
+                # the kernel lies within one cell, or falls between the cell
+                # centres: put it all in the cell containing the particle
+                uniform[i] = 1
+                factor[i] = factor[i]/cell_volume
+                a0 = <int>cmath.floor((x_i-x1)/pixel_dx); a1 = a0+1
+                b0 = <int>cmath.floor((y_i-y1)/pixel_dy); b1 = b0+1
+                c0 = <int>cmath.floor((z_i-z1)/pixel_dz); c1 = c0+1
+
+            lower[i,0] = max(a0, 0); upper[i,0] = min(a1, nx)
+            lower[i,1] = max(b0, 0); upper[i,1] = min(b1, ny)
+            lower[i,2] = max(c0, 0); upper[i,2] = min(c1, nz)
+
+        # count the particles in each slab
+        for i in range(n_part) :
+            if lower[i,0]<upper[i,0] and lower[i,1]<upper[i,1] and lower[i,2]<upper[i,2] :
+                for s in range(lower[i,2]/slab_size, (upper[i,2]-1)/slab_size+1) :
+                    slab_start[s+1]+=1
+        for s in range(n_slabs) :
+            slab_start[s+1]+=slab_start[s]
+
+    cdef np.ndarray[np.int64_t,ndim=1] slab_fill = slab_start[:-1].copy()
+    cdef np.ndarray[np.int32_t,ndim=1] slab_entries = np.empty(slab_start[n_slabs], dtype=np.int32)
+
+    with nogil:
+        for i in range(n_part) :
+            if lower[i,0]<upper[i,0] and lower[i,1]<upper[i,1] and lower[i,2]<upper[i,2] :
+                for s in range(lower[i,2]/slab_size, (upper[i,2]-1)/slab_size+1) :
+                    slab_entries[slab_fill[s]] = i
+                    slab_fill[s]+=1
+
+        # fill the slabs
+        for s in prange(n_slabs, schedule='dynamic', num_threads=num_threads) :
+            for e in range(slab_start[s], slab_start[s+1]) :
+                i = slab_entries[e]
+                c_lo = max(lower[i,2], s*slab_size)
+                c_hi = min(upper[i,2], (s+1)*slab_size)
+
+                if uniform[i] :
+                    for a in range(lower[i,0], upper[i,0]) :
+                        for b in range(lower[i,1], upper[i,1]) :
+                            for c in range(c_lo, c_hi) :
+                                result[a,b,c]+=factor[i]
+                    continue
+
+                x_i = x[i]; y_i=y[i]; z_i=z[i]; sm_i = sm[i]
+                sm_to_kdim = sm_i*sm_i*sm_i
+                kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
+
+                # the squared offsets along each axis are found once per row
+                for a in range(lower[i,0], upper[i,0]) :
+                    dx2 = x_i-(pixel_dx*<fixed_input_type>(a)+x_start)
+                    dx2 = dx2*dx2
+                    for b in range(lower[i,1], upper[i,1]) :
+                        dy2 = y_i-(pixel_dy*<fixed_input_type>(b)+y_start)
+                        dy2 = dx2+dy2*dy2
+                        for c in range(c_lo, c_hi) :
+                            dz2 = z_i-(pixel_dz*<fixed_input_type>(c)+z_start)
+                            result[a,b,c]+=factor[i]*get_kernel(dy2+dz2*dz2, kernel_max_2, sm_to_kdim, num_samples, samples_c)
+
+    return result
@@ -0,0 +1,139 @@
+"""
+
+distributed
+===========
+
+Smoothing lengths and densities calculated by a pool of worker
+processes.
+
+The box is decomposed into spatial domains, the tiles of
+:mod:`~pynbody.sph.outofcore`, which are shared out between the
+workers. Each worker reads the particles of its domain, and the boundary
+particles it needs from neighbouring domains, directly from positions and
+masses in shared memory. It builds its own tree and writes the results
+for its domain into shared output arrays, so that nothing but the list of
+domains passes between the processes.
+
+This requires the ``posix_ipc`` module. The number of processes used to
+derive the ``smooth`` and ``rho`` arrays of snapshots is set by
+``smooth-processes`` in the ``[sph]`` section of the configuration.
+
+"""
+
+import numpy as np
+import math
+import time
+import logging
+
+from . import outofcore
+from .. import array, config
+
+logger = logging.getLogger('pynbody.sph.distributed')
+
+try:
+    import multiprocessing
+    import posix_ipc
+    remote_exec = array.shared_array_remote
+    remote_map = array.remote_map
+    available = True
+except ImportError:
+    available = False
+
+    def remote_exec(fn):
+        return fn
+
+_pool = None
+_pool_processes = 0
+
+
+def _get_pool(processes):
+    global _pool, _pool_processes
+    if _pool is None or _pool_processes != processes:
+        if _pool is not None:
+            _pool.close()
+        _pool = multiprocessing.Pool(processes)
+        _pool_processes = processes
+    return _pool
+
+
+def _shared(ar, dtype=None):
+    """Return *ar*, or a copy of it in shared memory if it is not there already"""
+    if dtype is None:
+        dtype = ar.dtype
+    base = ar
+    while isinstance(base, array.SimArray) and isinstance(base.base, array.SimArray):
+        base = base.base
+    if hasattr(base, '_shared_fname') and ar.dtype == dtype:
+        return ar
+    copy = array._array_factory(ar.shape, dtype, False, True)
+    copy[:] = ar
+    return copy
+
+
+@remote_exec
+def _smooth_tiles(pos, mass, smooth, rho, nsmooth, boxsize, tiles, tiling, tile_index, chunk, num_threads):
+    # each process gets its share of the threads
+    config['number_of_threads'] = num_threads
+    for tile in tiles:
+        outofcore._smooth_tile(pos, mass, smooth, rho, nsmooth, boxsize, np.array(tile), tiling, tile_index, chunk)
+
+
+def smooth_in_processes(pos, mass, nsmooth=None, boxsize=None, rho=True, processes=None,
+                        ntiles=None, chunk=1000000):
+    """Calculate the smoothing lengths and, if *rho* is True, densities of
+    the particles with the given positions and masses using *processes*
+    worker processes (default: ``smooth-processes`` from the configuration).
+
+    The arrays are copied into shared memory unless they are there
+    already. The box is divided into *ntiles* domains along each axis,
+    by default enough to give each process several domains.
+
+    Returns the smoothing lengths or, if *rho* is True, the smoothing
+    lengths and densities, as arrays in shared memory."""
+
+    if not available:
+        raise RuntimeError, "Smoothing in several processes requires the posix_ipc module"
+
+    if nsmooth is None:
+        nsmooth = config['sph']['smooth-particles']
+    if processes is None:
+        processes = config['sph']['smooth-processes']
+    if ntiles is None:
+        ntiles = max(2, int(math.ceil((4 * processes) ** (1. / 3))))
+
+    n = len(pos)
+    if nsmooth > n:
+        raise ValueError, "Number of smoothing particles exceeds number of particles"
+
+    dtype = np.dtype(pos.dtype).newbyteorder('=')
+    pos = _shared(pos, dtype)
+    mass = _shared(mass)
+    smooth = array._array_factory(n, dtype, False, True)
+    if rho:
+        rho = array._array_factory(n, dtype, False, True)
+    else:
+        rho = None
+
+    tiling = outofcore._tiling(pos, nsmooth, boxsize, ntiles, chunk)
+    indices, starts = outofcore._sort_into_tiles(pos, tiling, boxsize, chunk)
+    tile_index = _shared(indices), starts
+    tiles = list(np.ndindex(ntiles, ntiles, ntiles))
+    num_threads = max(1, config['number_of_threads'] // processes)
+
+    logger.info('Smoothing %d particles in %d domains with %d processes' % (n, len(tiles), processes))
+    start = time.time()
+
+    tasks = [[tile] for tile in tiles]
+    n_tasks = len(tasks)
+    remote_map(_get_pool(processes), _smooth_tiles,
+               [pos] * n_tasks, [mass] * n_tasks, [smooth] * n_tasks, [rho] * n_tasks,
+               [nsmooth] * n_tasks, [boxsize] * n_tasks, tasks, [tiling] * n_tasks,
+               [tile_index] * n_tasks, [chunk] * n_tasks, [num_threads] * n_tasks)
+
+    end = time.time()
+    logger.info('Smoothing in processes done in %5.3g s' % (end - start))
+
+    if rho is None:
+        return smooth
+    else:
+        return smooth, rho
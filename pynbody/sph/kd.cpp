@@ -58,6 +58,24 @@ void kdOrder(KD kd)
 }
 
 
+void kdCountNodes(KD kd)
+{
+	// Work out the number of levels and nodes in a tree of nActive particles
+	int n,l;
+
+	n = kd->nActive;
+	kd->nLevels = 1;
+	l = 1;
+	while (n > kd->nBucket) {
+		n = n>>1;
+		l = l<<1;
+		++kd->nLevels;
+		}
+	kd->nSplit = l;
+	kd->nNodes = l<<1;
+}
+
+
 void kdFinish(KD kd)
 {
 	free(kd->p);
@@ -132,23 +150,61 @@ void kdUpPass(KD kd,int iCell)
 		}
 	}
 
+struct KDargs {
+	KD kd;
+	int local_root;
+	int nThreads;
+};
+
 template <typename T>
-void kdBuildTree(KD kd)
+void *kdUpPassRemote(void *a) {
+	struct KDargs *args = (struct KDargs *)a;
+	kdUpPassThreaded<T>(args->kd, args->local_root, args->nThreads);
+	return NULL;
+}
+
+template<typename T>
+void kdUpPassThreaded(KD kd, int iCell, int nThreads)
 {
-	int l,n,i,d,j;
+	// As kdUpPass, but sharing the subtrees of the top few levels between
+	// nThreads threads. Every node's bounds depend only on its own subtree,
+	// so the result is identical to the serial pass.
+	KDN *c = kd->kdNodes;
+
+#ifdef KDT_THREADING
+	if (nThreads > 1 && c[iCell].iDim != -1) {
+		pthread_t remote_thread;
+		struct KDargs remote_args;
+		int launched;
+
+		remote_args.kd = kd;
+		remote_args.local_root = LOWER(iCell);
+		remote_args.nThreads = nThreads/2;
+
+		launched = (pthread_create(&remote_thread, NULL, kdUpPassRemote<T>, &remote_args)==0);
+		if (!launched)
+			kdUpPass<T>(kd, LOWER(iCell));
+
+		kdUpPassThreaded<T>(kd, UPPER(iCell), nThreads - nThreads/2);
+
+		if (launched)
+			pthread_join(remote_thread, NULL);
+
+		kdCombine(&c[LOWER(iCell)],&c[UPPER(iCell)],&c[iCell]);
+		return;
+	}
+#endif
+	kdUpPass<T>(kd, iCell);
+}
+
+template <typename T>
+void kdBuildTree(KD kd, int nThreads)
+{
+	int i,j;
 	T rj;
 	BND bnd;
 
-	n = kd->nActive;
-	kd->nLevels = 1;
-	l = 1;
-	while (n > kd->nBucket) {
-		n = n>>1;
-		l = l<<1;
-		++kd->nLevels;
-		}
-	kd->nSplit = l;
-	kd->nNodes = l<<1;
+	kdCountNodes(kd);
 	if (kd->kdNodes != NULL) free(kd->kdNodes);
 	kd->kdNodes = (KDN *)malloc(kd->nNodes*sizeof(KDN));
 	assert(kd->kdNodes != NULL);
@@ -178,127 +234,119 @@ void kdBuildTree(KD kd)
 	kd->kdNodes[ROOT].bnd = bnd;
 
 	// Recursively build tree
-	kdBuildNode<T>(kd, ROOT);
+	kdBuildNodeThreaded<T>(kd, ROOT, nThreads);
 
 	// Calculate and store bounds information by passing it up the tree
-	kdUpPass<T>(kd,ROOT);
+	kdUpPassThreaded<T>(kd, ROOT, nThreads);
 }
 
-struct KDargs {
-	KD kd;
-	int local_root;
-};
-
 template <typename T>
-void kdBuildNodeRemote(struct KDargs *a) {
-	kdBuildNode<T>(a->kd, a->local_root);
+void *kdBuildNodeRemote(void *a) {
+	struct KDargs *args = (struct KDargs *)a;
+	kdBuildNodeThreaded<T>(args->kd, args->local_root, args->nThreads);
+	return NULL;
 }
 
 template <typename T>
-void kdBuildNode(KD kd, int local_root) {
-
-	int i=local_root;
-	int d,j,m,diff;
-	KDN *nodes;
-	nodes = kd->kdNodes;
+void kdBuildNodeThreaded(KD kd, int local_root, int nThreads) {
+	// Build the subtree below local_root, splitting the work between nThreads
+	// threads. The lower subtree of each of the top few nodes is handed to a new
+	// thread while the current thread continues with the upper subtree. Each
+	// node's median selection only permutes that node's own particles, so the
+	// tree is identical to one built on a single thread.
 
 #ifdef KDT_THREADING
-	pthread_t remote_thread;
-	struct KDargs remote_args;
-#endif
+	if (nThreads > 1) {
+		pthread_t remote_thread;
+		struct KDargs remote_args;
+		int launched;
 
-	while (1) {
-		assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
-		if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
-
-			// Select splitting dimensions on the basis of keeping things
-			// as square as possible
-			d = 0;
-			for (j=1;j<3;++j) {
-				if (nodes[i].bnd.fMax[j]-nodes[i].bnd.fMin[j] >
-					nodes[i].bnd.fMax[d]-nodes[i].bnd.fMin[d]) d = j;
-				}
-			nodes[i].iDim = d;
-
-			// Find mid-point of particle list at which splitting will
-			// ultimately take place
-			m = (nodes[i].pLower + nodes[i].pUpper)/2;
-
-			// Sort list to ensure particles between lower and m are to
-			// the 'left' of particles between m and upper
-			kdSelect<T>(kd,d,m,nodes[i].pLower,nodes[i].pUpper);
-
-			// Note split point based on median particle
-			nodes[i].fSplit = GET2<T>(kd->pNumpyPos,kd->p[m].iOrder,d);
-
-			// Set up lower cell
-			nodes[LOWER(i)].bnd = nodes[i].bnd;
-			nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
-			nodes[LOWER(i)].pLower = nodes[i].pLower;
-			nodes[LOWER(i)].pUpper = m;
-
-			// Set up upper cell
-			nodes[UPPER(i)].bnd = nodes[i].bnd;
-			nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
-			nodes[UPPER(i)].pLower = m+1;
-			nodes[UPPER(i)].pUpper = nodes[i].pUpper;
-			diff = (m-nodes[i].pLower+1)-(nodes[i].pUpper-m);
-			assert(diff == 0 || diff == 1);
-
-#if 0
-			// Threaded KDT build is disabled at the moment.
-			//
-			// It does work, but it turns out to be slower than working on a single
-			// thread. This is presumably because the threads are writing to widely
-			// different bits of memory and the CPU cache doesn't like it?
-
-			if(i<=2) {
-				// Launch a thread to handle the lower part of the tree,
-				// handle the upper part on the current thread.
-				printf("launch thread for id=%d...\n",LOWER(i));
-
-				remote_args.kd = kd;
-				remote_args.local_root = LOWER(i);
-
-
-				// do lower part on another thread
-				if(pthread_create(&remote_thread, NULL, kdBuildNodeRemote, &remote_args)) {
-					fprintf(stderr,"Threading error");
-					return;
-				}
+		if (!kdSplitNode<T>(kd, local_root))
+			return; // local_root is a leaf
 
-				// do upper part locally
-				kdBuildNode(kd,UPPER(i));
+		remote_args.kd = kd;
+		remote_args.local_root = LOWER(local_root);
+		remote_args.nThreads = nThreads/2;
 
+		launched = (pthread_create(&remote_thread, NULL, kdBuildNodeRemote<T>, &remote_args)==0);
+		if (!launched)
+			kdBuildNode<T>(kd, LOWER(local_root));
 
-				printf("join...");
-				if(pthread_join(remote_thread,NULL)) {
-					fprintf(stderr,"Threading error");
-					return;
-				}
+		kdBuildNodeThreaded<T>(kd, UPPER(local_root), nThreads - nThreads/2);
+
+		if (launched)
+			pthread_join(remote_thread, NULL);
+		return;
+	}
+#endif
+	kdBuildNode<T>(kd, local_root);
+}
 
-				// at this point, we've finished processing this node and all subnodes,
-				// so continue back up the tree
+template <typename T>
+int kdSplitNode(KD kd, int i) {
+	// Split node i about the median particle along its longest dimension and
+	// set up its two children, returning 1. If the node is not to be split,
+	// mark it as a leaf and return 0.
+
+	int d,j,m,diff;
+	KDN *nodes;
+	nodes = kd->kdNodes;
 
-				SETNEXT(i,local_root);
+	assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
+	if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
 
-			} else{
-				// Continue processing on these threads
-				// Next cell is the lower one. Upper one will be processed
-				// on the way up.
-				i = LOWER(i);
+		// Select splitting dimensions on the basis of keeping things
+		// as square as possible
+		d = 0;
+		for (j=1;j<3;++j) {
+			if (nodes[i].bnd.fMax[j]-nodes[i].bnd.fMin[j] >
+				nodes[i].bnd.fMax[d]-nodes[i].bnd.fMin[d]) d = j;
 			}
+		nodes[i].iDim = d;
+
+		// Find mid-point of particle list at which splitting will
+		// ultimately take place
+		m = (nodes[i].pLower + nodes[i].pUpper)/2;
+
+		// Sort list to ensure particles between lower and m are to
+		// the 'left' of particles between m and upper
+		kdSelect<T>(kd,d,m,nodes[i].pLower,nodes[i].pUpper);
+
+		// Note split point based on median particle
+		nodes[i].fSplit = GET2<T>(kd->pNumpyPos,kd->p[m].iOrder,d);
+
+		// Set up lower cell
+		nodes[LOWER(i)].bnd = nodes[i].bnd;
+		nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
+		nodes[LOWER(i)].pLower = nodes[i].pLower;
+		nodes[LOWER(i)].pUpper = m;
+
+		// Set up upper cell
+		nodes[UPPER(i)].bnd = nodes[i].bnd;
+		nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
+		nodes[UPPER(i)].pLower = m+1;
+		nodes[UPPER(i)].pUpper = nodes[i].pUpper;
+		diff = (m-nodes[i].pLower+1)-(nodes[i].pUpper-m);
+		assert(diff == 0 || diff == 1);
+		return 1;
+	} else {
+		// Cell does not need to be split. Mark as leaf
+		nodes[i].iDim = -1;
+		return 0;
+	}
+}
 
-#else
-	// On single thread, always switch attention to the lower branch
-			// (and upper branch gets processed on way up).
-		i = LOWER(i);
-#endif
+template <typename T>
+void kdBuildNode(KD kd, int local_root) {
 
-		} else {
-			// Cell does not need to be split. Mark as leaf
-			nodes[i].iDim = -1;
+	int i=local_root;
 
+	while (1) {
+		if (kdSplitNode<T>(kd, i)) {
+			// Always switch attention to the lower branch (and upper branch
+			// gets processed on way up).
+			i = LOWER(i);
+		} else {
 			// Go back up the tree and process the UPPER cells where
 			// necessary
 			SETNEXT(i,local_root);
@@ -317,10 +365,16 @@ template
 void kdUpPass<double>(KD kd,int iCell);
 
 template
-void kdBuildTree<double>(KD kd);
+void kdUpPassThreaded<double>(KD kd,int iCell,int nThreads);
 
 template
-void kdBuildNodeRemote<double>(struct KDargs *a);
+void kdBuildTree<double>(KD kd,int nThreads);
+
+template
+int kdSplitNode<double>(KD kd, int i);
+
+template
+void kdBuildNodeThreaded<double>(KD kd, int local_root, int nThreads);
 
 template
 void kdBuildNode<double>(KD kd, int local_root);
@@ -334,10 +388,16 @@ template
 void kdUpPass<float>(KD kd,int iCell);
 
 template
-void kdBuildTree<float>(KD kd);
+void kdUpPassThreaded<float>(KD kd,int iCell,int nThreads);
+
+template
+void kdBuildTree<float>(KD kd,int nThreads);
+
+template
+int kdSplitNode<float>(KD kd, int i);
 
 template
-void kdBuildNodeRemote<float>(struct KDargs *a);
+void kdBuildNodeThreaded<float>(KD kd, int local_root, int nThreads);
 
 template
 void kdBuildNode<float>(KD kd, int local_root);
@@ -45,6 +45,14 @@ typedef struct kdNode {
 	int pUpper;
 	} KDN;
 
+/*
+ ** A user-supplied operator, called for each particle being smoothed with
+ ** (data, particle index, smoothing length, number of neighbours,
+ ** neighbour indices, squared neighbour distances). Indices refer to the
+ ** original order of the particles.
+ */
+typedef void (*EXTERNAL_FN)(void *, int, double, int, const int *, const float *);
+
 typedef struct kdContext {
 	int nBucket;
 	int nParticles;
@@ -65,6 +73,10 @@ typedef struct kdContext {
 	PyObject *pNumpyDen;  // Nx1 Numpy array of density
 	PyObject *pNumpyQty;  // Nx1 Numpy array of density
 	PyObject *pNumpyQtySmoothed;  // Nx1 Numpy array of density
+	PyObject *pNumpyNSmooth;  // Nx1 Numpy int32 array of per-particle neighbour numbers, or NULL
+
+	EXTERNAL_FN pExternalFn;  // operator for PROPID_EXTERNAL
+	void *pExternalData;
 	} * KD;
 
 
@@ -169,12 +181,25 @@ int kdReadTipsy(KD,FILE *,int,int,int,int);
 void kdInMark(KD,char *);
 
 template<typename T>
-void kdBuildTree(KD);
+void kdBuildTree(KD, int nThreads);
 void kdOrder(KD);
+void kdCountNodes(KD);
 void kdFinish(KD);
 
 template<typename T>
 void kdBuildNode(KD, int);
+
+template<typename T>
+int kdSplitNode(KD, int);
+
+template<typename T>
+void kdBuildNodeThreaded(KD, int, int);
+
+template<typename T>
+void kdUpPass(KD, int);
+
+template<typename T>
+void kdUpPassThreaded(KD, int, int);
 void kdCombine(KDN *p1,KDN *p2,KDN *pOut);
 
 
@@ -10,6 +10,7 @@
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#include <vector>
 
 #include "kd.h"
 #include "smooth.h"
@@ -42,6 +43,8 @@ long total_alloc = 0;
 /*==========================================================================*/
 
 PyObject *kdinit(PyObject *self, PyObject *args);
+PyObject *kdinit_from_state(PyObject *self, PyObject *args);
+PyObject *kdget_state(PyObject *self, PyObject *args);
 PyObject *kdfree(PyObject *self, PyObject *args);
 
 PyObject *nn_start(PyObject *self, PyObject *args);
@@ -51,9 +54,13 @@ PyObject *nn_rewind(PyObject *self, PyObject *args);
 
 PyObject *populate(PyObject *self, PyObject *args);
 
+PyObject *nn_query(PyObject *self, PyObject *args);
+PyObject *ball_query(PyObject *self, PyObject *args);
+
 PyObject *domain_decomposition(PyObject *self, PyObject *args);
 PyObject *set_arrayref(PyObject *self, PyObject *args);
 PyObject *get_arrayref(PyObject *self, PyObject *args);
+PyObject *set_operator(PyObject *self, PyObject *args);
 PyObject *has_threading(PyObject *self, PyObject *args);
 
 template<typename T>
@@ -68,11 +75,18 @@ int getBitDepth(PyObject *check);
 #define PROPID_QTYMEAN_ND    4
 #define PROPID_QTYDISP_1D    5
 #define PROPID_QTYDISP_ND    6
+#define PROPID_QTYGRAD_1D    7
+#define PROPID_QTYDIV_ND     8
+#define PROPID_QTYCURL_ND    9
+#define PROPID_EXTERNAL      10
+#define PROPID_HSM_RHO       11
 /*==========================================================================*/
 
 static PyMethodDef kdmain_methods[] =
 {
     {"init", kdinit, METH_VARARGS, "init"},
+    {"init_from_state", kdinit_from_state, METH_VARARGS, "init_from_state"},
+    {"get_state", kdget_state, METH_VARARGS, "get_state"},
     {"free", kdfree, METH_VARARGS, "free"},
 
     {"nn_start",  nn_start,  METH_VARARGS, "nn_start"},
@@ -82,10 +96,14 @@ static PyMethodDef kdmain_methods[] =
 
     {"set_arrayref", set_arrayref, METH_VARARGS, "set_arrayref"},
     {"get_arrayref", get_arrayref, METH_VARARGS, "get_arrayref"},
+    {"set_operator", set_operator, METH_VARARGS, "set_operator"},
     {"domain_decomposition", domain_decomposition, METH_VARARGS, "domain_decomposition"},
 
     {"populate",  populate,  METH_VARARGS, "populate"},
 
+    {"nn_query",   nn_query,   METH_VARARGS, "nn_query"},
+    {"ball_query", ball_query, METH_VARARGS, "ball_query"},
+
     {"has_threading",  has_threading,  METH_VARARGS, "populate"},
 
     {NULL, NULL, 0, NULL}
@@ -108,6 +126,7 @@ PyInit_kdmain(void)
 initkdmain(void)
 #endif
 {
+  import_array();
   #if PY_MAJOR_VERSION>=3
     return PyModule_Create(&ourdef);
   #else
@@ -118,27 +137,20 @@ initkdmain(void)
 PyObject *has_threading(PyObject *self, PyObject *args)
 {
 #ifdef KDT_THREADING
-    return Py_True;
+    Py_RETURN_TRUE;
 #else
-    return Py_False;
+    Py_RETURN_FALSE;
 #endif
 }
 
 
 /*==========================================================================*/
-/* kdinit                                                                   */
+/* kdcreate: common set-up for kdinit and kdinit_from_state                 */
 /*==========================================================================*/
-PyObject *kdinit(PyObject *self, PyObject *args)
+KD kdcreate(PyObject *pos, PyObject *mass, int nBucket, PyObject *order)
 {
-    int nBucket;
     int i;
 
-    PyObject *pos;  // Nx3 Numpy array of positions
-    PyObject *mass; // Nx1 Numpy array of masses
-
-    if (!PyArg_ParseTuple(args, "OOi", &pos, &mass, &nBucket))
-        return NULL;
-
     int bitdepth = getBitDepth(pos);
     if(bitdepth==0) {
         PyErr_SetString(PyExc_ValueError, "Unsupported array dtype for kdtree");
@@ -157,11 +169,37 @@ PyObject *kdinit(PyObject *self, PyObject *args)
         if(checkArray<float>(mass, "mass")) return NULL;
     }
 
+    int nbodies = PyArray_DIM(pos, 0);
+
+    if(order!=NULL && order!=Py_None) {
+        PyArray_Descr *descr = PyArray_DESCR(order);
+        if(descr==NULL || descr->kind!='i' || descr->elsize!=sizeof(int) || !PyArray_ISNOTSWAPPED(order)
+           || PyArray_NDIM(order)!=1 || PyArray_DIM(order,0)!=nbodies) {
+            PyErr_SetString(PyExc_ValueError, "Particle order for kdtree must be a native int32 array with one entry per particle");
+            return NULL;
+        }
+
+        // the order is used to index the particle arrays, so it must be a
+        // permutation of them
+        char *seen = (char *)calloc(nbodies>0?nbodies:1, 1);
+        assert(seen != NULL);
+        for (i=0; i < nbodies; i++) {
+            int j = *((int*)PyArray_GETPTR1(order, i));
+            if(j<0 || j>=nbodies || seen[j]) {
+                free(seen);
+                PyErr_SetString(PyExc_ValueError, "Particle order for kdtree is not a permutation of the particles");
+                return NULL;
+            }
+            seen[j] = 1;
+        }
+        free(seen);
+    } else {
+        order = NULL;
+    }
+
     KD kd = (KD)malloc(sizeof(*kd));
     kdInit(&kd, nBucket);
 
-    int nbodies = PyArray_DIM(pos, 0);
-
     kd->nParticles = nbodies;
     kd->nActive = nbodies;
     kd->nBitDepth = bitdepth;
@@ -171,34 +209,138 @@ PyObject *kdinit(PyObject *self, PyObject *args)
     kd->pNumpyDen = NULL;
     kd->pNumpyQty = NULL;
     kd->pNumpyQtySmoothed = NULL;
+    kd->pNumpyNSmooth = NULL;
+    kd->pExternalFn = NULL;
+    kd->pExternalData = NULL;
 
     Py_INCREF(pos);
     Py_INCREF(mass);
 
-
-    Py_BEGIN_ALLOW_THREADS
-
-
     // Allocate particles
     kd->p = (PARTICLE *)malloc(kd->nActive*sizeof(PARTICLE));
     assert(kd->p != NULL);
 
     for (i=0; i < nbodies; i++)
     {
-        kd->p[i].iOrder = i;
+        kd->p[i].iOrder = (order==NULL)?i:*((int*)PyArray_GETPTR1(order, i));
         kd->p[i].iMark = 1;
     }
 
-    if(bitdepth==64)
-        kdBuildTree<double>(kd);
+    return kd;
+}
+
+/*==========================================================================*/
+/* kdinit                                                                   */
+/*==========================================================================*/
+PyObject *kdinit(PyObject *self, PyObject *args)
+{
+    int nBucket;
+    int nThreads = 1;
+
+    PyObject *pos;  // Nx3 Numpy array of positions
+    PyObject *mass; // Nx1 Numpy array of masses
+
+    if (!PyArg_ParseTuple(args, "OOi|i", &pos, &mass, &nBucket, &nThreads))
+        return NULL;
+
+    if(nThreads<1) {
+        PyErr_SetString(PyExc_ValueError, "Invalid number of threads for kdtree build");
+        return NULL;
+    }
+
+    KD kd = kdcreate(pos, mass, nBucket, NULL);
+    if(kd==NULL) return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    if(kd->nBitDepth==64)
+        kdBuildTree<double>(kd, nThreads);
     else
-        kdBuildTree<float>(kd);
+        kdBuildTree<float>(kd, nThreads);
 
     Py_END_ALLOW_THREADS
 
     return PyCapsule_New((void *)kd, NULL, NULL);
 }
 
+/*==========================================================================*/
+/* kdinit_from_state                                                        */
+/*==========================================================================*/
+PyObject *kdinit_from_state(PyObject *self, PyObject *args)
+{
+    // Recreate a tree from the particle order and node table returned by
+    // get_state, without rebuilding it
+    int nBucket;
+
+    PyObject *pos, *mass, *order, *nodes;
+
+    if (!PyArg_ParseTuple(args, "OOiOO", &pos, &mass, &nBucket, &order, &nodes))
+        return NULL;
+
+    if(order==Py_None) {
+        PyErr_SetString(PyExc_ValueError, "A particle order is required to restore a kdtree");
+        return NULL;
+    }
+
+    PyArray_Descr *descr = PyArray_DESCR(nodes);
+    if(descr==NULL || descr->elsize!=1 || PyArray_NDIM(nodes)!=1 || !PyArray_ISCONTIGUOUS(nodes)) {
+        PyErr_SetString(PyExc_ValueError, "kdtree node table must be a contiguous array of bytes");
+        return NULL;
+    }
+
+    KD kd = kdcreate(pos, mass, nBucket, order);
+    if(kd==NULL) return NULL;
+
+    kdCountNodes(kd);
+    if(PyArray_DIM(nodes,0)!=(npy_intp)kd->nNodes*(npy_intp)sizeof(KDN)) {
+        kdFinish(kd);
+        Py_DECREF(pos);
+        Py_DECREF(mass);
+        PyErr_SetString(PyExc_ValueError, "kdtree node table does not match the number of particles and leaf size");
+        return NULL;
+    }
+
+    kd->kdNodes = (KDN *)malloc(kd->nNodes*sizeof(KDN));
+    assert(kd->kdNodes != NULL);
+    memcpy(kd->kdNodes, PyArray_DATA(nodes), kd->nNodes*sizeof(KDN));
+
+    return PyCapsule_New((void *)kd, NULL, NULL);
+}
+
+/*==========================================================================*/
+/* kdget_state                                                              */
+/*==========================================================================*/
+PyObject *kdget_state(PyObject *self, PyObject *args)
+{
+    // Return the particle order and the raw node table, from which
+    // init_from_state can recreate the tree
+    KD kd;
+    PyObject *kdobj;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O", &kdobj))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    npy_intp nActive = kd->nActive;
+    npy_intp nBytes = (npy_intp)kd->nNodes*(npy_intp)sizeof(KDN);
+
+    PyObject *order = PyArray_SimpleNew(1, &nActive, NPY_INT32);
+    PyObject *nodes = PyArray_SimpleNew(1, &nBytes, NPY_UINT8);
+    if(order==NULL || nodes==NULL) {
+        Py_XDECREF(order);
+        Py_XDECREF(nodes);
+        return NULL;
+    }
+
+    for(i=0; i<kd->nActive; i++)
+        *((int*)PyArray_GETPTR1(order, i)) = kd->p[i].iOrder;
+    memcpy(PyArray_DATA(nodes), kd->kdNodes, nBytes);
+
+    return Py_BuildValue("NN", order, nodes);
+}
+
 /*==========================================================================*/
 /* kdfree                                                                   */
 /*==========================================================================*/
@@ -210,12 +352,15 @@ PyObject *kdfree(PyObject *self, PyObject *args)
     PyArg_ParseTuple(args, "O", &kdobj);
     kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
 
-    kdFinish(kd);
     Py_XDECREF(kd->pNumpyPos);
     Py_XDECREF(kd->pNumpyMass);
     Py_XDECREF(kd->pNumpySmooth);
     Py_XDECREF(kd->pNumpyDen);
-    return Py_None;
+    Py_XDECREF(kd->pNumpyQty);
+    Py_XDECREF(kd->pNumpyQtySmoothed);
+    Py_XDECREF(kd->pNumpyNSmooth);
+    kdFinish(kd);
+    Py_RETURN_NONE;
 }
 
 #define BIGFLOAT ((float)1.0e37)
@@ -239,7 +384,8 @@ PyObject *nn_start(PyObject *self, PyObject *args)
     float hsm;
     float period = BIGFLOAT;
 
-    PyArg_ParseTuple(args, "Oi|f", &kdobj, &nSmooth, &period);
+    if (!PyArg_ParseTuple(args, "Oi|f", &kdobj, &nSmooth, &period))
+        return NULL;
     kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
 
     if(period<=0)
@@ -328,7 +474,7 @@ PyObject *nn_next(PyObject *self, PyObject *args)
         return retList;
     }
 
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
 /*==========================================================================*/
@@ -347,7 +493,7 @@ PyObject *nn_stop(PyObject *self, PyObject *args)
 
     smFinish(smx);
 
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
 /*==========================================================================*/
@@ -410,6 +556,10 @@ int checkArray(PyObject *check, const char* name) {
     PyErr_Format(PyExc_TypeError, "Incorrect numpy data type for %s passed to kdtree - must match C %s",name,c_name<T>());
     return 1;
   }
+  if(!PyArray_ISNOTSWAPPED(check)) {
+    PyErr_Format(PyExc_TypeError, "Array %s passed to kdtree must be in native byte order",name);
+    return 1;
+  }
   return 0;
 
 }
@@ -426,6 +576,7 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
     const char *name2="mass";
     const char *name3="qty";
     const char *name4="qty_sm";
+    const char *name5="nsmooth";
 
     const char *name;
 
@@ -456,11 +607,34 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
         existing = &(kd->pNumpyQtySmoothed);
         name = name4;
         break;
+    case 5:
+        existing = &(kd->pNumpyNSmooth);
+        name = name5;
+        break;
     default:
         PyErr_SetString(PyExc_ValueError, "Unknown array to set for KD tree");
         return NULL;
     }
 
+    if(arid==5) {
+        // per-particle neighbour numbers are optional; None removes them
+        if(arobj==Py_None) {
+            Py_XDECREF(*existing);
+            (*existing) = NULL;
+            Py_RETURN_NONE;
+        }
+        PyArray_Descr *descr = PyArray_DESCR(arobj);
+        if(descr==NULL || descr->kind!='i' || descr->elsize!=sizeof(int) || !PyArray_ISNOTSWAPPED(arobj)
+           || PyArray_NDIM(arobj)!=1 || PyArray_DIM(arobj,0)!=PyArray_DIM(kd->pNumpyPos,0)) {
+            PyErr_SetString(PyExc_ValueError, "Array nsmooth for kdtree must be a native int32 array with one entry per particle");
+            return NULL;
+        }
+        Py_XDECREF(*existing);
+        (*existing) = arobj;
+        Py_INCREF(arobj);
+        Py_RETURN_NONE;
+    }
+
     int bitdepth=0;
     if(arid<=2)
         bitdepth=kd->nBitDepth;
@@ -479,7 +653,7 @@ PyObject *set_arrayref(PyObject *self, PyObject *args) {
     Py_XDECREF(*existing);
     (*existing) = arobj;
     Py_INCREF(arobj);
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
 PyObject *get_arrayref(PyObject *self, PyObject *args) {
@@ -507,18 +681,37 @@ PyObject *get_arrayref(PyObject *self, PyObject *args) {
     case 4:
         existing = &(kd->pNumpyQtySmoothed);
         break;
+    case 5:
+        existing = &(kd->pNumpyNSmooth);
+        break;
     default:
         PyErr_SetString(PyExc_ValueError, "Unknown array to get from KD tree");
         return NULL;
     }
 
+    if(*existing==NULL)
+        Py_RETURN_NONE;
+
     Py_INCREF(*existing);
+    return (*existing);
 
-    if(*existing==NULL)
-        return Py_None;
-    else
-        return (*existing);
+}
+
+PyObject *set_operator(PyObject *self, PyObject *args) {
+    // Set the operator used by PROPID_EXTERNAL, from the addresses of a
+    // native function with the EXTERNAL_FN signature and of its data
+    PyObject *kdobj;
+    unsigned long long fn, data;
+    KD kd;
+
+    if (!PyArg_ParseTuple(args, "OKK", &kdobj, &fn, &data))
+        return NULL;
+    kd  = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
 
+    kd->pExternalFn = (EXTERNAL_FN)(size_t)fn;
+    kd->pExternalData = (void *)(size_t)data;
+    Py_RETURN_NONE;
 }
 
 PyObject *domain_decomposition(PyObject *self, PyObject *args) {
@@ -547,7 +740,7 @@ PyObject *domain_decomposition(PyObject *self, PyObject *args) {
     else
         smDomainDecomposition<double>(kd,nproc);
 
-    return Py_None;
+    Py_RETURN_NONE;
 }
 
 template<typename Tf, typename Tq>
@@ -578,13 +771,21 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
 
 
     if (checkArray<Tf>(kd->pNumpySmooth,"smooth")) return NULL;
-    if(propid>PROPID_HSM) {
-      if (checkArray<Tf>(kd->pNumpyDen,"rho")) return NULL;
-      if (checkArray<Tf>(kd->pNumpyMass,"mass")) return NULL;
-    }
-    if(propid>PROPID_RHO) {
-        if (checkArray<Tq>(kd->pNumpyQty,"qty")) return NULL;
-        if (checkArray<Tq>(kd->pNumpyQtySmoothed,"qty_sm")) return NULL;
+    if(propid==PROPID_EXTERNAL) {
+      // the operator reads and writes its own arrays
+      if (kd->pExternalFn==NULL) {
+        PyErr_SetString(PyExc_ValueError, "No smoothing operator has been set for kdtree");
+        return NULL;
+      }
+    } else {
+      if(propid>PROPID_HSM) {
+        if (checkArray<Tf>(kd->pNumpyDen,"rho")) return NULL;
+        if (checkArray<Tf>(kd->pNumpyMass,"mass")) return NULL;
+      }
+      if(propid>PROPID_RHO && propid!=PROPID_HSM_RHO) {
+          if (checkArray<Tq>(kd->pNumpyQty,"qty")) return NULL;
+          if (checkArray<Tq>(kd->pNumpyQtySmoothed,"qty_sm")) return NULL;
+      }
     }
 
 #ifdef KDT_THREADING
@@ -617,10 +818,51 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
         case PROPID_QTYDISP_1D:
             pSmFn = &smDispQty1D<Tf,Tq>;
             break;
+        case PROPID_QTYGRAD_1D:
+            pSmFn = &smGradQty1D<Tf,Tq>;
+            break;
+        case PROPID_QTYDIV_ND:
+            pSmFn = &smDivQtyND<Tf,Tq>;
+            break;
+        case PROPID_QTYCURL_ND:
+            pSmFn = &smCurlQtyND<Tf,Tq>;
+            break;
+        case PROPID_EXTERNAL:
+            pSmFn = &smExternal<Tf>;
+            break;
     }
 
 
-    if(propid==PROPID_HSM)
+    if((propid==PROPID_HSM || propid==PROPID_HSM_RHO) && kd->pNumpyNSmooth!=NULL)
+    {
+      // each particle has its own number of neighbours, so the queue left
+      // by one particle cannot seed the next; search for each afresh
+      int nSmooth;
+
+      i=smGetNext(smx_local);
+
+      Py_BEGIN_ALLOW_THREADS
+      while(i<nbodies)
+        {
+            for(int j=0; j<3; ++j) {
+              ri[j] = GET2<Tf>(kd->pNumpyPos,kd->p[i].iOrder,j);
+            }
+
+            nSmooth = GET<int>(kd->pNumpyNSmooth,kd->p[i].iOrder);
+            if(nSmooth<1) nSmooth=1;
+            if(nSmooth>smx_local->nSmooth) nSmooth=smx_local->nSmooth;
+
+            nCnt = smNearestNeighbours<Tf>(smx_local,ri,nSmooth);
+            SETSMOOTH(Tf,i,0.5*sqrt(smx_local->fList[nCnt-1]));
+
+            if(propid==PROPID_HSM_RHO)
+              smDensity<Tf>(smx_local, i, nCnt, smx_local->pList, smx_local->fList);
+
+            i=smGetNext(smx_local);
+        }
+      Py_END_ALLOW_THREADS
+
+    } else if(propid==PROPID_HSM || propid==PROPID_HSM_RHO)
     {
           Py_BEGIN_ALLOW_THREADS
             for (i=0; i < nbodies; i++)
@@ -628,6 +870,12 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
                 nCnt = smSmoothStep<Tf>(smx_local, procid);
                 if(nCnt==-1)
                   break; // nothing more to do
+
+                // the neighbours found for the smoothing length are
+                // exactly those needed for the density
+                if(propid==PROPID_HSM_RHO)
+                  smDensity<Tf>(smx_local, smx_local->pi, nCnt, smx_local->pList, smx_local->fList);
+
                 total_particles+=1;
               }
           Py_END_ALLOW_THREADS
@@ -673,7 +921,7 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
 #ifdef KDT_THREADING
     smFinishThreadLocalCopy(smx_local);
 #endif
-    return Py_None;
+    Py_RETURN_NONE;
   }
 
 }
@@ -711,3 +959,149 @@ PyObject *populate(PyObject *self, PyObject *args)
         return NULL;
     }
 }
+
+
+/*==========================================================================*/
+/* nn_query, ball_query: neighbours of arbitrary points                     */
+/*==========================================================================*/
+
+template<typename T>
+PyObject *typed_query(KD kd, PyObject *points, int nSmooth, float fBall2, float *fPeriod)
+{
+    // Find the nSmooth nearest neighbours of each point or, if nSmooth is
+    // zero, all particles within sqrt(fBall2) of each point. The result is
+    // returned in compressed sparse row form: (offsets, indices, squared
+    // distances), where the neighbours of point i are entries
+    // offsets[i]:offsets[i+1] of the other two arrays.
+    SMX smx;
+    npy_intp i, nPoints = PyArray_DIM(points, 0);
+    int j, nCnt;
+    float ri[3];
+
+    if(!smInit(&smx, kd, nSmooth>0?nSmooth:1, fPeriod)) {
+        PyErr_SetString(PyExc_RuntimeError, "Unable to create smoothing context");
+        return NULL;
+    }
+    smSmoothInitStep(smx, 1);
+
+    // overflowing gathers are repeated with larger lists below, so the
+    // warning printed by smBallGather is not wanted
+    smx->warnings = true;
+
+    std::vector<npy_int64> offsets(nPoints+1);
+    std::vector<int> indices;
+    std::vector<float> dist2;
+
+    offsets[0] = 0;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    for(i=0; i<nPoints; i++) {
+        for(j=0; j<3; j++)
+            ri[j] = *((double*)PyArray_GETPTR2(points, i, j));
+
+        if(nSmooth>0) {
+            nCnt = smNearestNeighbours<T>(smx, ri, nSmooth);
+        } else {
+            while((nCnt = smBallGather<T>(smx, fBall2, ri)) >= smx->nListSize)
+                smGrowLists(smx, 2*smx->nListSize);
+        }
+
+        for(j=0; j<nCnt; j++) {
+            indices.push_back(kd->p[smx->pList[j]].iOrder);
+            dist2.push_back(smx->fList[j]);
+        }
+        offsets[i+1] = indices.size();
+    }
+
+    Py_END_ALLOW_THREADS
+
+    smFinish(smx);
+
+    npy_intp nOffsets = nPoints+1;
+    npy_intp nTotal = indices.size();
+
+    PyObject *pyOffsets = PyArray_SimpleNew(1, &nOffsets, NPY_INT64);
+    PyObject *pyIndices = PyArray_SimpleNew(1, &nTotal, NPY_INT32);
+    PyObject *pyDist2 = PyArray_SimpleNew(1, &nTotal, NPY_FLOAT32);
+    if(pyOffsets==NULL || pyIndices==NULL || pyDist2==NULL) {
+        Py_XDECREF(pyOffsets);
+        Py_XDECREF(pyIndices);
+        Py_XDECREF(pyDist2);
+        return NULL;
+    }
+
+    memcpy(PyArray_DATA(pyOffsets), &offsets[0], nOffsets*sizeof(npy_int64));
+    if(nTotal>0) {
+        memcpy(PyArray_DATA(pyIndices), &indices[0], nTotal*sizeof(int));
+        memcpy(PyArray_DATA(pyDist2), &dist2[0], nTotal*sizeof(float));
+    }
+
+    return Py_BuildValue("NNN", pyOffsets, pyIndices, pyDist2);
+}
+
+PyObject *query(PyObject *kdobj, PyObject *points, int nSmooth, float fBall2, float period)
+{
+    KD kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(checkArray<double>(points, "points")) return NULL;
+    if(PyArray_NDIM(points)!=2 || PyArray_DIM(points,1)!=3) {
+        PyErr_SetString(PyExc_ValueError, "Query points must be an Nx3 array");
+        return NULL;
+    }
+
+    if(nSmooth>kd->nActive) {
+        PyErr_SetString(PyExc_ValueError, "Number of neighbours requested exceeds number of particles in tree");
+        return NULL;
+    }
+
+    if(period<=0)
+        period = BIGFLOAT;
+
+    float fPeriod[3] = {period, period, period};
+
+    if(!smCheckFits(kd, fPeriod)) {
+        PyErr_SetString(PyExc_ValueError, "The particles span a region larger than the specified boxsize");
+        return NULL;
+    }
+
+    if(kd->nBitDepth==64)
+        return typed_query<double>(kd, points, nSmooth, fBall2, fPeriod);
+    else
+        return typed_query<float>(kd, points, nSmooth, fBall2, fPeriod);
+}
+
+PyObject *nn_query(PyObject *self, PyObject *args)
+{
+    PyObject *kdobj, *points;
+    int nSmooth;
+    float period = BIGFLOAT;
+
+    if (!PyArg_ParseTuple(args, "OOi|f", &kdobj, &points, &nSmooth, &period))
+        return NULL;
+
+    if(nSmooth<1) {
+        PyErr_SetString(PyExc_ValueError, "At least one neighbour must be requested");
+        return NULL;
+    }
+
+    return query(kdobj, points, nSmooth, 0.0, period);
+}
+
+PyObject *ball_query(PyObject *self, PyObject *args)
+{
+    PyObject *kdobj, *points;
+    float radius;
+    float period = BIGFLOAT;
+
+    if (!PyArg_ParseTuple(args, "OOf|f", &kdobj, &points, &radius, &period))
+        return NULL;
+
+    if(radius<0) {
+        PyErr_SetString(PyExc_ValueError, "Search radius must not be negative");
+        return NULL;
+    }
+
+    return query(kdobj, points, 0, radius*radius, period);
+}
@@ -9,6 +9,7 @@ Provides access to nearest neighbour lists and smoothing lengths.
 from . import kdmain
 from .. import config
 from .. import array as ar
+from .. import util
 import numpy as np
 import time
 import logging
@@ -17,6 +18,43 @@ import warnings
 
 logger = logging.getLogger('pynbody.sph.kdtree')
 
+_external_operators = {}
+
+# the layout of a node (KDN in kd.h) in the table returned by kdmain.get_state
+_node_dtype = np.dtype([('fSplit', np.float32), ('fMin', np.float32, 3), ('fMax', np.float32, 3),
+                        ('iDim', np.int32), ('pLower', np.int32), ('pUpper', np.int32)])
+
+
+def register_smoothing_operator(name, function, data=0):
+    """Register a native operator which :meth:`KDTree.populate` can apply
+    to every particle under the given *name*.
+
+    *function* is the address of a C-callable function with the signature
+
+     void operator(void *data, int i, double h, int n, const int *neighbours, const float *r2)
+
+    It is called for each particle *i* with its smoothing length *h* and
+    the *n* particles within 2h, given as indices in *neighbours* and
+    squared distances in *r2*. All particle indices refer to the arrays
+    from which the tree was built. *data* is the address of whatever the
+    operator needs to read and write its results, and is passed through
+    unchanged. The address may be obtained from e.g. a Cython ``cdef``
+    function, a ctypes or cffi callback, or the ``address`` of a numba
+    ``cfunc``.
+
+    The operator runs on several threads at once without holding the GIL,
+    and must only write to the entry for particle *i* of its outputs. The
+    ``smooth`` array must be set on the tree before populating."""
+
+    if name in ("hsm", "rho", "hsm_rho", "qty_mean", "qty_disp", "qty_grad", "qty_div", "qty_curl"):
+        raise ValueError, "%r is the name of a built-in smoothing operation" % name
+    _external_operators[name] = (int(function), int(data))
+
+
+def unregister_smoothing_operator(name):
+    """Remove an operator registered by :func:`register_smoothing_operator`"""
+    del _external_operators[name]
+
 
 class KDTree(object):
     PROPID_HSM = 1
@@ -25,13 +63,124 @@ class KDTree(object):
     PROPID_QTYMEAN_ND = 4
     PROPID_QTYDISP_1D = 5
     PROPID_QTYDISP_ND = 6
+    PROPID_QTYGRAD_1D = 7
+    PROPID_QTYDIV_ND = 8
+    PROPID_QTYCURL_ND = 9
+    PROPID_EXTERNAL = 10
+    PROPID_HSM_RHO = 11
+
+    def __init__(self, pos, mass, leafsize=32, boxsize=None, num_threads=None, float32=False):
+        """Build a tree for the particles with the given positions and masses.
+
+        If *float32* is True, a tree for double precision particles is
+        built on a single precision copy of their positions, relative to
+        the centre of the particles, halving the memory read by neighbour
+        searches. The smoothing length, density and mass arrays then keep
+        their precision: the tree works on single precision copies of them,
+        copying results back after each :meth:`populate`."""
+
+        if num_threads is None:
+            num_threads = config['number_of_threads']
+
+        if kdmain.has_threading() is False:
+            num_threads = 1
+
+        origin = None
+        if float32 and pos.dtype != np.float32:
+            origin = (np.asarray(pos.min(axis=0), dtype=np.float64) +
+                      np.asarray(pos.max(axis=0), dtype=np.float64)) / 2
+        pos, mass = self._tree_arrays(pos, mass, origin)
+
+        # the top levels of the tree are split between threads; the resulting
+        # tree is identical whatever the number of threads
+        start = time.time()
+        self.kdtree = kdmain.init(pos, mass, int(leafsize), max(1, int(num_threads)))
+        end = time.time()
+        logger.info("KDTree of %d particles built on %d thread(s) in %5.3g s",
+                    len(pos), max(1, int(num_threads)), end - start)
+
+        self._setup(pos, mass, leafsize, boxsize, origin)
 
-    def __init__(self, pos, mass, leafsize=32, boxsize=None):
-        self.kdtree = kdmain.init(pos, mass, int(leafsize))
+    @staticmethod
+    def _tree_arrays(pos, mass, origin):
+        """Return the positions and masses from which to build the tree: the
+        given ones or, if *origin* is not None, single precision copies with
+        positions relative to *origin*"""
+        if origin is None:
+            return pos, mass
+        return ((pos - origin).astype(np.float32).view(np.ndarray),
+                np.asarray(mass, dtype=np.float32))
+
+    def _setup(self, pos, mass, leafsize, boxsize, origin=None):
         self.derived = True
+        self.leafsize = int(leafsize)
+        if boxsize is None:
+            boxsize = -1.0 # represents infinite box
         self.boxsize=boxsize
         self.s_len = len(pos)
         self.flags = {'WRITEABLE': False}
+        self._pos = pos
+        self._mass = mass
+        self._origin = origin
+        # arrays of the particles' own precision, for which the tree holds
+        # single precision copies
+        self._targets = {}
+
+    @classmethod
+    def from_state(cls, pos, mass, state, boxsize=None):
+        """Recreate a tree, without rebuilding it, from the *state* returned by
+        :meth:`get_state` for a tree of particles with the same positions"""
+        self = cls.__new__(cls)
+        origin = state.get('origin', None)
+        pos, mass = self._tree_arrays(pos, mass, origin)
+        self.kdtree = kdmain.init_from_state(pos, mass, int(state['leafsize']),
+                                             np.ascontiguousarray(state['order'], dtype=np.int32),
+                                             np.ascontiguousarray(state['nodes'], dtype=np.uint8))
+        self._setup(pos, mass, state['leafsize'], boxsize, origin)
+        return self
+
+    def get_state(self):
+        """Return a dictionary of arrays from which :meth:`from_state` can
+        recreate this tree: the order of the particles within the tree,
+        the raw table of nodes, the leaf size and, for a single precision
+        tree of double precision particles, the origin of its positions"""
+        order, nodes = kdmain.get_state(self.kdtree)
+        state = {'order': order, 'nodes': nodes, 'leafsize': np.array(self.leafsize)}
+        if self._origin is not None:
+            state['origin'] = self._origin
+        return state
+
+    def save(self, filename):
+        """Save the tree structure to *filename*, from which :meth:`load` can
+        recreate it for the same particles without rebuilding it"""
+        state = self.get_state()
+        np.savez(filename, npart=self.s_len, **state)
+
+    @classmethod
+    def load(cls, filename, pos, mass, boxsize=None):
+        """Recreate a tree saved by :meth:`save` for the particles with
+        positions *pos* and masses *mass*. These must be the same particles,
+        in the same positions, as when the tree was saved."""
+        data = np.load(filename)
+        try:
+            if int(data['npart']) != len(pos):
+                raise ValueError, "Saved KDTree is for a different number of particles"
+            state = dict([(k, data[k]) for k in ('order', 'nodes', 'leafsize', 'origin') if k in data.files])
+        finally:
+            data.close()
+        return cls.from_state(pos, mass, state, boxsize)
+
+    def __getstate__(self):
+        state = self.get_state()
+        state.update(pos=self._pos, mass=self._mass, boxsize=self.boxsize)
+        return state
+
+    def __setstate__(self, state):
+        # the positions and masses stored are those of the tree itself
+        self.kdtree = kdmain.init_from_state(state['pos'], state['mass'], int(state['leafsize']),
+                                             state['order'], state['nodes'])
+        self._setup(state['pos'], state['mass'], state['leafsize'], state['boxsize'],
+                    state.get('origin', None))
 
     def nn(self, nn=None):
         if nn is None:
@@ -50,6 +199,108 @@ class KDTree(object):
     def all_nn(self, nn=None):
         return [x for x in self.nn(nn)]
 
+    def _query(self, function, points, param, num_threads):
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape((-1, 3))
+        if self._origin is not None:
+            points = points - self._origin
+
+        if num_threads is None:
+            num_threads = config['number_of_threads']
+
+        # each thread searches a contiguous block of the points with its
+        # own smoothing context; the tree itself is only read
+        num_threads = max(1, min(int(num_threads), len(points) // 1000))
+        bounds = np.linspace(0, len(points), num_threads + 1).astype(int)
+
+        results = [None] * num_threads
+
+        def run(i):
+            results[i] = function(self.kdtree, points[bounds[i]:bounds[i + 1]], param, float(self.boxsize))
+
+        if num_threads == 1:
+            run(0)
+        else:
+            from . import _thread_map
+            _thread_map(run, range(num_threads))
+
+        offsets = [results[0][0]]
+        for i in xrange(1, num_threads):
+            offsets.append(results[i][0][1:] + offsets[-1][-1])
+
+        offsets = np.concatenate(offsets)
+        indices = np.concatenate([r[1] for r in results])
+        distances = np.sqrt(np.concatenate([r[2] for r in results]))
+        return offsets, indices, distances
+
+    def query(self, points, k=1, num_threads=None):
+        """Find the *k* nearest particles to each of the given points.
+
+        *points* is an Nx3 array in the same units as the positions from
+        which the tree was built. The search respects the periodic *boxsize*
+        of the tree, if any.
+
+        Returns (offsets, indices, distances) in compressed sparse row form: the
+        neighbours of point i are indices[offsets[i]:offsets[i+1]] (offsets
+        into the tree's particle arrays), at the corresponding distances, in
+        order of increasing distance.
+
+        The points are divided between *num_threads* threads (default
+        taken from the configuration), which search without holding the GIL."""
+        return self._query(kdmain.nn_query, points, int(k), num_threads)
+
+    def query_ball(self, points, r, num_threads=None):
+        """Find all particles within distance *r* of each of the given points.
+
+        The arguments and return value are as for :meth:`query`, except
+        that the neighbours of each point are in no particular order."""
+        return self._query(kdmain.ball_query, points, float(r), num_threads)
+
+    def particles_in_box(self, lower, upper, reach=None):
+        """Return the indices, in increasing order, of the particles which
+        may lie within the box with corners *lower* and *upper* (which may
+        be infinite along an axis), or within *reach* of it if this array
+        of per-particle distances is given. *lower* and *upper* may also
+        be Nx3 arrays of the corners of several boxes, in which case the
+        particles within any of them are returned.
+
+        Whole leaves of the tree are accepted or rejected using their
+        bounding boxes, so some particles outside the box are included;
+        none inside it are left out."""
+
+        order, nodes = kdmain.get_state(self.kdtree)
+        nodes = np.frombuffer(nodes, dtype=_node_dtype)
+
+        # descend the tree a level at a time to find its leaves, which
+        # are not all on the lowest level
+        leaves = []
+        level = np.array([1])
+        while len(level) > 0:
+            is_leaf = nodes['iDim'][level] == -1
+            leaves.append(level[is_leaf])
+            split = level[~is_leaf]
+            level = np.concatenate((2 * split, 2 * split + 1))
+        leaves = nodes[np.concatenate(leaves)]
+        leaves = leaves[np.argsort(leaves['pLower'])]
+
+        leaf_lower = leaves['fMin'].astype(np.float64)
+        leaf_upper = leaves['fMax'].astype(np.float64)
+        if self._origin is not None:
+            leaf_lower += self._origin
+            leaf_upper += self._origin
+
+        if reach is not None:
+            leaf_reach = np.maximum.reduceat(np.asarray(reach)[order], leaves['pLower'])
+            leaf_lower -= leaf_reach[:, np.newaxis]
+            leaf_upper += leaf_reach[:, np.newaxis]
+
+        lower = np.asarray(lower, dtype=np.float64).reshape((-1, 3))
+        upper = np.asarray(upper, dtype=np.float64).reshape((-1, 3))
+        overlaps = np.zeros(len(leaves), dtype=bool)
+        for box_lower, box_upper in zip(lower, upper):
+            overlaps |= ((leaf_upper >= box_lower) & (leaf_lower <= box_upper)).all(axis=1)
+        selected = np.repeat(overlaps, leaves['pUpper'] - leaves['pLower'] + 1)
+        return np.sort(order[selected])
+
     @staticmethod
     def array_name_to_id(name):
         if name=="smooth":
@@ -62,10 +313,16 @@ class KDTree(object):
             return 3
         elif name=="qty_sm":
             return 4
+        elif name=="nsmooth":
+            return 5
         else :
             raise ValueError, "Unknown KDTree array"
 
     def set_array_ref(self, name, ar) :
+        self._targets.pop(name, None)
+        if self._origin is not None and name in ('smooth', 'rho', 'mass') and ar.dtype != np.float32:
+            self._targets[name] = ar
+            ar = np.ascontiguousarray(ar, dtype=np.float32)
         kdmain.set_arrayref(self.kdtree,self.array_name_to_id(name),ar)
         assert self.get_array_ref(name) is ar
 
@@ -76,6 +333,9 @@ class KDTree(object):
     def smooth_operation_to_id(self,name):
         if name=="hsm":
             return self.PROPID_HSM
+        elif name=="hsm_rho":
+            # smoothing lengths and densities from a single neighbour search
+            return self.PROPID_HSM_RHO
         elif name=="rho":
             return self.PROPID_RHO
         elif name=="qty_mean":
@@ -83,23 +343,48 @@ class KDTree(object):
             if len(input_array.shape)==1:
                 return self.PROPID_QTYMEAN_1D
             elif len(input_array.shape)==2:
-                if input_array.shape[1]!=3:
-                    raise ValueError, "Currently only able to smooth 3D or 1D arrays"
                 return self.PROPID_QTYMEAN_ND
+            else:
+                raise ValueError, "Can only smooth 1D or 2D arrays; reshape others to 2D first"
         elif name=="qty_disp":
+            # for a 2D quantity, a 1D output receives the dispersion over all
+            # components, and a 2D output the variance of each component
             input_array = self.get_array_ref('qty')
             if len(input_array.shape)==1:
                 return self.PROPID_QTYDISP_1D
             elif len(input_array.shape)==2:
-                if input_array.shape[1]!=3:
-                    raise ValueError, "Currently only able to smooth 3D or 1D arrays"
                 return self.PROPID_QTYDISP_ND
+            else:
+                raise ValueError, "Can only smooth 1D or 2D arrays; reshape others to 2D first"
+        elif name=="qty_grad":
+            if len(self.get_array_ref('qty').shape)!=1:
+                raise ValueError, "Can only take the gradient of 1D arrays"
+            return self.PROPID_QTYGRAD_1D
+        elif name in ("qty_div", "qty_curl"):
+            input_array = self.get_array_ref('qty')
+            if len(input_array.shape)!=2 or input_array.shape[1]!=3:
+                raise ValueError, "Can only take the divergence or curl of 3D arrays"
+            if name=="qty_div":
+                return self.PROPID_QTYDIV_ND
+            else:
+                return self.PROPID_QTYCURL_ND
+        elif name in _external_operators:
+            kdmain.set_operator(self.kdtree, *_external_operators[name])
+            return self.PROPID_EXTERNAL
         else:
             raise ValueError, "Unknown smoothing request %s"%name
 
 
 
     def populate(self, mode, nn):
+        """Calculate a property of every particle by smoothing over its
+        neighbours, as named by *mode* (see :meth:`smooth_operation_to_id`).
+
+        *nn* is the number of neighbours to use. For the smoothing
+        length modes ``hsm`` and ``hsm_rho`` it may instead be an array
+        giving the number of neighbours for each particle. The other modes
+        gather all particles within twice the smoothing length, and only
+        use *nn* to size their buffers."""
         from . import _thread_map
 
         n_proc=config['number_of_threads']
@@ -111,11 +396,27 @@ class KDTree(object):
         if nn is None:
             nn = 64
 
-        smx = kdmain.nn_start(self.kdtree, int(nn), self.boxsize)
-
         propid = self.smooth_operation_to_id(mode)
+        smoothing_lengths = propid in (self.PROPID_HSM, self.PROPID_HSM_RHO)
+
+        if np.isscalar(nn):
+            per_particle = None
+            nn = int(nn)
+        else:
+            per_particle = np.ascontiguousarray(nn, dtype=np.int32)
+            nn = int(per_particle.max())
+
+        if smoothing_lengths:
+            self.set_array_ref('nsmooth', per_particle)
+            self._max_nsmooth = nn
+        else:
+            # gathers within smoothing lengths found for larger numbers of
+            # neighbours return more particles
+            nn = max(nn, getattr(self, '_max_nsmooth', 0))
 
-        if propid==self.PROPID_HSM:
+        smx = kdmain.nn_start(self.kdtree, nn, self.boxsize)
+
+        if smoothing_lengths and per_particle is None:
             kdmain.domain_decomposition(self.kdtree,n_proc)
 
         if n_proc==1 :
@@ -125,9 +426,71 @@ class KDTree(object):
 
         kdmain.nn_stop(self.kdtree, smx)
 
+        # copy results back into arrays of the particles' own precision
+        outputs = {self.PROPID_HSM: ('smooth',), self.PROPID_RHO: ('rho',),
+                   self.PROPID_HSM_RHO: ('smooth', 'rho')}.get(propid, ())
+        for name in outputs:
+            if name in self._targets:
+                self._targets[name][:] = self.get_array_ref(name)
+
+    def _smooth_arrays(self, arrays, mode, nsmooth, per_component):
+        """Smooth several arrays in a single pass over the neighbours, by
+        smoothing the array made from all their components side by side.
+        Returns, for each array, the output columns belonging to it."""
+        n = len(arrays[0])
+        widths = [int(np.prod(a.shape[1:])) for a in arrays]
+        dtype = np.result_type(np.float32, *[a.dtype for a in arrays])
+
+        stacked = np.empty((n, sum(widths)), dtype=dtype)
+        column = 0
+        for a, width in zip(arrays, widths):
+            stacked[:, column:column + width] = np.asarray(a).reshape((n, width))
+            column += width
+
+        if per_component or mode == 'qty_mean':
+            output = np.empty_like(stacked)
+        else:
+            output = np.empty(n, dtype=dtype)
+
+        self.set_array_ref('qty', stacked)
+        self.set_array_ref('qty_sm', output)
+        self.populate(mode, nsmooth)
+
+        results = []
+        column = 0
+        for width in widths:
+            results.append(output[:, column:column + width])
+            column += width
+        return results
+
+    def _with_units_of(self, result, array):
+        result = result.astype(array.dtype)
+        if hasattr(array, 'units'):
+            result = result.view(ar.SimArray)
+            result.units = array.units
+        return result
+
     def sph_mean(self, array, nsmooth=64):
         """Calculate the SPH mean of a simulation array.
+
+        *array* may have any shape (N, ...). It may also be a list of
+        arrays, in which case a list of their means is returned. The
+        neighbour search is then shared between them, which is faster
+        than smoothing each separately.
         """
+
+        if isinstance(array, (list, tuple)):
+            logger.info("Smoothing %d arrays with %d nearest neighbours" % (len(array), nsmooth))
+            start = time.time()
+            results = self._smooth_arrays(array, 'qty_mean', nsmooth, False)
+            end = time.time()
+            logger.info('SPH smooth done in %5.3g s' % (end - start))
+            return [self._with_units_of(r.reshape(a.shape), a) for r, a in zip(results, array)]
+
+        if len(array.shape) > 2:
+            return self.sph_mean([array], nsmooth)[0]
+
+        array = util.native_byteorder(array)
         output=np.empty_like(array)
 
         if hasattr(array,'units'):
@@ -147,7 +510,27 @@ class KDTree(object):
         return output
 
     def sph_dispersion(self, array, nsmooth=64):
-        output=np.empty_like(array)
+        """Calculate the SPH dispersion of a simulation array. For an array
+        with more than one component per particle, this is the dispersion
+        about the mean summed over all the components.
+
+        As for :meth:`sph_mean`, *array* may be a list of arrays, whose
+        dispersions are then found in a single pass.
+        """
+
+        if isinstance(array, (list, tuple)):
+            logger.info("Getting dispersion of %d arrays with %d nearest neighbours" % (len(array), nsmooth))
+            start = time.time()
+            results = self._smooth_arrays(array, 'qty_disp', nsmooth, True)
+            end = time.time()
+            logger.info('SPH dispersion done in %5.3g s' % (end - start))
+            return [self._with_units_of(np.sqrt(r.sum(axis=1)), a) for r, a in zip(results, array)]
+
+        if len(array.shape) > 2:
+            return self.sph_dispersion([array], nsmooth)[0]
+
+        array = util.native_byteorder(array)
+        output=np.empty(len(array), dtype=array.dtype)
         if hasattr(array,'units'):
             output = output.view(ar.SimArray)
             output.units=array.units
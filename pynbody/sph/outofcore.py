@@ -0,0 +1,528 @@
+"""
+
+outofcore
+=========
+
+Smoothing lengths and densities for particle sets too large to hold in
+memory at once.
+
+The particles are divided into a grid of spatial tiles. Each tile is
+smoothed on its own, together with a halo of ghost particles from the
+surrounding tiles, and the results for the particles inside the tile
+are written straight to the output arrays. One pass over the positions
+sorts the particles into tiles, recording the indices of the particles
+each tile and its halo need. After that, positions and masses are only
+ever read a tile at a time, so they can be memory-mapped from disk, e.g.
+with ``np.load(filename, mmap_mode='r')``, and so can the outputs.
+
+A particle's result is only kept once its whole smoothing sphere lies
+within the region loaded for its tile; otherwise the tile is repeated
+with a wider halo. The results are therefore the same as those of
+smoothing all the particles in memory.
+
+Images and grids too large to hold in memory can likewise be rendered a
+tile or slab at a time straight into a ``.npy`` file or an HDF5 dataset,
+using :func:`render_image_to_file` and :func:`to_3d_grid_to_file`. An
+interrupted render into the same file picks up where it left off.
+
+"""
+
+import numpy as np
+import math
+import time
+import os
+import warnings
+import logging
+
+from . import kdtree
+from .. import config
+
+logger = logging.getLogger('pynbody.sph.outofcore')
+
+
+def _open_output(output, shape, dtype):
+    if isinstance(output, basestring):
+        return np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=shape)
+    if output.shape != shape or output.dtype != dtype:
+        raise ValueError, "Output arrays must have one entry per particle, with the dtype of the positions"
+    return output
+
+
+def _bounds(pos, chunk):
+    lower = np.empty(3)
+    lower[:] = np.inf
+    upper = -lower
+    for start in xrange(0, len(pos), chunk):
+        p = np.asarray(pos[start:start + chunk])
+        lower = np.minimum(lower, p.min(axis=0))
+        upper = np.maximum(upper, p.max(axis=0))
+    return lower, upper
+
+
+def _load_region(pos, centre, extent, boxsize, chunk, candidates=None):
+    """Return the indices of the particles within *extent* of *centre* along
+    each axis, and their offsets from the centre (taking the nearest
+    periodic image if *boxsize* is given). If *candidates* is given, only
+    the particles with those (sorted) indices are read."""
+    indices = []
+    offsets = []
+    n = len(pos) if candidates is None else len(candidates)
+    for start in xrange(0, n, chunk):
+        if candidates is None:
+            index = np.arange(start, min(start + chunk, n))
+            offset = np.asarray(pos[start:start + chunk]) - centre
+        else:
+            index = candidates[start:start + chunk]
+            offset = np.asarray(pos[index]) - centre
+        if boxsize:
+            offset -= boxsize * np.round(offset / boxsize)
+        inside = np.where((abs(offset) <= extent).all(axis=1))[0]
+        indices.append(index[inside])
+        offsets.append(offset[inside])
+
+    if len(indices) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros((0, 3))
+    return np.concatenate(indices), np.concatenate(offsets)
+
+
+def _tile_of(p, tiling, boxsize):
+    """Return the tile, along each axis, holding each of the positions *p*"""
+    lower, upper, tile_width, ntiles, halo = tiling
+    tile = np.floor((p - lower) / tile_width).astype(int)
+    if boxsize:
+        tile %= ntiles
+    else:
+        tile = np.clip(tile, 0, ntiles - 1)
+    return tile
+
+
+def _sort_into_tiles(pos, tiling, boxsize, chunk):
+    """Sort the particles into tiles in one pass over *pos*, with *tiling*
+    as returned by :func:`_tiling`.
+
+    Returns the indices of the particles in each tile or its initial halo,
+    concatenated tile by tile, and the offset in that array at which each
+    tile's indices start. Tiles are numbered in the order of
+    ``np.ndindex(ntiles, ntiles, ntiles)``."""
+    lower, upper, tile_width, ntiles, halo = tiling
+    extent = tile_width / 2 + halo
+
+    # the tiles, relative to its own, whose halos a particle may be in
+    steps = []
+    for axis in xrange(3):
+        reach = int(np.ceil(halo / tile_width[axis])) + 1
+        step = np.arange(-reach, reach + 1)
+        if boxsize:
+            step = step[np.unique(step % ntiles, return_index=True)[1]]
+        steps.append(step)
+
+    buckets = [[] for i in xrange(ntiles ** 3)]
+
+    for start in xrange(0, len(pos), chunk):
+        p = np.asarray(pos[start:start + chunk])
+        tile = _tile_of(p, tiling, boxsize)
+
+        # the membership of each neighbouring tile's region, one axis at a time
+        targets = []
+        members = []
+        for axis in xrange(3):
+            targets.append([])
+            members.append([])
+            for step in steps[axis]:
+                target = tile[:, axis] + step
+                if boxsize:
+                    target %= ntiles
+                offset = p[:, axis] - (lower[axis] + tile_width[axis] * (target + 0.5))
+                if boxsize:
+                    offset -= boxsize * np.round(offset / boxsize)
+                inside = abs(offset) <= extent[axis]
+                if not boxsize:
+                    inside &= (target >= 0) & (target < ntiles)
+                targets[axis].append(target)
+                members[axis].append(inside)
+
+        for i, j, k in np.ndindex(*[len(x) for x in steps]):
+            inside = np.where(members[0][i] & members[1][j] & members[2][k])[0]
+            if len(inside) == 0:
+                continue
+            flat = (targets[0][i][inside] * ntiles + targets[1][j][inside]) * ntiles + targets[2][k][inside]
+            order = np.argsort(flat, kind='mergesort')
+            flat = flat[order]
+            inside = inside[order] + start
+            bounds = np.flatnonzero(np.diff(flat)) + 1
+            for first, tile_particles in zip(np.concatenate(([0], bounds)), np.split(inside, bounds)):
+                buckets[flat[first]].append(tile_particles)
+
+    lengths = [sum([len(x) for x in bucket]) for bucket in buckets]
+    starts = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+    indices = np.empty(starts[-1], dtype=np.intp)
+    for t, bucket in enumerate(buckets):
+        if len(bucket) > 0:
+            indices[starts[t]:starts[t + 1]] = np.sort(np.concatenate(bucket))
+
+    return indices, starts
+
+
+def smooth_out_of_core(pos, mass, smooth, rho=None, nsmooth=None, boxsize=None,
+                       ntiles=4, chunk=1000000):
+    """Calculate the smoothing lengths, and optionally the densities, of
+    particles whose arrays need not fit in memory.
+
+    *pos* (Nx3) and *mass* (N) may be any arrays supporting slicing and
+    fancy indexing, such as memory maps. *smooth* and *rho* are the
+    output arrays, with the dtype of *pos*, or the names of ``.npy`` files
+    to create for them.
+
+    The region containing the particles is divided into *ntiles* tiles
+    along each axis. At any one time only one tile and its halo of
+    neighbouring particles are held in memory, besides *chunk* particles
+    at a time while sorting them into tiles and the index of the particles
+    in each tile. *boxsize*, if given, makes the region periodic.
+
+    Returns the smoothing lengths or, if *rho* was given, the smoothing
+    lengths and densities."""
+
+    if nsmooth is None:
+        nsmooth = config['sph']['smooth-particles']
+
+    n = len(pos)
+    if nsmooth > n:
+        raise ValueError, "Number of smoothing particles exceeds number of particles"
+
+    dtype = np.dtype(pos.dtype).newbyteorder('=')
+    smooth = _open_output(smooth, (n,), dtype)
+    if rho is not None:
+        rho = _open_output(rho, (n,), dtype)
+
+    tiling = _tiling(pos, nsmooth, boxsize, ntiles, chunk)
+    tile_index = _sort_into_tiles(pos, tiling, boxsize, chunk)
+
+    logger.info('Smoothing %d particles in %d tiles' % (n, ntiles ** 3))
+    start = time.time()
+
+    for tile in np.ndindex(ntiles, ntiles, ntiles):
+        _smooth_tile(pos, mass, smooth, rho, nsmooth, boxsize, np.array(tile), tiling, tile_index, chunk)
+
+    end = time.time()
+    logger.info('Out-of-core smoothing done in %5.3g s' % (end - start))
+
+    if rho is None:
+        return smooth
+    else:
+        return smooth, rho
+
+
+def _tiling(pos, nsmooth, boxsize, ntiles, chunk):
+    """Return the lower and upper corners of the region to be divided into
+    *ntiles* tiles along each axis, the width of the tiles, their number
+    and the initial width of their halos"""
+    lower, upper = _bounds(pos, chunk)
+    if boxsize:
+        # tiles may start anywhere in a periodic box
+        upper = lower + boxsize
+
+    tile_width = (upper - lower) / ntiles
+    tile_width[tile_width == 0] = 1.0
+
+    # the distance to the nsmooth-th neighbour at the mean density, twice
+    # over, is the starting width of the halo; tiles of lower density are
+    # repeated with wider halos
+    volume = np.prod(tile_width) * ntiles ** 3
+    halo = 2 * (3 * nsmooth * volume / (4 * math.pi * len(pos))) ** (1. / 3)
+
+    return lower, upper, tile_width, ntiles, halo
+
+
+def _tile_candidates(tile_index, tiles):
+    """Return the sorted indices of the particles recorded in *tile_index*,
+    as returned by :func:`_sort_into_tiles`, for the given tile numbers"""
+    indices, starts = tile_index
+    candidates = [indices[starts[t]:starts[t + 1]] for t in tiles]
+    if len(tiles) == 1:
+        return np.asarray(candidates[0])
+    return np.unique(np.concatenate(candidates))
+
+
+def _tiles_overlapping(centre, extent, tiling, boxsize):
+    """Return the numbers of the tiles overlapping the region within
+    *extent* of *centre* along each axis"""
+    lower, upper, tile_width, ntiles, halo = tiling
+    first = np.floor((centre - extent - lower) / tile_width).astype(int)
+    last = np.floor((centre + extent - lower) / tile_width).astype(int)
+    axes = []
+    for axis in xrange(3):
+        if boxsize:
+            axes.append(np.unique(np.arange(first[axis], last[axis] + 1) % ntiles))
+        else:
+            axes.append(np.arange(max(first[axis], 0), min(last[axis], ntiles - 1) + 1))
+    return [(i * ntiles + j) * ntiles + k for i in axes[0] for j in axes[1] for k in axes[2]]
+
+
+def _smooth_tile(pos, mass, smooth, rho, nsmooth, boxsize, tile, tiling, tile_index, chunk):
+    """Smooth the particles of one tile, with *tiling* and *tile_index* as
+    returned by :func:`_tiling` and :func:`_sort_into_tiles`, writing their
+    results into *smooth* and *rho*"""
+    lower, upper, tile_width, ntiles, halo = tiling
+    initial_halo = halo
+    centre = lower + tile_width * (tile + 0.5)
+    half_width = tile_width / 2
+
+    while True:
+        whole_box = False
+        if boxsize and (half_width + halo >= boxsize / 2).any():
+            # the halo would wrap round onto the other side of the tile, so
+            # use every particle and a periodic tree instead
+            if ntiles > 1:
+                warnings.warn("Out-of-core smoothing needed all the particles for one tile", RuntimeWarning)
+            whole_box = True
+            extent = boxsize
+        elif not boxsize and ((centre - half_width - halo <= lower).all() and
+                              (centre + half_width + halo >= upper).all()):
+            whole_box = True
+            extent = halo + half_width
+        else:
+            extent = halo + half_width
+
+        if whole_box:
+            candidates = None
+        elif halo == initial_halo:
+            candidates = _tile_candidates(tile_index, [(tile[0] * ntiles + tile[1]) * ntiles + tile[2]])
+        else:
+            # a wider halo reaches the particles of the tiles it overlaps
+            candidates = _tile_candidates(tile_index, _tiles_overlapping(centre, extent, tiling, boxsize))
+
+        indices, offsets = _load_region(pos, centre, extent, boxsize, chunk, candidates)
+
+        # the particles belonging to this tile, as opposed to its halo
+        core = (_tile_of(offsets + centre, tiling, boxsize) == tile).all(axis=1)
+
+        if not core.any():
+            return
+
+        if len(indices) < nsmooth and not whole_box:
+            halo *= 2
+            continue
+
+        tile_pos = (offsets + centre).astype(smooth.dtype)
+        tile_mass = np.asarray(mass[indices]).astype(smooth.dtype)
+        tree = kdtree.KDTree(tile_pos, tile_mass, leafsize=config['sph']['tree-leafsize'],
+                             boxsize=boxsize if whole_box else None)
+
+        tile_smooth = np.empty(len(indices), dtype=smooth.dtype)
+        tree.set_array_ref('smooth', tile_smooth)
+        if rho is None:
+            tree.populate('hsm', nsmooth)
+        else:
+            tile_rho = np.empty(len(indices), dtype=smooth.dtype)
+            tree.set_array_ref('mass', tile_mass)
+            tree.set_array_ref('rho', tile_rho)
+            tree.populate('hsm_rho', nsmooth)
+
+        if whole_box:
+            complete = core
+        else:
+            # the smoothing sphere (radius 2h) must lie inside the loaded region
+            reach = abs(offsets) + 2 * tile_smooth[:, np.newaxis]
+            complete = core & (reach <= extent).all(axis=1)
+
+        smooth[indices[complete]] = tile_smooth[complete]
+        if rho is not None:
+            rho[indices[complete]] = tile_rho[complete]
+
+        if complete.sum() == core.sum():
+            return
+
+        logger.info('Repeating tile %s with a wider halo for %d particles' %
+                    (tuple(tile), core.sum() - complete.sum()))
+        halo *= 2
+
+
+def _open_target(filename, dataset, shape, chunks, resume):
+    """Return the float32 array of the given shape to render into, a memory
+    map of a ``.npy`` file or an HDF5 dataset, with the HDF5 file to be
+    closed afterwards (or None), and whether it holds an earlier render"""
+    if filename.endswith('.npy'):
+        if resume and os.path.exists(filename):
+            target = np.lib.format.open_memmap(filename, mode='r+')
+            if target.shape == shape and target.dtype == np.float32:
+                return target, None, True
+            del target
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape), None, False
+    else:
+        import h5py
+        f = h5py.File(filename, 'a')
+        if dataset in f:
+            if resume and f[dataset].shape == shape and f[dataset].dtype == np.float32:
+                return f[dataset], f, True
+            del f[dataset]
+        return f.create_dataset(dataset, shape, dtype=np.float32, chunks=chunks), f, False
+
+
+def _render_pieces(filename, dataset, shape, chunks, pieces, render_piece, units, resume):
+    """Render each of *pieces*, a list of index tuples into an array of the
+    given shape, with *render_piece* and write it to *filename*, recording
+    the pieces done in a progress file alongside it until all are finished"""
+    progress_file = filename + '.progress'
+    target, h5file, existing = _open_target(filename, dataset, shape, chunks, resume)
+
+    try:
+        done = np.zeros(len(pieces), dtype=bool)
+        if existing and os.path.exists(progress_file):
+            with open(progress_file, 'rb') as f:
+                previous = np.load(f)
+            if len(previous) == len(pieces):
+                done = previous
+                logger.info("Resuming render into %s with %d of %d pieces done" %
+                            (filename, done.sum(), len(pieces)))
+
+        if h5file is not None:
+            target.attrs['units'] = str(units)
+
+        start = time.time()
+        for i, piece in enumerate(pieces):
+            if done[i]:
+                continue
+            target[piece] = render_piece(piece)
+
+            # make sure the piece is on disk before it is recorded as done
+            if h5file is None:
+                target.flush()
+            else:
+                h5file.flush()
+            done[i] = True
+            with open(progress_file + '.tmp', 'wb') as f:
+                np.save(f, done)
+            os.rename(progress_file + '.tmp', progress_file)
+
+        logger.info("Render into %s done in %5.3g s" % (filename, time.time() - start))
+    finally:
+        if h5file is not None:
+            h5file.close()
+        else:
+            del target
+
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
+
+def render_image_to_file(snap, filename, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
+                         y1=None, tile_size=4096, resume=True, dataset='image', **kwargs):
+    """Render an image, as :func:`~pynbody.sph.render_image`, into
+    *filename* one tile of at most *tile_size* pixels square at a time, so
+    that the whole image need never be held in memory.
+
+    If *filename* ends in ``.npy`` the image is written to a memory-mapped
+    ``.npy`` file; otherwise to the dataset *dataset* of an HDF5 file,
+    chunked into tiles, which also records the units of the image. If
+    *resume* is True and an earlier render into the same file was
+    interrupted, the tiles it finished are not rendered again.
+
+    The other keyword arguments are passed to
+    :func:`~pynbody.sph.render_image`, except that perspective images
+    (*z_camera*) are not supported and *approximate_fast* defaults to False
+    so that the tiles join seamlessly. If the snapshot has a tree, only the
+    particles overlapping each tile are rendered for it.
+
+    Returns the units of the image."""
+
+    from . import render_image, _image_units, Kernel
+
+    if kwargs.get('z_camera', None):
+        raise ValueError, "Perspective images cannot be rendered to a file in tiles"
+    kwargs.setdefault('approximate_fast', False)
+
+    if y2 is None:
+        if ny is not None:
+            y2 = x2 * float(ny) / nx
+        else:
+            y2 = x2
+    if ny is None:
+        ny = nx
+    if x1 is None:
+        x1 = -x2
+    if y1 is None:
+        y1 = -y2
+
+    nx, ny = int(nx), int(ny)
+    pixel_dx = float(x2 - x1) / nx
+    pixel_dy = float(y2 - y1) / ny
+
+    pieces = [(slice(y, min(y + tile_size, ny)), slice(x, min(x + tile_size, nx)))
+              for y in xrange(0, ny, tile_size) for x in xrange(0, nx, tile_size)]
+
+    def render_piece(piece):
+        rows, columns = piece
+        # the tile is rendered with a border of one pixel, then discarded, so
+        # that particles just outside it are not rounded into its edge pixels
+        im = render_image(snap, qty, x1=x1 + (columns.start - 1) * pixel_dx, x2=x1 + (columns.stop + 1) * pixel_dx,
+                          nx=columns.stop - columns.start + 2,
+                          y1=y1 + (rows.start - 1) * pixel_dy, y2=y1 + (rows.stop + 1) * pixel_dy,
+                          ny=rows.stop - rows.start + 2, **kwargs)
+        return im[1:-1, 1:-1]
+
+    units = _image_units(snap, qty, kwargs.get('out_units', None), kwargs.get('kernel', Kernel()))
+    _render_pieces(filename, dataset, (ny, nx), (min(tile_size, ny), min(tile_size, nx)),
+                   pieces, render_piece, units, resume)
+    return units
+
+
+def to_3d_grid_to_file(snap, filename, qty='rho', nx=None, ny=None, nz=None, x2=None,
+                       slab_size=None, resume=True, dataset='grid', out_units=None,
+                       xy_units=None, kernel=None, smooth='smooth', threaded=None, denoise=None,
+                       conserve=False):
+    """Render a grid, as :func:`~pynbody.sph.to_3d_grid`, into *filename*
+    one slab of *slab_size* planes along the x axis at a time (by default,
+    enough planes for about 2**24 cells), so that the whole grid need never
+    be held in memory.
+
+    The file and the *resume* and *dataset* arguments are as for
+    :func:`render_image_to_file`, and the others as for
+    :func:`~pynbody.sph.to_3d_grid`. The grid is not rendered with
+    *approximate_fast*, so that the slabs join seamlessly.
+
+    Returns the units of the grid."""
+
+    from . import _grid_region, _image_units, _auto_denoise, Kernel
+
+    if kernel is None:
+        kernel = Kernel()
+    if denoise is None:
+        denoise = _auto_denoise(snap, kernel)
+
+    if x2 is None:
+        x1, x2 = np.min(snap['x']), np.max(snap['x'])
+        y1, y2 = np.min(snap['y']), np.max(snap['y'])
+        z1, z2 = np.min(snap['z']), np.max(snap['z'])
+    else:
+        x1 = y1 = z1 = -x2
+        y2 = z2 = x2
+
+    if nx is None:
+        nx = np.ceil((x2 - x1) / np.min(snap['eps']))
+    if ny is None:
+        ny = nx
+    if nz is None:
+        nz = nx
+
+    x1, x2, y1, y2, z1, z2 = [float(q) for q in x1, x2, y1, y2, z1, z2]
+    nx, ny, nz = [int(q) for q in nx, ny, nz]
+    pixel_dx = (x2 - x1) / nx
+
+    if slab_size is None:
+        slab_size = max(1, 2 ** 24 // (ny * nz))
+
+    pieces = [(slice(x, min(x + slab_size, nx)),) for x in xrange(0, nx, slab_size)]
+
+    def render_piece(piece):
+        planes = piece[0]
+        # with a border of one plane on either side, as for the tiles of images
+        grid = _grid_region(snap, qty, planes.stop - planes.start + 2, ny, nz,
+                            x1 + (planes.start - 1) * pixel_dx, x1 + (planes.stop + 1) * pixel_dx,
+                            y1, y2, z1, z2, out_units, xy_units, kernel, smooth,
+                            False, threaded, denoise, conserve)
+        return grid[1:-1]
+
+    units = _image_units(snap, qty, out_units, kernel)
+    _render_pieces(filename, dataset, (nx, ny, nz), (min(slab_size, nx), ny, nz),
+                   pieces, render_piece, units, resume)
+    return units
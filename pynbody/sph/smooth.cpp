@@ -7,6 +7,8 @@
 #include "kd.h"
 
 #include <iostream>
+#include <vector>
+#include <algorithm>
 
 bool smCheckFits(KD kd, float *fPeriod) {
 	KDN *root;
@@ -363,6 +365,85 @@ int smBallGather(SMX smx,float fBall2,float *ri)
 	}
 
 
+void smGrowLists(SMX smx, int nListSize)
+{
+	// Enlarge the neighbour lists, for gathers that return more particles
+	// than the lists allocated by smInit can hold
+	smx->nListSize = nListSize;
+	smx->fList = (float *)realloc(smx->fList,nListSize*sizeof(float));  assert(smx->fList != NULL);
+	smx->pList = (int *)realloc(smx->pList,nListSize*sizeof(int));      assert(smx->pList != NULL);
+}
+
+
+template<typename T>
+int smNearestNeighbours(SMX smx,float *ri,int nSmooth)
+{
+	// Find the nSmooth nearest particles to an arbitrary point ri, where
+	// nSmooth may be anything up to the smx->nSmooth the queue was allocated
+	// for. On return pList and fList hold the particles and squared
+	// distances, in order of increasing distance. smSmoothInitStep must have
+	// been called first.
+	KDN *c;
+	PARTICLE *p;
+	PQ *pq,*pqLast;
+	KD kd=smx->kd;
+	int cell,pj,nCnt;
+	float dx,dy,dz;
+
+	c = kd->kdNodes;
+	p = kd->p;
+	assert(nSmooth>0 && nSmooth<=smx->nSmooth);
+
+	/*
+	** Find the bucket containing (or closest to) the point, and seed the
+	** queue with the particles in and after it.
+	*/
+	cell = ROOT;
+	while (cell < kd->nSplit) {
+		if (ri[c[cell].iDim] < c[cell].fSplit) cell = LOWER(cell);
+		else cell = UPPER(cell);
+		}
+
+	/*
+	** Only the particles in the queue are marked, but the previous search may
+	** have used a shorter queue than this one, so clear the whole allocation.
+	*/
+	for (pq=smx->pq;pq<&smx->pq[smx->nSmooth];++pq) smx->iMark[pq->p] = 0;
+
+	PQ_INIT(smx->pq,nSmooth);
+	pqLast = &smx->pq[nSmooth-1];
+
+	pj = c[cell].pLower;
+	if (pj > kd->nActive - nSmooth)
+		pj = kd->nActive - nSmooth;
+	for (pq=smx->pq;pq<=pqLast;++pq) {
+		smx->iMark[pj] = 1;
+		dx = ri[0] - GET2<T>(kd->pNumpyPos,p[pj].iOrder,0);
+		dy = ri[1] - GET2<T>(kd->pNumpyPos,p[pj].iOrder,1);
+		dz = ri[2] - GET2<T>(kd->pNumpyPos,p[pj].iOrder,2);
+		pq->fKey = dx*dx + dy*dy + dz*dz;
+		pq->p = pj++;
+		pq->ax = 0.0;
+		pq->ay = 0.0;
+		pq->az = 0.0;
+		}
+	PQ_BUILD(smx->pq,nSmooth,smx->pqHead);
+
+	smBallSearch<T>(smx,smx->pqHead->fKey,ri);
+
+	std::vector<std::pair<float,int> > sorted(nSmooth);
+	for (pq=smx->pq,nCnt=0;pq<=pqLast;++pq,++nCnt)
+		sorted[nCnt] = std::make_pair(pq->fKey,pq->p);
+	std::sort(sorted.begin(),sorted.end());
+
+	for (nCnt=0;nCnt<nSmooth;++nCnt) {
+		smx->fList[nCnt] = sorted[nCnt].first;
+		smx->pList[nCnt] = sorted[nCnt].second;
+		}
+	return(nSmooth);
+	}
+
+
 
 
 
@@ -644,6 +725,7 @@ template<typename T>
 void smDensity(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 {
 	T fNorm,ih2,r2,rs,ih;
+	double rho;
 	int j,pj,pi_iord ;
 	KD kd = smx->kd;
 
@@ -651,7 +733,12 @@ void smDensity(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 	ih = 1.0/GET<T>(kd->pNumpySmooth, pi_iord);
 	ih2 = ih*ih;
 	fNorm = M_1_PI*ih*ih2;
-	SET<T>(kd->pNumpyDen,pi_iord,0.0);
+
+	// accumulate locally and store once, since in a combined smoothing
+	// length and density pass two threads may occasionally process the
+	// same particle. The sum is kept in double precision even for single
+	// precision trees.
+	rho = 0;
 	for (j=0;j<nSmooth;++j) {
 		pj = pList[j];
 		r2 = fList[j]*ih2;
@@ -660,8 +747,9 @@ void smDensity(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 		else rs = 0.25*rs*rs*rs;
 		if(rs<0) rs=0;
 		rs *= fNorm;
-		ACCUM<T>(kd->pNumpyDen,pi_iord,rs*GET<T>(kd->pNumpyMass,kd->p[pj].iOrder));
+		rho += rs*GET<T>(kd->pNumpyMass,kd->p[pj].iOrder);
 	}
+	SET<T>(kd->pNumpyDen,pi_iord,(T)rho);
 
 }
 
@@ -699,15 +787,16 @@ template<typename Tf, typename Tq>
 void smMeanQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 {
 	Tf fNorm,ih2,r2,rs,ih,mass,rho;
-	int j,k,pj,pi_iord ;
+	int j,k,pj,pi_iord,nDim;
 	KD kd = smx->kd;
 
+	nDim = PyArray_DIM(kd->pNumpyQty,1);
 	pi_iord = kd->p[pi].iOrder;
 	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
 	ih2 = ih*ih;
 	fNorm = M_1_PI*ih*ih2;
 
-	for(k=0;k<3;++k)
+	for(k=0;k<nDim;++k)
 		SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,0.0);
 
 	for (j=0;j<nSmooth;++j) {
@@ -720,7 +809,7 @@ void smMeanQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 		rs *= fNorm;
 		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
 		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
-		for(k=0;k<3;++k) {
+		for(k=0;k<nDim;++k) {
 			ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,
 			    rs*mass*GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k)/rho);
 		}
@@ -728,66 +817,91 @@ void smMeanQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 
 }
 
+// number of components of a quantity whose dispersion is found at once
+#define DISP_BLOCK 16
+
 template<typename Tf, typename Tq>
 void smDispQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 {
+	// If the output is one-dimensional, store the dispersion over all
+	// components of the quantity, sqrt(sum_k var_k). If it has one column
+	// per component, store the variance var_k of each component instead.
+	// If it has two columns per component, store the means of all the
+	// components followed by their variances.
 	float fNorm,ih2,r2,rs,ih,mass,rho;
-	int j,k,pj,pi_iord ;
+	int j,k,k0,nBlock,nDim,pj,pi_iord;
+	bool bPerComponent, bWithMean;
 	KD kd = smx->kd;
-	float mean[3], tdiff;
+	Tq mean[DISP_BLOCK], var[DISP_BLOCK], tdiff, total;
 
+	nDim = PyArray_DIM(kd->pNumpyQty,1);
+	bPerComponent = PyArray_NDIM(kd->pNumpyQtySmoothed)==2;
+	bWithMean = bPerComponent && PyArray_DIM(kd->pNumpyQtySmoothed,1)==2*nDim;
 	pi_iord = kd->p[pi].iOrder;
 	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
 	ih2 = ih*ih;
 	fNorm = M_1_PI*ih*ih2;
 
+	total = 0;
 
+	for(k0=0;k0<nDim;k0+=DISP_BLOCK) {
+		nBlock = nDim-k0;
+		if(nBlock>DISP_BLOCK) nBlock=DISP_BLOCK;
 
-	SET<Tq>(kd->pNumpyQtySmoothed,pi_iord,0.0);
-
-	for(k=0;k<3;++k) {
-
-		mean[k]=0;
-	}
-
-	// pass 1: find mean
+		for(k=0;k<nBlock;++k) {
+			mean[k]=0;
+			var[k]=0;
+		}
 
-	for (j=0;j<nSmooth;++j) {
-		pj = pList[j];
-		r2 = fList[j]*ih2;
-		rs = 2.0 - sqrt(r2);
-		if (r2 < 1.0) rs = (1.0 - 0.75*rs*r2);
-		else rs = 0.25*rs*rs*rs;
-		if(rs<0) rs=0;
-		rs *= fNorm;
-		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
-		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
-		for(k=0;k<3;++k)
-			mean[k]+=rs*mass*GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k)/rho;
-	}
+		// pass 1: find mean
+
+		for (j=0;j<nSmooth;++j) {
+			pj = pList[j];
+			r2 = fList[j]*ih2;
+			rs = 2.0 - sqrt(r2);
+			if (r2 < 1.0) rs = (1.0 - 0.75*rs*r2);
+			else rs = 0.25*rs*rs*rs;
+			if(rs<0) rs=0;
+			rs *= fNorm;
+			mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
+			rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
+			for(k=0;k<nBlock;++k)
+				mean[k]+=rs*mass*GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k0+k)/rho;
+		}
 
-	// pass 2: get variance
+		// pass 2: get variance
+
+		for (j=0;j<nSmooth;++j) {
+			pj = pList[j];
+			r2 = fList[j]*ih2;
+			rs = 2.0 - sqrt(r2);
+			if (r2 < 1.0) rs = (1.0 - 0.75*rs*r2);
+			else rs = 0.25*rs*rs*rs;
+			if(rs<0) rs=0;
+			rs *= fNorm;
+			mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
+			rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
+			for(k=0;k<nBlock;++k) {
+				tdiff = mean[k]-GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k0+k);
+				var[k]+=rs*mass*tdiff*tdiff/rho;
+			}
+		}
 
-	for (j=0;j<nSmooth;++j) {
-		pj = pList[j];
-		r2 = fList[j]*ih2;
-		rs = 2.0 - sqrt(r2);
-		if (r2 < 1.0) rs = (1.0 - 0.75*rs*r2);
-		else rs = 0.25*rs*rs*rs;
-		if(rs<0) rs=0;
-		rs *= fNorm;
-		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
-		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
-		for(k=0;k<3;++k) {
-			tdiff = mean[k]-GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k);
-			ACCUM<Tq>(kd->pNumpyQtySmoothed,pi_iord,
-				rs*mass*tdiff*tdiff/rho);
+		for(k=0;k<nBlock;++k) {
+			if(bWithMean) {
+				SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k0+k,mean[k]);
+				SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,nDim+k0+k,var[k]);
+			} else if(bPerComponent)
+				SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k0+k,var[k]);
+			else
+				total+=var[k];
 		}
 	}
 
 	// finally: take square root to get dispersion
 
-	SET<Tq>(kd->pNumpyQtySmoothed,pi_iord,sqrt(GET<Tq>(kd->pNumpyQtySmoothed,pi_iord)));
+	if(!bPerComponent)
+		SET<Tq>(kd->pNumpyQtySmoothed,pi_iord,sqrt(total));
 
 }
 
@@ -848,6 +962,149 @@ void smDispQty1D(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 }
 
 
+template<typename Tf>
+void smSeparation(SMX smx,int pi_iord,int pj_iord,Tf *dx)
+{
+	// the vector from particle pj to particle pi, taking the nearest
+	// periodic image
+	KD kd = smx->kd;
+	int k;
+	for(k=0;k<3;++k) {
+		dx[k] = GET2<Tf>(kd->pNumpyPos,pi_iord,k)-GET2<Tf>(kd->pNumpyPos,pj_iord,k);
+		if(dx[k]>0.5*smx->fPeriod[k]) dx[k]-=smx->fPeriod[k];
+		else if(dx[k]<-0.5*smx->fPeriod[k]) dx[k]+=smx->fPeriod[k];
+	}
+}
+
+template<typename Tf>
+Tf smKernelGradientFactor(Tf r2,Tf ih)
+{
+	// Return (dW/dr)/r for the cubic spline kernel, given r2=(r/h)^2, so that
+	// the gradient of the kernel is this factor times the separation vector
+	Tf q,dw;
+	if(r2>=4.0 || r2<=0.0) return 0;
+	q = sqrt(r2);
+	if (q < 1.0) dw = -3.0*q+2.25*q*q;
+	else dw = -0.75*(2.0-q)*(2.0-q);
+	return M_1_PI*ih*ih*ih*ih*ih*dw/q;
+}
+
+template<typename Tf, typename Tq>
+void smGradQty1D(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	// SPH estimate of the gradient of a scalar,
+	// sum_j (m_j/rho_j) (q_j-q_i) grad_i W_ij
+	Tf ih,ih2,dwr,mass,rho;
+	Tf dx[3];
+	Tq qi,dq;
+	int j,k,pj,pj_iord,pi_iord;
+	KD kd = smx->kd;
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+	qi = GET<Tq>(kd->pNumpyQty,pi_iord);
+
+	for(k=0;k<3;++k)
+		SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		pj_iord = kd->p[pj].iOrder;
+		dwr = smKernelGradientFactor<Tf>(fList[j]*ih2,ih);
+		if(dwr==0) continue;
+		mass=GET<Tf>(kd->pNumpyMass,pj_iord);
+		rho=GET<Tf>(kd->pNumpyDen,pj_iord);
+		dq = GET<Tq>(kd->pNumpyQty,pj_iord)-qi;
+		smSeparation<Tf>(smx,pi_iord,pj_iord,dx);
+		for(k=0;k<3;++k)
+			ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,mass*dq*dwr*dx[k]/rho);
+	}
+}
+
+template<typename Tf, typename Tq>
+void smDivQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	// SPH estimate of the divergence of a vector,
+	// sum_j (m_j/rho_j) (v_j-v_i).grad_i W_ij
+	Tf ih,ih2,dwr,mass,rho;
+	Tf dx[3];
+	Tq dot;
+	int j,k,pj,pj_iord,pi_iord;
+	KD kd = smx->kd;
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+
+	SET<Tq>(kd->pNumpyQtySmoothed,pi_iord,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		pj_iord = kd->p[pj].iOrder;
+		dwr = smKernelGradientFactor<Tf>(fList[j]*ih2,ih);
+		if(dwr==0) continue;
+		mass=GET<Tf>(kd->pNumpyMass,pj_iord);
+		rho=GET<Tf>(kd->pNumpyDen,pj_iord);
+		smSeparation<Tf>(smx,pi_iord,pj_iord,dx);
+		dot = 0;
+		for(k=0;k<3;++k)
+			dot += (GET2<Tq>(kd->pNumpyQty,pj_iord,k)-GET2<Tq>(kd->pNumpyQty,pi_iord,k))*dx[k];
+		ACCUM<Tq>(kd->pNumpyQtySmoothed,pi_iord,mass*dot*dwr/rho);
+	}
+}
+
+template<typename Tf, typename Tq>
+void smCurlQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	// SPH estimate of the curl of a vector,
+	// sum_j (m_j/rho_j) grad_i W_ij x (v_j-v_i)
+	Tf ih,ih2,dwr,mass,rho;
+	Tf dx[3];
+	Tq dv[3];
+	int j,k,pj,pj_iord,pi_iord;
+	KD kd = smx->kd;
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+
+	for(k=0;k<3;++k)
+		SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		pj_iord = kd->p[pj].iOrder;
+		dwr = smKernelGradientFactor<Tf>(fList[j]*ih2,ih);
+		if(dwr==0) continue;
+		mass=GET<Tf>(kd->pNumpyMass,pj_iord);
+		rho=GET<Tf>(kd->pNumpyDen,pj_iord);
+		smSeparation<Tf>(smx,pi_iord,pj_iord,dx);
+		for(k=0;k<3;++k)
+			dv[k] = GET2<Tq>(kd->pNumpyQty,pj_iord,k)-GET2<Tq>(kd->pNumpyQty,pi_iord,k);
+		ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,0,mass*dwr*(dx[1]*dv[2]-dx[2]*dv[1])/rho);
+		ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,1,mass*dwr*(dx[2]*dv[0]-dx[0]*dv[2])/rho);
+		ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,2,mass*dwr*(dx[0]*dv[1]-dx[1]*dv[0])/rho);
+	}
+}
+
+template<typename Tf>
+void smExternal(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	// Hand the neighbour list to a user-supplied operator. The list belongs
+	// to this thread and is rebuilt for every particle, so it is converted
+	// to the original particle order in place.
+	int j,pi_iord;
+	KD kd = smx->kd;
+
+	pi_iord = kd->p[pi].iOrder;
+	for (j=0;j<nSmooth;++j)
+		pList[j] = kd->p[pList[j]].iOrder;
+
+	(*kd->pExternalFn)(kd->pExternalData,pi_iord,(double)GET<Tf>(kd->pNumpySmooth,pi_iord),
+	                   nSmooth,pList,fList);
+}
+
 
 // instantiate the actual functions that are available:
 
@@ -857,6 +1114,9 @@ void smBallSearch<double>(SMX smx,float fBall2,float *ri);
 template
 int smBallGather<double>(SMX smx,float fBall2,float *ri);
 
+template
+int smNearestNeighbours<double>(SMX smx,float *ri,int nSmooth);
+
 template
 void smDomainDecomposition<double>(KD kd, int nprocs);
 
@@ -877,6 +1137,9 @@ void smBallSearch<float>(SMX smx,float fBall2,float *ri);
 template
 int smBallGather<float>(SMX smx,float fBall2,float *ri);
 
+template
+int smNearestNeighbours<float>(SMX smx,float *ri,int nSmooth);
+
 template
 void smDomainDecomposition<float>(KD kd, int nprocs);
 
@@ -889,6 +1152,12 @@ void smDensitySym<float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 template
 void smDensity<float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smExternal<double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smExternal<float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 
 
@@ -904,6 +1173,15 @@ void smDispQty1D<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fL
 template
 void smDispQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -917,6 +1195,15 @@ void smDispQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fLi
 template
 void smDispQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -930,6 +1217,15 @@ void smDispQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fLi
 template
 void smDispQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -943,6 +1239,15 @@ void smDispQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fLis
 template
 void smDispQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 /*
 
@@ -119,6 +119,11 @@ void smBallSearch(SMX,float,float *);
 template<typename T>
 int  smBallGather(SMX,float,float *);
 
+template<typename T>
+int smNearestNeighbours(SMX,float *,int);
+
+void smGrowLists(SMX,int);
+
 template<typename T>
 int smSmoothStep(SMX smx, int procid);
 
@@ -138,6 +143,15 @@ template<typename Tf, typename Tq>
 void smMeanQty1D(SMX,int,int,int *,float *);
 template<typename Tf, typename Tq>
 void smDispQty1D(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smGradQty1D(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smDivQtyND(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smCurlQtyND(SMX,int,int,int *,float *);
+
+template<typename Tf>
+void smExternal(SMX,int,int,int *,float *);
 
 bool smCheckFits(KD kd, float *fPeriod);
 
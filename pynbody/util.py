@@ -316,6 +316,16 @@ def set_array_if_not_same(a_store, a_in, index=None):
             a_store.units = a_in.units
 
 
+def native_byteorder(ar):
+    """Returns ar itself if its dtype is in native byte order, or a
+    native-order copy otherwise. Compiled routines assume native data,
+    so byte-swapped views (e.g. memory-mapped big-endian files) must be
+    passed through this first."""
+    if ar.dtype.isnative:
+        return ar
+    return ar.astype(ar.dtype.newbyteorder('='))
+
+
 def index_of_first(array, find):
     """Returns the index to the first element in array
     which satisfies array[index]>=find. The array must
@@ -654,11 +664,34 @@ def read_fortran(f, dtype, n=1):
     return data
 
 
+def read_fortran_records(f, dtype, n, nrecords):
+    """Read *nrecords* consecutive FORTRAN records, each of *n* items of
+    type *dtype*, with a single read. Returns an (nrecords, n) array."""
+    if not isinstance(dtype, np.dtype):
+        dtype = np.dtype(dtype)
+
+    length = n * dtype.itemsize
+    stride = length + 2 * _head_type.itemsize
+    raw = np.fromfile(f, np.uint8, stride * nrecords)
+    if len(raw) != stride * nrecords:
+        raise IOError, "Unexpected end of file reading FORTRAN blocks"
+
+    heads = np.ndarray((nrecords, 2), _head_type, raw, 0,
+                       (stride, length + _head_type.itemsize))
+    if (heads != length).any():
+        raise IOError, "Unexpected FORTRAN block length"
+
+    return np.ndarray((nrecords, n), dtype, raw, _head_type.itemsize,
+                      (stride, dtype.itemsize))
+
+
 def skip_fortran(f, n=1):
+    # struct is used here rather than np.fromfile because the per-call
+    # overhead dominates when skipping many small records
     for i in xrange(n):
-        alen = np.fromfile(f, _head_type, 1)
-        f.seek(alen[0], 1)
-        alen2 = np.fromfile(f, _head_type, 1)
+        (alen,) = struct.unpack("=i", f.read(4))
+        f.seek(alen, 1)
+        (alen2,) = struct.unpack("=i", f.read(4))
         assert alen == alen2
 
 
@@ -707,6 +740,31 @@ def _thread_map(func, *args):
     raise excp  # Note this is a re-raised exception from within a thread
 
 
+def _thread_map_interleaved(func, tasks, num_threads=None):
+    """Call func(*task) for every tuple in tasks, sharing the calls between
+    at most num_threads threads (by default config['number_of_threads']).
+    Each thread takes every num_threads-th task in turn. Returns the
+    results in the same order as tasks. Any exception raised in a
+    worker thread is re-raised here."""
+
+    if num_threads is None:
+        num_threads = config['number_of_threads']
+    num_threads = max(1, min(num_threads, len(tasks)))
+
+    if num_threads == 1:
+        return [func(*task) for task in tasks]
+
+    def run_tasks(tasks_this_thread):
+        return [func(*task) for task in tasks_this_thread]
+
+    rets = _thread_map(run_tasks, [tasks[n::num_threads] for n in range(num_threads)])
+
+    results = [None] * len(tasks)
+    for n in range(num_threads):
+        results[n::num_threads] = rets[n]
+    return results
+
+
 def parallel(p_args=[0],
              threads=config['number_of_threads'], reduce='interleave'):
     """Return a function decorator which makes a function execute in parallel.